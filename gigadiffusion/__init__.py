@@ -0,0 +1,5 @@
+from gigadiffusion.backends import DiffusersBackend, Processing, ProcessedTiles, StubBackend, TileInpaintBackend, WebUIAPIBackend
+from gigadiffusion.canvas import DiskCanvas
+from gigadiffusion.multi import run_many
+from gigadiffusion.pipeline import USDUFlatMode, USDUMode, USDUpscaler, USDUSFMode, calc_target_size, dry_run, run
+from gigadiffusion.tune import auto_tune
@@ -0,0 +1,4 @@
+import sys
+from gigadiffusion.cli import main
+
+sys.exit(main())
@@ -0,0 +1,301 @@
+import base64
+import io
+import json
+import os
+import time
+import urllib.request
+import numpy as np
+from PIL import Image, ImageFilter, PngImagePlugin
+
+
+class ProcessedTiles():
+    # Minimal stand-in for webui's Processed: the finished tiles plus an infotext per tile.
+    def __init__(self, images, infotexts) -> None:
+        self.images = images
+        self.infotexts = infotexts
+
+    def infotext(self, p, index):
+        if index < len(self.infotexts) and self.infotexts[index] is not None:
+            return self.infotexts[index]
+        return ""
+
+
+class Processing():
+    # Plain stand-in for webui's StableDiffusionProcessingImg2Img for backends outside webui.
+    # The pipeline reads and rewrites these attributes between jobs, exactly as it does on webui's p.
+    def __init__(self, width, height, prompt="", negative_prompt="", seed=0, steps=20, cfg_scale=7.0,
+                 sampler_name=None, denoising_strength=0.35, batch_size=1, outpath_samples="outputs",
+                 output_name="gigadiffusion") -> None:
+        self.width = width
+        self.height = height
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.seed = seed
+        self.subseed = 0
+        self.subseed_strength = 0
+        self.steps = steps
+        self.cfg_scale = cfg_scale
+        self.sampler_name = sampler_name
+        self.denoising_strength = denoising_strength
+        self.batch_size = batch_size
+        self.outpath_samples = outpath_samples
+        self.output_name = output_name
+        self.mask_blur = 0
+        self.inpaint_full_res = True
+        self.inpaint_full_res_padding = 0
+        self.inpainting_fill = 1
+        self.init_images = []
+        self.extra_generation_params = {}
+
+
+def sample_seeds(p):
+    if isinstance(p.seed, list):
+        return p.seed
+    return [p.seed + index for index in range(len(p.init_images))]
+
+
+def create_infotext(p, seed):
+    # Same layout as webui infotexts, so PNGs written outside webui can still be read back by it.
+    params = {
+        "Steps": p.steps,
+        "Sampler": p.sampler_name,
+        "CFG scale": p.cfg_scale,
+        "Seed": seed,
+        "Size": f"{p.width}x{p.height}",
+        "Denoising strength": p.denoising_strength,
+    }
+    params.update(p.extra_generation_params)
+    generation_params = ", ".join(f"{key}: {value}" for key, value in params.items() if value is not None)
+    negative_prompt = f"\nNegative prompt: {p.negative_prompt}" if p.negative_prompt else ""
+    return f"{p.prompt}{negative_prompt}\n{generation_params}"
+
+
+def calc_crop_region(mask, padding, width, height):
+    # What webui's inpaint_full_res crops: the mask bounds plus padding, grown to the width:height
+    # aspect ratio of the processing size and kept inside the image.
+    pixels = np.asarray(mask.convert("L"))
+    rows = np.flatnonzero(pixels.any(axis=1))
+    cols = np.flatnonzero(pixels.any(axis=0))
+    if len(rows) == 0:
+        return 0, 0, mask.width, mask.height
+    x1 = max(int(cols[0]) - padding, 0)
+    y1 = max(int(rows[0]) - padding, 0)
+    x2 = min(int(cols[-1]) + 1 + padding, mask.width)
+    y2 = min(int(rows[-1]) + 1 + padding, mask.height)
+    if (x2 - x1) / (y2 - y1) > width / height:
+        diff = int((x2 - x1) / (width / height) - (y2 - y1))
+        y1 -= diff // 2
+        y2 += diff - diff // 2
+        if y2 >= mask.height:
+            y1 -= y2 - mask.height
+            y2 = mask.height
+        if y1 < 0:
+            y2 = min(y2 - y1, mask.height)
+            y1 = 0
+    else:
+        diff = int((y2 - y1) * (width / height) - (x2 - x1))
+        x1 -= diff // 2
+        x2 += diff - diff // 2
+        if x2 >= mask.width:
+            x1 -= x2 - mask.width
+            x2 = mask.width
+        if x1 < 0:
+            x2 = min(x2 - x1, mask.width)
+            x1 = 0
+    return x1, y1, x2, y2
+
+
+class TileInpaintBackend():
+    # Everything the pipeline needs from a diffusion host.
+    # process() gets p with init_images, per-sample p.seed / p.subseed lists and the processing
+    # settings, plus one mask per init image. It returns an object with .images (same order and size
+    # as p.init_images) and .infotext(p, index), like webui's Processed.
+    upscaler_name = "None"
+    # False makes the tiled first-stage upscale call upscale() from one thread at a time.
+    upscale_thread_safe = True
+    stopped = False
+    job_count = 0
+
+    def process(self, p, masks):
+        raise NotImplementedError
+
+    def upscale(self, image, scale):
+        return image.resize((image.width * scale, image.height * scale), resample=Image.LANCZOS)
+
+    def model_hash(self):
+        return None
+
+    def interrupt(self):
+        self.stopped = True
+
+    def interrupted(self) -> bool:
+        return self.stopped
+
+    def begin(self):
+        self.stopped = False
+
+    def end(self):
+        pass
+
+    def set_job_count(self, job_count):
+        self.job_count = job_count
+
+    def save_image(self, image, p, seed, info):
+        os.makedirs(p.outpath_samples, exist_ok=True)
+        index = 0
+        path = os.path.join(p.outpath_samples, f"{p.output_name}-{seed}.png")
+        while os.path.exists(path):
+            index += 1
+            path = os.path.join(p.outpath_samples, f"{p.output_name}-{seed}-{index}.png")
+        pnginfo = PngImagePlugin.PngInfo()
+        pnginfo.add_text("parameters", info or "")
+        image.save(path, "PNG", pnginfo=pnginfo)
+        print(f"Saved {path}")
+        return path
+
+
+class StubBackend(TileInpaintBackend):
+    # Hands every tile back unchanged, to run the orchestration without a model (tests, CI, benchmarks).
+    # delay seconds per sample stand in for model time.
+    def __init__(self, upscaler_name="None", delay=0) -> None:
+        self.upscaler_name = upscaler_name
+        self.delay = delay
+        self.calls = 0
+        self.samples = 0
+
+    def process(self, p, masks):
+        self.calls += 1
+        self.samples += len(p.init_images)
+        if self.delay > 0:
+            time.sleep(self.delay * len(p.init_images))
+        images = [image.convert("RGB").copy() for image in p.init_images]
+        return ProcessedTiles(images, [create_infotext(p, seed) for seed in sample_seeds(p)])
+
+
+class DiffusersBackend(TileInpaintBackend):
+    # Inpaints tiles with a diffusers inpainting pipeline. torch and diffusers are optional and only
+    # imported when this backend is created.
+    def __init__(self, model, device=None, upscaler_name="None") -> None:
+        try:
+            import torch
+            from diffusers import AutoPipelineForInpainting
+        except ImportError as e:
+            raise ImportError("DiffusersBackend needs the optional torch and diffusers packages") from e
+        self.torch = torch
+        self.model = model
+        self.upscaler_name = upscaler_name
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        dtype = torch.float16 if self.device == "cuda" else torch.float32
+        self.pipe = AutoPipelineForInpainting.from_pretrained(model, torch_dtype=dtype).to(self.device)
+
+    def model_hash(self):
+        return self.model
+
+    def process(self, p, masks):
+        seeds = sample_seeds(p)
+        crops = []
+        crop_masks = []
+        regions = []
+        blurred = []
+        for image, mask in zip(p.init_images, masks):
+            mask = mask.convert("L")
+            if p.mask_blur > 0:
+                mask = mask.filter(ImageFilter.GaussianBlur(p.mask_blur))
+            region = (0, 0, image.width, image.height)
+            if p.inpaint_full_res:
+                region = calc_crop_region(mask, p.inpaint_full_res_padding, p.width, p.height)
+            crops.append(image.convert("RGB").crop(region).resize((p.width, p.height), resample=Image.LANCZOS))
+            crop_masks.append(mask.crop(region).resize((p.width, p.height), resample=Image.LANCZOS))
+            regions.append(region)
+            blurred.append(mask)
+        generators = [self.torch.Generator(device=self.device).manual_seed(int(seed)) for seed in seeds]
+        result = self.pipe(
+            prompt=[p.prompt] * len(crops),
+            negative_prompt=[p.negative_prompt] * len(crops),
+            image=crops,
+            mask_image=crop_masks,
+            width=p.width,
+            height=p.height,
+            strength=p.denoising_strength,
+            num_inference_steps=p.steps,
+            guidance_scale=p.cfg_scale,
+            generator=generators,
+        )
+        images = []
+        for index, output in enumerate(result.images):
+            region = regions[index]
+            source = p.init_images[index].convert("RGB")
+            painted = source.copy()
+            painted.paste(output.resize((region[2] - region[0], region[3] - region[1]), resample=Image.LANCZOS), region[:2])
+            images.append(Image.composite(painted, source, blurred[index]))
+        return ProcessedTiles(images, [create_infotext(p, seed) for seed in seeds])
+
+
+def encode_image(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def decode_image(data):
+    # The API may prefix a data URL header.
+    return Image.open(io.BytesIO(base64.b64decode(data.split(",", 1)[-1])))
+
+
+class WebUIAPIBackend(TileInpaintBackend):
+    # Sends tiles to another webui started with --api (or python -m gigadiffusion.worker), e.g. one per
+    # GPU on the same host. The img2img API takes a single seed and mask, so every sample is its own
+    # request. Only used for redraw and seams fix jobs; the first-stage upscale stays local.
+    def __init__(self, url, timeout=600) -> None:
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.hash = None
+
+    def request(self, path, payload=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(self.url + path, data=data, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def model_hash(self):
+        # Part of the tile cache key, so tiles cached from one model are never served for another.
+        if self.hash is None:
+            try:
+                options = self.request("/sdapi/v1/options")
+                self.hash = options.get("sd_checkpoint_hash") or options.get("sd_model_checkpoint") or ""
+            except (OSError, ValueError):
+                return None
+        return self.hash or None
+
+    def process(self, p, masks):
+        seeds = sample_seeds(p)
+        subseeds = p.subseed if isinstance(p.subseed, list) else [p.subseed + index for index in range(len(seeds))]
+        images = []
+        infotexts = []
+        for index, (image, mask) in enumerate(zip(p.init_images, masks)):
+            payload = {
+                "init_images": [encode_image(image.convert("RGB"))],
+                "mask": encode_image(mask.convert("L")),
+                "prompt": p.prompt,
+                "negative_prompt": p.negative_prompt,
+                "seed": int(seeds[index]),
+                "subseed": int(subseeds[index]),
+                "subseed_strength": p.subseed_strength,
+                "steps": p.steps,
+                "cfg_scale": p.cfg_scale,
+                "sampler_name": p.sampler_name,
+                "denoising_strength": p.denoising_strength,
+                "width": p.width,
+                "height": p.height,
+                "mask_blur": p.mask_blur,
+                "inpaint_full_res": p.inpaint_full_res,
+                "inpaint_full_res_padding": p.inpaint_full_res_padding,
+                "inpainting_fill": p.inpainting_fill,
+                "batch_size": 1,
+                "n_iter": 1,
+            }
+            result = self.request("/sdapi/v1/img2img", {key: value for key, value in payload.items() if value is not None})
+            images.append(decode_image(result["images"][0]).convert("RGB"))
+            info = json.loads(result.get("info") or "{}")
+            infotexts.append((info.get("infotexts") or [None])[0])
+        return ProcessedTiles(images, infotexts)
@@ -0,0 +1,121 @@
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import sys
+import time
+import numpy as np
+from PIL import Image
+from gigadiffusion.backends import Processing, StubBackend
+from gigadiffusion.pipeline import USDUMode, USDUpscaler, USDUSFMode
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Redraw modes run without a seams fix, seams fix modes without a redraw, so each case times one pass.
+cases = {
+    "linear": (USDUMode.LINEAR, USDUSFMode.NONE),
+    "chess": (USDUMode.CHESS, USDUSFMode.NONE),
+    "band_pass": (USDUMode.NONE, USDUSFMode.BAND_PASS),
+    "half_tile": (USDUMode.NONE, USDUSFMode.HALF_TILE),
+    "half_tile_plus_intersections": (USDUMode.NONE, USDUSFMode.HALF_TILE_PLUS_INTERSECTIONS),
+}
+
+default_sizes = [2048, 4096, 8192, 16384, 32768]
+
+
+def peak_rss_megabytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def source_image(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), "RGB")
+
+
+def run_case(case, size, tile_size=512, padding=128, batch_size=4, scale=4, disk_canvas=False):
+    # Runs in a fresh process, so peak RSS belongs to this case alone.
+    redraw_mode, seams_fix_mode = cases[case]
+    image = source_image(max(1, size // scale), max(1, size // scale))
+    backend = StubBackend()
+    p = Processing(size, size, seed=1, batch_size=batch_size)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        upscaler = USDUpscaler(p, image, backend, False, False, tile_size)
+        upscaler.setup_canvas(disk_canvas)
+        upscaler.setup_redraw(redraw_mode.value, padding, 0)
+        upscaler.setup_seams_fix(padding, 0.35, 0, 64, seams_fix_mode.value)
+        upscaler.upscale()
+        upscaled = time.perf_counter()
+        upscaler.process()
+    finished = time.perf_counter()
+    return {
+        "case": case,
+        "size": size,
+        "tile_size": tile_size,
+        "batch_size": batch_size,
+        "disk_canvas": disk_canvas,
+        "tiles": math.ceil(size / tile_size) ** 2,
+        "wall_seconds": finished - start,
+        "upscale_seconds": upscaled - start,
+        "process_seconds": finished - upscaled,
+        "peak_rss_mb": peak_rss_megabytes(),
+        "backend_calls": backend.calls,
+        "samples": backend.samples,
+        # Share of the requested batch the backend actually got, averaged over calls.
+        "batch_fill": backend.samples / (backend.calls * batch_size) if backend.calls > 0 else 0,
+        "timings": upscaler.metrics.totals(),
+    }
+
+
+def run_isolated(*args, **kwargs):
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_case, *args, **kwargs).result()
+
+
+def format_result(result):
+    rss = f"{result['peak_rss_mb']:.0f}" if result["peak_rss_mb"] is not None else "-"
+    return (f"{result['case']:<30} {result['size']:>6} {result['tiles']:>6} {result['wall_seconds']:>9.2f} "
+            f"{result['process_seconds']:>9.2f} {rss:>9} {result['backend_calls']:>6} {result['batch_fill']:>6.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="gigadiffusion.benchmark", description="Time the tiling pipeline on a stub backend that returns every tile unchanged.")
+    parser.add_argument("--cases", nargs="+", choices=list(cases), default=list(cases))
+    parser.add_argument("--sizes", nargs="+", type=int, default=default_sizes, help="square canvas sizes in pixels")
+    parser.add_argument("--tile-size", type=int, default=512)
+    parser.add_argument("--padding", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--scale", type=int, default=4, help="canvas size / source image size")
+    parser.add_argument("--disk-canvas-from", type=int, default=16384, help="use the disk-backed canvas from this size on")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    print(f"{'case':<30} {'size':>6} {'tiles':>6} {'wall (s)':>9} {'proc (s)':>9} {'rss (MB)':>9} {'calls':>6} {'fill':>6}")
+    results = []
+    for size in args.sizes:
+        for case in args.cases:
+            result = run_isolated(case, size, tile_size=args.tile_size, padding=args.padding, batch_size=args.batch_size,
+                                  scale=args.scale, disk_canvas=size >= args.disk_canvas_from)
+            results.append(result)
+            print(format_result(result), flush=True)
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
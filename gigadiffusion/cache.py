@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import threading
+from PIL import Image, PngImagePlugin
+
+
+class TileCache():
+    # On-disk LRU of finished tiles, addressed by a hash of everything that determines the result:
+    # the cropped pixels, the mask and the generation settings (prompt, model, seed, steps, denoise...).
+    # Hits refresh the file mtime, and the oldest files are evicted once the cache outgrows max_bytes.
+    def __init__(self, path, max_bytes) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(size for _, _, size in self.entries())
+
+    @staticmethod
+    def key(image, mask, settings):
+        digest = hashlib.sha256()
+        for part in [image, mask]:
+            if part is None:
+                continue
+            digest.update(f"{part.mode}{part.size}".encode("utf-8"))
+            digest.update(part.tobytes())
+        digest.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + ".png")
+
+    def entries(self):
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def get(self, key):
+        # Returns (image, infotext), or None on a miss.
+        path = self.entry_path(key)
+        try:
+            with Image.open(path) as cached:
+                image = cached.convert("RGB")
+                infotext = cached.info.get("parameters", "")
+            os.utime(path)
+        except (FileNotFoundError, OSError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return image, infotext
+
+    def put(self, key, image, infotext=""):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        info = PngImagePlugin.PngInfo()
+        info.add_text("parameters", infotext or "")
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        image.save(temp_path, "PNG", pnginfo=info)
+        size = os.path.getsize(temp_path)
+        previous = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temp_path, path)
+        with self.lock:
+            self.size += size - previous
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Drop least recently used tiles until the cache is back to 90% of its cap.
+        target = self.max_bytes * 0.9
+        for path, _, size in sorted(self.entries(), key=lambda entry: entry[1]):
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self.size -= size
@@ -0,0 +1,137 @@
+import os
+import struct
+import tempfile
+import zlib
+import numpy as np
+from PIL import Image
+
+
+class DiskCanvas():
+    # RGB canvas kept in a raw, row-major uint8 file and memory-mapped, so only the tiles being
+    # cropped or pasted are resident. Mirrors the subset of the PIL.Image API the redraw and
+    # seams fix passes use (width, height, size, crop, paste), so either can be passed around.
+    mode = "RGB"
+
+    def __init__(self, path, width, height, create=True, delete=False) -> None:
+        self.path = path
+        self.width = width
+        self.height = height
+        self.delete = delete
+        # Called with the canvas rect of every paste, e.g. by an output writer.
+        self.listeners = []
+        self.pixels = np.memmap(path, dtype=np.uint8, mode="w+" if create else "r+", shape=(height, width, 3))
+
+    @staticmethod
+    def create_temp(width, height, dir=None):
+        fd, path = tempfile.mkstemp(prefix="gigadiffusion-", suffix=".raw", dir=dir)
+        os.close(fd)
+        return DiskCanvas(path, width, height, create=True, delete=True)
+
+    @staticmethod
+    def from_image(image, path=None, strip_height=1024):
+        if path is None:
+            canvas = DiskCanvas.create_temp(image.width, image.height)
+        else:
+            canvas = DiskCanvas(path, image.width, image.height, create=True)
+        # Copy in horizontal strips so converting never needs a second full-size buffer.
+        for top in range(0, image.height, strip_height):
+            bottom = min(top + strip_height, image.height)
+            canvas.paste(image.crop((0, top, image.width, bottom)), (0, top))
+        canvas.flush()
+        return canvas
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    def clip(self, rect):
+        left = min(max(rect[0], 0), self.width)
+        top = min(max(rect[1], 0), self.height)
+        right = min(max(rect[2], left), self.width)
+        bottom = min(max(rect[3], top), self.height)
+        return left, top, right, bottom
+
+    def crop(self, rect=None):
+        if rect is None:
+            rect = (0, 0, self.width, self.height)
+        rect = tuple(int(v) for v in rect)
+        left, top, right, bottom = self.clip(rect)
+        # Like PIL, areas outside the canvas come back black.
+        if (left, top, right, bottom) == rect:
+            return Image.fromarray(np.array(self.pixels[top:bottom, left:right]), "RGB")
+        pixels = np.zeros((rect[3] - rect[1], rect[2] - rect[0], 3), dtype=np.uint8)
+        pixels[top - rect[1]:bottom - rect[1], left - rect[0]:right - rect[0]] = self.pixels[top:bottom, left:right]
+        return Image.fromarray(pixels, "RGB")
+
+    def paste(self, image, box=None, mask=None):
+        if box is None:
+            box = (0, 0)
+        if len(box) == 4 and (box[2] - box[0], box[3] - box[1]) != image.size:
+            raise ValueError("images do not match")
+        x, y = int(box[0]), int(box[1])
+        left, top, right, bottom = self.clip((x, y, x + image.width, y + image.height))
+        if right <= left or bottom <= top:
+            return
+        source = (left - x, top - y, right - x, bottom - y)
+        pixels = np.asarray(image.convert("RGB").crop(source))
+        if mask is None:
+            self.pixels[top:bottom, left:right] = pixels
+        else:
+            alpha = np.asarray(mask.convert("L").crop(source), dtype=np.float32)[..., None] / 255
+            current = self.pixels[top:bottom, left:right].astype(np.float32)
+            self.pixels[top:bottom, left:right] = np.rint(pixels * alpha + current * (1 - alpha)).astype(np.uint8)
+        for listener in self.listeners:
+            listener((left, top, right, bottom))
+
+    def to_image(self):
+        return Image.fromarray(np.array(self.pixels), "RGB")
+
+    def save_png(self, path, info=None, strip_height=256):
+        # PNG encoded strip by strip from the memmap, so saving never loads the whole canvas. info goes
+        # in the "parameters" text chunk, where webui keeps generation parameters.
+        def chunk(file, kind, data):
+            file.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data)))
+
+        with open(path, "wb") as file:
+            file.write(b"\x89PNG\r\n\x1a\n")
+            chunk(file, b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0))
+            if info is not None:
+                chunk(file, b"iTXt", b"parameters\0\0\0\0\0" + info.encode("utf-8"))
+            compressor = zlib.compressobj(6)
+            for top in range(0, self.height, strip_height):
+                rows = np.array(self.pixels[top:min(top + strip_height, self.height)]).reshape(-1, self.width * 3)
+                # Every row starts with its filter type, 0 (none).
+                data = compressor.compress(np.pad(rows, ((0, 0), (1, 0))).tobytes())
+                if len(data) > 0:
+                    chunk(file, b"IDAT", data)
+            chunk(file, b"IDAT", compressor.flush())
+            chunk(file, b"IEND", b"")
+
+    def preview(self, max_size=4096, strip_height=1024):
+        # Downscaled copy for the gallery, built strip by strip so the full canvas is never loaded.
+        scale = min(1, max_size / max(self.width, self.height))
+        width = max(1, round(self.width * scale))
+        height = max(1, round(self.height * scale))
+        if scale == 1:
+            return self.to_image()
+        preview = Image.new("RGB", (width, height))
+        for top in range(0, self.height, strip_height):
+            bottom = min(top + strip_height, self.height)
+            preview_top = round(top * scale)
+            preview_bottom = round(bottom * scale)
+            if preview_bottom <= preview_top:
+                continue
+            strip = self.crop((0, top, self.width, bottom)).resize((width, preview_bottom - preview_top), resample=Image.LANCZOS)
+            preview.paste(strip, (0, preview_top))
+        return preview
+
+    def flush(self):
+        self.pixels.flush()
+
+    def close(self):
+        if self.pixels is None:
+            return
+        self.pixels.flush()
+        self.pixels = None
+        if self.delete and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,110 @@
+import json
+import os
+from gigadiffusion.canvas import DiskCanvas
+
+
+class CheckpointJournal():
+    # A checkpoint directory holds the partially painted canvas (canvas.raw, the DiskCanvas backing
+    # file) and journal.json with the settings the run was planned with, the tile rects of every job
+    # per stage and the seeds each finished job used. The journal is only rewritten right after the
+    # canvas is flushed, so the two always describe the same point of the run.
+    version = 1
+
+    def __init__(self, path, every=8) -> None:
+        self.path = path
+        self.every = max(1, int(every))
+        self.journal_path = os.path.join(path, "journal.json")
+        self.canvas_path = os.path.join(path, "canvas.raw")
+        self.plan = None
+        self.analysis = {}
+        self.stages = {}
+        self.complete = False
+        self.canvas = None
+        self.since_checkpoint = 0
+
+    def exists(self) -> bool:
+        return os.path.exists(self.journal_path) and os.path.exists(self.canvas_path)
+
+    def load(self):
+        with open(self.journal_path, "r", encoding="utf-8") as file:
+            journal = json.load(file)
+        if journal.get("version") != self.version:
+            raise ValueError(f"unsupported checkpoint version {journal.get('version')} in {self.journal_path}")
+        self.plan = journal["plan"]
+        self.analysis = journal.get("analysis", {})
+        self.stages = journal["stages"]
+        self.complete = journal["complete"]
+
+    def matches(self, plan) -> bool:
+        # Round trip through json so tuples and lists compare equal.
+        return self.plan == json.loads(json.dumps(plan))
+
+    def create_canvas(self, width, height):
+        # The first-stage upscale is written straight into the checkpoint canvas. Any older journal is
+        # removed first, so a crash before start() never leaves a journal next to a half-filled canvas.
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.canvas = DiskCanvas(self.canvas_path, width, height, create=True)
+        return self.canvas
+
+    def start(self, plan, analysis=None):
+        # analysis holds what was measured on the upscaled canvas (flat tiles), so a resume needn't redo it.
+        self.plan = json.loads(json.dumps(plan))
+        self.analysis = json.loads(json.dumps(analysis or {}))
+        self.stages = {}
+        self.complete = False
+        self.canvas.flush()
+        self.write()
+
+    def open_canvas(self):
+        self.canvas = DiskCanvas(self.canvas_path, self.plan["width"], self.plan["height"], create=False)
+        return self.canvas
+
+    def begin_stage(self, stage, job_rects):
+        if stage in self.stages:
+            if self.stages[stage]["jobs"] != json.loads(json.dumps(job_rects)):
+                raise ValueError(f"{stage} jobs in {self.journal_path} do not match the current plan")
+            return
+        self.stages[stage] = {"jobs": job_rects, "seeds": [], "complete": False}
+        self.write()
+
+    def completed(self, stage) -> int:
+        if stage not in self.stages:
+            return 0
+        return len(self.stages[stage]["seeds"])
+
+    def job_done(self, stage, seed, all_seeds, all_subseeds):
+        self.stages[stage]["seeds"].append({"seed": seed, "all_seeds": list(all_seeds or []), "all_subseeds": list(all_subseeds or [])})
+        self.since_checkpoint += 1
+        if self.since_checkpoint >= self.every:
+            self.checkpoint()
+
+    def finish_stage(self, stage):
+        self.stages[stage]["complete"] = True
+        self.checkpoint()
+
+    def stage_complete(self, stage) -> bool:
+        return stage in self.stages and self.stages[stage]["complete"]
+
+    def checkpoint(self):
+        if self.canvas is not None and self.canvas.pixels is not None:
+            self.canvas.flush()
+        self.write()
+        self.since_checkpoint = 0
+
+    def finish(self):
+        # The finished image has been saved, so the canvas copy is no longer needed.
+        self.complete = True
+        self.write()
+        if self.canvas is not None:
+            self.canvas.close()
+        if os.path.exists(self.canvas_path):
+            os.remove(self.canvas_path)
+
+    def write(self):
+        journal = {"version": self.version, "plan": self.plan, "analysis": self.analysis, "stages": self.stages, "complete": self.complete}
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(journal, file)
+        os.replace(temp_path, self.journal_path)
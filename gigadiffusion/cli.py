@@ -0,0 +1,201 @@
+import argparse
+import contextlib
+import functools
+import json
+import os
+import random
+import signal
+import sys
+from PIL import Image
+from gigadiffusion.backends import DiffusersBackend, Processing, StubBackend, WebUIAPIBackend
+from gigadiffusion.multi import run_many
+from gigadiffusion.tune import auto_tune
+from gigadiffusion.pipeline import USDUFlatMode, USDUMode, USDUSFMode, calc_target_size, dry_run, run
+
+image_extensions = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff")
+
+redraw_modes = {mode.name.lower(): mode for mode in USDUMode}
+seams_fix_modes = {mode.name.lower(): mode for mode in USDUSFMode}
+flat_tile_modes = {mode.name.lower(): mode for mode in USDUFlatMode}
+
+
+def find_images(inputs):
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.lower().endswith(image_extensions))
+        else:
+            paths.append(path)
+    return paths
+
+
+def load_image(path):
+    with Image.open(path) as source:
+        return source.convert("RGB")
+
+
+def create_processing(args, path):
+    # Only reads the image header for its size, the pixels are loaded when the image's turn comes.
+    with Image.open(path) as source:
+        source_width, source_height = source.size
+    if args.region is not None or args.region_mask:
+        # The input is a finished output, re-rendered at its own size.
+        width, height = source_width, source_height
+    elif args.size is not None:
+        width, height = args.size
+    else:
+        width, height = calc_target_size(source_width, source_height, args.scale)
+    seed = args.seed if args.seed != -1 else random.randrange(4294967294)
+    return Processing(width, height, prompt=args.prompt, negative_prompt=args.negative_prompt, seed=seed,
+                      steps=args.steps, cfg_scale=args.cfg_scale, denoising_strength=args.denoise,
+                      batch_size=args.batch_size, outpath_samples=args.output,
+                      output_name=os.path.splitext(os.path.basename(path))[0])
+
+
+def run_settings(args, workers):
+    seams_fix_mode = seams_fix_modes[args.seams_fix]
+    return dict(
+        tile_size=args.tile_size, padding=args.padding,
+        redraw_mode=redraw_modes[args.redraw].value, redraw_blur=args.redraw_blur,
+        seams_fix_type=seams_fix_mode.value, seams_fix_width=args.seams_fix_width,
+        seams_fix_denoise=args.seams_fix_denoise, seams_fix_padding=args.seams_fix_padding,
+        seams_blur=args.seams_blur, save_redraw=args.save_redraw or seams_fix_mode == USDUSFMode.NONE,
+        save_seams_fix=True, disk_canvas=args.disk_canvas, stream_output=args.stream_output,
+        checkpoint_every=args.checkpoint_every, resume=args.resume,
+        cache_dir=args.cache_dir, cache_size=args.cache_size, metrics_path=args.metrics,
+        prefetch=args.prefetch, upscale_cache_dir=args.upscale_cache_dir,
+        flat_tiles=flat_tile_modes[args.flat_tiles].value, detail_threshold=args.detail_threshold,
+        flat_denoise_scale=args.flat_denoise_scale, quadtree_levels=args.quadtree_levels,
+        seam_threshold=args.seam_threshold, workers=workers, region=load_region(args), wavefront=args.wavefront,
+        seam_coloring=args.seam_coloring)
+
+
+def load_region(args):
+    if args.region_mask:
+        return load_image(args.region_mask).convert("L")
+    return tuple(args.region) if args.region is not None else None
+
+
+def create_backend(args):
+    if args.backend == "diffusers":
+        if not args.model:
+            raise SystemExit("--model is required with --backend diffusers")
+        return DiffusersBackend(args.model, device=args.device, upscaler_name=args.upscaler)
+    return StubBackend(upscaler_name=args.upscaler, delay=args.stub_delay)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog="gigadiffusion", description="Upscale images, then redraw and deseam them tile by tile.")
+    parser.add_argument("inputs", nargs="+", help="images or folders of images")
+    parser.add_argument("--output", default="outputs", help="output folder")
+    parser.add_argument("--backend", choices=["stub", "diffusers"], default="stub", help="stub returns tiles unchanged, for testing the pipeline")
+    parser.add_argument("--model", default=None, help="diffusers inpainting model id or path")
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--stub-delay", type=float, default=0, help="seconds per tile the stub backend sleeps, standing in for model time")
+    parser.add_argument("--workers", nargs="*", default=[], metavar="URL",
+                        help="webui --api or python -m gigadiffusion.worker instances sharing the redraw and seams fix")
+    parser.add_argument("--upscaler", default="Lanczos", help='"None" resizes straight to the target size')
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument("--scale", type=float, default=2)
+    size.add_argument("--size", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"), default=None)
+    parser.add_argument("--prompt", default="")
+    parser.add_argument("--negative-prompt", default="")
+    parser.add_argument("--seed", type=int, default=-1, help="-1 picks a random seed")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--cfg-scale", type=float, default=7.0)
+    parser.add_argument("--denoise", type=float, default=0.35)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--tile-size", type=int, default=512)
+    parser.add_argument("--padding", type=int, default=128)
+    parser.add_argument("--redraw", choices=list(redraw_modes), default="chess")
+    parser.add_argument("--redraw-blur", type=int, default=0)
+    parser.add_argument("--seams-fix", choices=list(seams_fix_modes), default="half_tile")
+    parser.add_argument("--seams-fix-denoise", type=float, default=0.45)
+    parser.add_argument("--seams-fix-width", type=int, default=64)
+    parser.add_argument("--seams-fix-padding", type=int, default=128)
+    parser.add_argument("--seams-blur", type=int, default=0)
+    parser.add_argument("--save-redraw", action="store_true", help="also save the image before the seams fix")
+    parser.add_argument("--disk-canvas", action="store_true")
+    parser.add_argument("--stream-output", action="store_true")
+    parser.add_argument("--checkpoint-dir", default="")
+    parser.add_argument("--checkpoint-every", type=int, default=8)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--cache-dir", default="")
+    parser.add_argument("--cache-size", type=int, default=4096, help="tile cache size in MB")
+    parser.add_argument("--prefetch", type=int, default=2, help="jobs to crop and mask ahead while the backend runs, 0 runs serially")
+    parser.add_argument("--upscale-cache-dir", default="", help="keep first-stage upscaler outputs here, shares --cache-size")
+    parser.add_argument("--flat-tiles", choices=list(flat_tile_modes), default="redraw", help="what to do with tiles without detail after the upscale")
+    parser.add_argument("--detail-threshold", type=float, default=2.0, help="mean gradient (0-255) below which a tile counts as flat")
+    parser.add_argument("--flat-denoise-scale", type=float, default=0.5, help="denoise multiplier for flat tiles with --flat-tiles lower_denoise")
+    parser.add_argument("--quadtree-levels", type=int, default=0, help="redraw flat areas as blocks of up to 2^N x 2^N tiles at model resolution")
+    parser.add_argument("--seam-threshold", type=float, default=0, help="only fix half tile seams whose edge stands out this much from the tiles around it (1 is invisible, try 1.5), 0 fixes all")
+    parser.add_argument("--metrics", default="", help="write timings to this .jsonl (appended) or .prom file, one per image with --images-at-once above 1")
+    parser.add_argument("--images-at-once", type=int, default=1,
+                        help="run this many images side by side, packing their tiles into shared --batch-size batches")
+    parser.add_argument("--region", type=int, nargs=4, default=None, metavar=("LEFT", "TOP", "RIGHT", "BOTTOM"),
+                        help="inputs are finished outputs, only re-render the tiles and seams around this rect")
+    parser.add_argument("--region-mask", default="", metavar="PATH", help="like --region, for the area that is not black in this mask")
+    parser.add_argument("--wavefront", action="store_true",
+                        help="fix each seam as soon as the tiles around it are redrawn instead of after the whole redraw (chess + half tile)")
+    parser.add_argument("--seam-coloring", action="store_true",
+                        help="pack half tile seams and intersections into batches of non-overlapping patches when that needs fewer calls")
+    parser.add_argument("--vram-budget", type=int, default=0, metavar="MB",
+                        help="pick tile size (up to --tile-size), padding (at least --padding) and batch size per image to fit this much VRAM")
+    parser.add_argument("--ram-budget", type=int, default=0, metavar="MB", help="with --vram-budget, also keep the planned peak host memory under this")
+    parser.add_argument("--dry-run", default="", metavar="PATH",
+                        help='write backend calls, batch fill, steps and peak memory of every input to this JSON file ("-" for stdout) without rendering')
+    return parser
+
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    backend = create_backend(args)
+    workers = [WebUIAPIBackend(url) for url in args.workers]
+    settings = run_settings(args, workers)
+
+    # First Ctrl+C stops after the running job so checkpoints stay resumable, a second one aborts.
+    def interrupt(signum, frame):
+        if backend.interrupted():
+            raise KeyboardInterrupt
+        print("Interrupting after the current job")
+        backend.interrupt()
+    signal.signal(signal.SIGINT, interrupt)
+
+    items = []
+    # Planning logs go to stderr on a dry run, so "-" leaves only the JSON on stdout.
+    with contextlib.redirect_stdout(sys.stderr) if args.dry_run else contextlib.nullcontext():
+        for path in find_images(args.inputs):
+            p = create_processing(args, path)
+            # Each input keeps its own checkpoint, so a folder run can be resumed image by image.
+            overrides = {"checkpoint_dir": os.path.join(args.checkpoint_dir, p.output_name) if args.checkpoint_dir else ""}
+            if args.vram_budget > 0:
+                with Image.open(path) as source:
+                    tuned, _ = auto_tune(p, source, args.vram_budget, args.ram_budget, **settings)
+                overrides.update(tuned)
+            items.append((path, p, overrides))
+
+    if args.dry_run:
+        plans = []
+        with contextlib.redirect_stdout(sys.stderr):
+            for path, p, overrides in items:
+                with Image.open(path) as source:
+                    plans.append({"input": path, **dry_run(p, source, **{**settings, **overrides})})
+        if args.dry_run == "-":
+            print(json.dumps(plans, indent=2))
+        else:
+            with open(args.dry_run, "w", encoding="utf-8") as file:
+                json.dump(plans, file, indent=2)
+        return 0
+
+    if args.images_at_once > 1:
+        print(f"Processing {len(items)} images, {args.images_at_once} at once")
+        run_many(backend, [(p, functools.partial(load_image, path), overrides) for path, p, overrides in items],
+                 images_at_once=args.images_at_once, **settings)
+        return 1 if backend.interrupted() else 0
+
+    for path, p, overrides in items:
+        print(f"Processing {path} to {p.width}x{p.height}")
+        run(backend, p, load_image(path), **{**settings, **overrides})
+        if backend.interrupted():
+            return 1
+    return 0
@@ -0,0 +1,82 @@
+import numpy as np
+
+
+def tile_detail_scores(image, tile_size, rows, cols, reduce=4):
+    # Mean gradient magnitude (|dx| + |dy| on a 0-255 grayscale) of every cell of the tile grid. Works
+    # one row of tiles at a time on a reduced grayscale strip, and sums all cells of the strip at once.
+    scores = np.zeros((rows, cols), dtype=np.float32)
+    for yi in range(rows):
+        top = yi * tile_size
+        bottom = min(top + tile_size, image.height)
+        strip = image.crop((0, top, image.width, bottom)).convert("L")
+        factor = max(1, min(reduce, strip.width, strip.height))
+        if factor > 1:
+            strip = strip.reduce(factor)
+        pixels = np.asarray(strip, dtype=np.float32)
+        energy = np.zeros_like(pixels)
+        energy[:, 1:] += np.abs(np.diff(pixels, axis=1))
+        energy[1:, :] += np.abs(np.diff(pixels, axis=0))
+        bounds = np.minimum(np.arange(cols) * tile_size // factor, pixels.shape[1] - 1)
+        sums = np.add.reduceat(energy.sum(axis=0), bounds)
+        widths = np.diff(np.append(bounds, pixels.shape[1]))
+        scores[yi] = sums / np.maximum(widths * pixels.shape[0], 1)
+    return scores
+
+
+def low_detail_tiles(scores, threshold):
+    return {(int(xi), int(yi)) for yi, xi in np.argwhere(scores < threshold)}
+
+
+class DetailFilter():
+    # Grid cells (xi, yi) judged flat, and what happens to jobs that only touch flat cells: skipped, or
+    # run with denoise scaled by denoise_scale. A worst_case filter stands in for cells that are not
+    # known yet, the jobs are split the way that costs the most backend calls.
+    def __init__(self, flat=(), skip=True, denoise_scale=1.0, worst_case=False) -> None:
+        self.flat = set(flat)
+        self.skip = skip
+        self.denoise_scale = denoise_scale
+        self.worst_case = worst_case
+
+    def is_flat(self, *cells) -> bool:
+        return len(self.flat) > 0 and all(cell in self.flat for cell in cells)
+
+
+def boundary_scores(strip, center, band, bounds):
+    # strip is grayscale with the boundary between rows center - 1 and center. Mean gradient across
+    # the rows within band of the boundary, over the mean gradient of the rows further out, per
+    # segment of columns starting at bounds. Around 1 where the boundary looks like the tiles beside it.
+    gradient = np.abs(np.diff(strip, axis=0))
+    near = slice(max(center - band, 0), center + band - 1)
+    seam = gradient[near].mean(axis=0)
+    rest = np.concatenate([gradient[:near.start], gradient[near.stop:]])
+    reference = rest.mean(axis=0) if len(rest) > 0 else np.zeros_like(seam)
+    widths = np.diff(np.append(bounds, strip.shape[1]))
+    seam = np.add.reduceat(seam, bounds) / widths
+    reference = np.add.reduceat(reference, bounds) / widths
+    return seam / (reference + 1)
+
+
+def seam_scores(image, tile_size, rows, cols, band=2, reference=8):
+    # Visibility of every tile boundary of the redrawn canvas, as (row_scores, col_scores):
+    # row_scores[yi, xi] for the boundary below tile (xi, yi), col_scores[yi, xi] for the one right of
+    # it. Only thin strips along the boundaries are read.
+    row_scores = np.zeros((max(rows - 1, 0), cols), dtype=np.float32)
+    col_scores = np.zeros((rows, max(cols - 1, 0)), dtype=np.float32)
+    reach = band + reference
+    for yi in range(1, rows):
+        y = yi * tile_size
+        top = max(y - reach, 0)
+        strip = np.asarray(image.crop((0, top, image.width, min(y + reach, image.height))).convert("L"), dtype=np.float32)
+        row_scores[yi - 1] = boundary_scores(strip, y - top, band, np.arange(cols) * tile_size)
+    for xi in range(1, cols):
+        x = xi * tile_size
+        left = max(x - reach, 0)
+        strip = np.asarray(image.crop((left, 0, min(x + reach, image.width), image.height)).convert("L"), dtype=np.float32)
+        col_scores[:, xi - 1] = boundary_scores(strip.T, x - left, band, np.arange(rows) * tile_size)
+    return row_scores, col_scores
+
+
+def visible_seams(row_scores, col_scores, threshold):
+    rows = {(int(xi), int(yi)) for yi, xi in np.argwhere(row_scores > threshold)}
+    cols = {(int(xi), int(yi)) for yi, xi in np.argwhere(col_scores > threshold)}
+    return rows, cols
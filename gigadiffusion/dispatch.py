@@ -0,0 +1,117 @@
+import collections
+import threading
+from gigadiffusion.prefetch import jobs_overlap
+
+
+class TileDispatcher():
+    # Spreads the jobs of a pass over several backends, e.g. one webui per GPU. Jobs are dealt round
+    # robin into one queue per backend; a backend whose queue has nothing ready takes the next job of
+    # another queue, so faster GPUs end up doing more of the pass. As in JobPrefetcher, a job is only
+    # taken once every earlier job whose tiles overlap it has been pasted: that is the barrier between
+    # passes that depend on each other (the chess colours), while the jobs within a pass run at once.
+    # Results are pasted in job order on one thread, so checkpoints always cover a prefix of the jobs,
+    # and at most `window` jobs run ahead of the paste. The first backend runs on the calling thread,
+    # as webui's processing must.
+    def __init__(self, backends, window=None) -> None:
+        self.backends = list(backends)
+        self.window = window or 4 * len(self.backends)
+        self.lock = threading.Condition()
+
+    def ready(self, jobs, index):
+        # Caller holds the lock.
+        if index >= self.pasted + self.window:
+            return False
+        return not any(jobs_overlap(jobs[earlier], jobs[index]) for earlier in range(self.pasted, index))
+
+    def take(self, worker, jobs):
+        # Caller holds the lock. Own queue first, then the queue whose next job comes earliest.
+        others = sorted((queue for index, queue in enumerate(self.queues) if index != worker and len(queue) > 0), key=lambda queue: queue[0])
+        for queue in [self.queues[worker]] + others:
+            if len(queue) > 0 and self.ready(jobs, queue[0]):
+                if queue is not self.queues[worker]:
+                    self.stolen += 1
+                self.taken[worker] += 1
+                return queue.popleft()
+        return None
+
+    def work(self, worker, jobs, prepare, process, interrupted):
+        backend = self.backends[worker]
+        try:
+            while True:
+                with self.lock:
+                    index = None
+                    while index is None:
+                        if self.error is not None or self.stopped or all(len(queue) == 0 for queue in self.queues):
+                            return
+                        index = self.take(worker, jobs)
+                        if index is None:
+                            self.lock.wait()
+                if interrupted():
+                    with self.lock:
+                        self.stopped = True
+                        self.lock.notify_all()
+                    return
+                job = jobs[index]
+                prepared = prepare(job)
+                processed = process(job, prepared, backend)
+                with self.lock:
+                    self.results[index] = (prepared, processed)
+                    self.lock.notify_all()
+        except BaseException as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+                self.lock.notify_all()
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.lock.notify_all()
+
+    def paste_all(self, jobs, paste):
+        # Pastes finished jobs in order until the next one will never come.
+        try:
+            while True:
+                with self.lock:
+                    while self.pasted not in self.results and self.running > 0 and self.error is None:
+                        self.lock.wait()
+                    if self.pasted not in self.results or self.error is not None:
+                        return
+                    prepared, processed = self.results.pop(self.pasted)
+                paste(jobs[self.pasted], prepared, processed)
+                with self.lock:
+                    self.processed = processed
+                    self.pasted += 1
+                    self.lock.notify_all()
+        except BaseException as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+                self.lock.notify_all()
+
+    def run(self, jobs, prepare, process, paste, interrupted):
+        # Same contract as JobPrefetcher.run, except process(job, prepared, backend) is told which
+        # backend to send the job to.
+        self.queues = [collections.deque() for _ in self.backends]
+        for index in range(len(jobs)):
+            self.queues[index % len(self.backends)].append(index)
+        self.taken = [0] * len(self.backends)
+        self.results = {}
+        self.pasted = 0
+        self.stolen = 0
+        self.stopped = False
+        self.error = None
+        self.processed = None
+        self.running = len(self.backends)
+        threads = [threading.Thread(target=self.work, args=(worker, jobs, prepare, process, interrupted),
+                                    name=f"gigadiffusion-dispatch-{worker}", daemon=True) for worker in range(1, len(self.backends))]
+        paster = threading.Thread(target=self.paste_all, args=(jobs, paste), name="gigadiffusion-paste", daemon=True)
+        for thread in threads + [paster]:
+            thread.start()
+        self.work(0, jobs, prepare, process, interrupted)
+        for thread in threads + [paster]:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+        if len(jobs) > 0:
+            print(f"Dispatched {self.pasted} of {len(jobs)} jobs, per backend {self.taken}, {self.stolen} taken from other queues")
+        return self.processed
@@ -0,0 +1,105 @@
+import collections
+import threading
+import numpy as np
+from PIL import Image, ImageOps
+
+
+class MaskFactory():
+    # Tile masks built with NumPy and memoised by (kind, tile size, mask rect) in a bounded LRU. A pass
+    # over thousands of tiles only has a handful of distinct masks (interior tiles all share one, edge
+    # tiles add a few), so after the first tile every mask is a lookup. The gradients pasted into masks
+    # are made once per size with the same PIL resizes as before, so masks are byte for byte unchanged
+    # and tile cache keys stay valid. Masks are shared between tiles, stages and runs: never modify one.
+    def __init__(self, max_bytes) -> None:
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+        value = build()
+        size = value.nbytes if isinstance(value, np.ndarray) else value.width * value.height * len(value.getbands())
+        # Band pass masks span the whole image and are only used once, they would flush everything else.
+        if size > self.max_bytes // 4:
+            return value
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (value, size)
+                self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+        return value
+
+    @staticmethod
+    def place(size, mode, source, offset):
+        # What Image.new(mode, size, "black").paste(source, offset) gives, for an L source array.
+        width, height = size
+        pixels = np.zeros((height, width), dtype=np.uint8)
+        left, top = offset
+        x0, y0 = max(left, 0), max(top, 0)
+        x1, y1 = min(left + source.shape[1], width), min(top + source.shape[0], height)
+        if x0 < x1 and y0 < y1:
+            pixels[y0:y1, x0:x1] = source[y0 - top:y1 - top, x0 - left:x1 - left]
+        if mode == "RGB":
+            pixels = np.repeat(pixels[:, :, None], 3, axis=2)
+        return Image.fromarray(pixels, mode)
+
+    def rect(self, size, mask_rect):
+        # White mask_rect on black, ends included as ImageDraw.rectangle draws them.
+        def build():
+            pixels = np.zeros((size[1], size[0]), dtype=np.uint8)
+            pixels[max(mask_rect[1], 0):max(mask_rect[3] + 1, 0), max(mask_rect[0], 0):max(mask_rect[2] + 1, 0)] = 255
+            return Image.fromarray(pixels, "L")
+        return self.get(("rect", tuple(size), tuple(mask_rect)), build)
+
+    def gradient(self, kind, tile_size):
+        # tile_size square gradients of the half tile seams fix: row and column seams fade out towards
+        # both tiles, intersections towards the corners.
+        def build():
+            gradient = Image.linear_gradient("L")
+            if kind == "row":
+                image = Image.new("L", (tile_size, tile_size), "black")
+                image.paste(gradient.resize((tile_size, tile_size // 2), resample=Image.BICUBIC), (0, 0))
+                image.paste(gradient.rotate(180).resize((tile_size, tile_size // 2), resample=Image.BICUBIC), (0, tile_size // 2))
+            elif kind == "col":
+                image = Image.new("L", (tile_size, tile_size), "black")
+                image.paste(gradient.rotate(90).resize((tile_size // 2, tile_size), resample=Image.BICUBIC), (0, 0))
+                image.paste(gradient.rotate(270).resize((tile_size // 2, tile_size), resample=Image.BICUBIC), (tile_size // 2, 0))
+            else:
+                image = ImageOps.invert(Image.radial_gradient("L").resize((tile_size, tile_size), resample=Image.BICUBIC))
+            return np.asarray(image)
+        return self.get(("gradient", kind, tile_size), build)
+
+    def seam(self, kind, tile_size, size, offset, mode="L"):
+        # A kind ("row", "col" or "corner") gradient at offset in a black mask of size.
+        return self.get(("seam", kind, tile_size, tuple(size), tuple(offset), mode),
+                        lambda: self.place(size, mode, self.gradient(kind, tile_size), offset))
+
+    def band_gradient(self, column, length, width):
+        # Band pass gradient across a band of width pixels, length pixels long.
+        def build():
+            gradient = Image.linear_gradient("L")
+            mirror = Image.new("L", (256, 256), "black")
+            mirror.paste(gradient.resize((256, 128), resample=Image.BICUBIC), (0, 0))
+            mirror.paste(gradient.rotate(180).resize((256, 128), resample=Image.BICUBIC), (0, 128))
+            if column:
+                return np.asarray(mirror.rotate(90).resize((width, length), resample=Image.BICUBIC))
+            return np.asarray(mirror.resize((length, width), resample=Image.BICUBIC))
+        return self.get(("band gradient", column, length, width), build)
+
+    def band(self, column, length, width, size, offset):
+        return self.get(("band", column, length, width, tuple(size), tuple(offset)),
+                        lambda: self.place(size, "L", self.band_gradient(column, length, width), offset))
+
+
+# Shared by every stage and run in the process.
+shared_masks = MaskFactory(128 * 1024 * 1024)
@@ -0,0 +1,136 @@
+import contextlib
+import json
+import threading
+import time
+
+phases = ["crop", "mask", "backend", "paste"]
+
+
+def image_bytes(images):
+    return sum(image.width * image.height * len(image.getbands()) for image in images)
+
+
+class JobTimer():
+    # Lap timer for one job: each lap() books the time since the previous lap to a phase.
+    def __init__(self, metrics, stage, batch_size) -> None:
+        self.metrics = metrics
+        self.stage = stage
+        self.batch_size = batch_size
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.seconds = {}
+        self.bytes = {}
+
+    def lap(self, phase, images=None):
+        now = time.perf_counter()
+        self.seconds[phase] = self.seconds.get(phase, 0) + now - self.last
+        if images is not None:
+            self.bytes[phase] = self.bytes.get(phase, 0) + image_bytes(images)
+        self.last = now
+
+    def resume(self):
+        # Phases of one job run on different threads, resume() skips the time spent queued in between.
+        self.last = time.perf_counter()
+
+    def done(self):
+        self.metrics.job_done(self)
+
+
+class Metrics():
+    # Timings of the run: stage events (upscale, redraw, seams fix, save) and one event per job with
+    # crop / mask / backend / paste seconds, batch size and bytes of image buffers created per phase.
+    # Events stream to a JSON lines file, or totals are written as Prometheus text when the path ends
+    # in .prom. Without a path only the totals for the end-of-run summary are kept.
+    def __init__(self, path=None) -> None:
+        self.path = path
+        self.prometheus = path is not None and path.endswith(".prom")
+        self.file = None
+        self.lock = threading.Lock()
+        if path and not self.prometheus:
+            self.file = open(path, "a", encoding="utf-8")
+        self.stage_seconds = {}
+        self.phase_seconds = {}
+        self.phase_bytes = {}
+        self.jobs = {}
+        self.samples = {}
+
+    def emit(self, event):
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(event) + "\n")
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0) + seconds
+            self.emit({"type": "stage", "stage": name, "time": time.time(), "seconds": seconds})
+
+    def job(self, stage, batch_size):
+        return JobTimer(self, stage, batch_size)
+
+    def job_done(self, timer):
+        stage = timer.stage
+        self.jobs[stage] = self.jobs.get(stage, 0) + 1
+        self.samples[stage] = self.samples.get(stage, 0) + timer.batch_size
+        for phase, seconds in timer.seconds.items():
+            self.phase_seconds[(stage, phase)] = self.phase_seconds.get((stage, phase), 0) + seconds
+        for phase, size in timer.bytes.items():
+            self.phase_bytes[(stage, phase)] = self.phase_bytes.get((stage, phase), 0) + size
+        self.emit({
+            "type": "job",
+            "stage": stage,
+            "time": time.time(),
+            "batch_size": timer.batch_size,
+            "seconds": timer.last - timer.started,
+            "phases": timer.seconds,
+            "bytes": timer.bytes,
+        })
+
+    def totals(self):
+        return {
+            "stages": dict(self.stage_seconds),
+            "phases": {f"{stage}/{phase}": seconds for (stage, phase), seconds in self.phase_seconds.items()},
+            "jobs": dict(self.jobs),
+            "samples": dict(self.samples),
+        }
+
+    def summary(self):
+        backend = sum(seconds for (_, phase), seconds in self.phase_seconds.items() if phase == "backend")
+        jobs = sum(seconds for seconds in self.phase_seconds.values())
+        parts = [f"{name} {seconds:.2f}s" for name, seconds in self.stage_seconds.items()]
+        other = ", ".join(f"{phase} {sum(s for (_, ph), s in self.phase_seconds.items() if ph == phase):.2f}s" for phase in phases if phase != "backend")
+        return f"Timing: {', '.join(parts)}; jobs {jobs:.2f}s of which backend {backend:.2f}s, {other}"
+
+    def write_prometheus(self):
+        lines = [
+            "# HELP gigadiffusion_stage_seconds_total Wall time per pipeline stage.",
+            "# TYPE gigadiffusion_stage_seconds_total counter",
+        ]
+        lines += [f'gigadiffusion_stage_seconds_total{{stage="{stage}"}} {seconds}' for stage, seconds in self.stage_seconds.items()]
+        lines += [
+            "# HELP gigadiffusion_phase_seconds_total Time per job phase (crop, mask, backend, paste).",
+            "# TYPE gigadiffusion_phase_seconds_total counter",
+        ]
+        lines += [f'gigadiffusion_phase_seconds_total{{stage="{stage}",phase="{phase}"}} {seconds}' for (stage, phase), seconds in self.phase_seconds.items()]
+        lines += [
+            "# HELP gigadiffusion_phase_bytes_total Bytes of image buffers created per job phase.",
+            "# TYPE gigadiffusion_phase_bytes_total counter",
+        ]
+        lines += [f'gigadiffusion_phase_bytes_total{{stage="{stage}",phase="{phase}"}} {size}' for (stage, phase), size in self.phase_bytes.items()]
+        lines += ["# TYPE gigadiffusion_jobs_total counter"]
+        lines += [f'gigadiffusion_jobs_total{{stage="{stage}"}} {count}' for stage, count in self.jobs.items()]
+        lines += ["# TYPE gigadiffusion_samples_total counter"]
+        lines += [f'gigadiffusion_samples_total{{stage="{stage}"}} {count}' for stage, count in self.samples.items()]
+        with open(self.path, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.prometheus:
+            self.write_prometheus()
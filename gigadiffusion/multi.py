@@ -0,0 +1,213 @@
+import copy
+import json
+import os
+import threading
+from gigadiffusion.backends import ProcessedTiles, TileInpaintBackend
+from gigadiffusion.pipeline import run, tile_cache_settings
+
+
+class BatchRequest():
+    def __init__(self, p, masks, key) -> None:
+        self.p = p
+        self.masks = list(masks)
+        self.key = key
+        self.result = None
+        self.error = None
+        self.done = False
+
+
+class SharedBatchBackend(TileInpaintBackend):
+    # What one image's pipeline sees in a multi-image run: process() hands the batch to the
+    # coordinator and waits for its share of a merged batch, everything else goes to the real backend.
+    def __init__(self, coordinator) -> None:
+        self.coordinator = coordinator
+        self.upscaler_name = coordinator.backend.upscaler_name
+        # Pipelines upscale at the same time, the coordinator serializes upscalers that need it.
+        self.upscale_thread_safe = coordinator.backend.upscale_thread_safe
+        self.job_count = 0
+
+    def process(self, p, masks):
+        return self.coordinator.submit(p, masks)
+
+    def upscale(self, image, scale):
+        return self.coordinator.upscale(image, scale)
+
+    def model_hash(self):
+        return self.coordinator.backend.model_hash()
+
+    def interrupt(self):
+        self.coordinator.backend.interrupt()
+
+    def interrupted(self) -> bool:
+        return self.coordinator.backend.interrupted()
+
+    def begin(self):
+        pass
+
+    def end(self):
+        pass
+
+    def set_job_count(self, job_count):
+        self.coordinator.add_jobs(job_count - self.job_count)
+        self.job_count = job_count
+
+    def save_image(self, image, p, seed, info):
+        return self.coordinator.backend.save_image(image, p, seed, info)
+
+
+class BatchCoordinator():
+    # Runs the pipelines of several images on threads and merges their process() calls into shared
+    # batches on the calling thread (webui's processing must run there). Requests with the same tile
+    # size and settings are packed up to batch_size samples; a partly filled batch is only sent once
+    # every running pipeline is waiting on one, so small images top up each other's batches.
+    def __init__(self, backend, batch_size, images_at_once=4) -> None:
+        self.backend = backend
+        self.batch_size = max(1, batch_size)
+        self.images_at_once = max(1, images_at_once)
+        self.lock = threading.Condition()
+        self.upscale_lock = threading.Lock()
+        self.pending = []
+        self.running = 0
+        self.jobs = 0
+        self.calls = 0
+        self.samples = 0
+
+    def batch_key(self, p):
+        # Everything a batch shares: the processing size and settings, and the size of the tiles.
+        settings = tile_cache_settings(self.backend, p, None, None)
+        settings["tile"] = p.init_images[0].size if len(p.init_images) > 0 else None
+        return json.dumps(settings, sort_keys=True, default=str)
+
+    def submit(self, p, masks):
+        request = BatchRequest(p, masks, self.batch_key(p))
+        with self.lock:
+            self.pending.append(request)
+            self.lock.notify_all()
+            while not request.done:
+                self.lock.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def upscale(self, image, scale):
+        if self.backend.upscale_thread_safe:
+            return self.backend.upscale(image, scale)
+        with self.upscale_lock:
+            return self.backend.upscale(image, scale)
+
+    def add_jobs(self, count):
+        with self.lock:
+            self.jobs += count
+            self.backend.set_job_count(self.jobs)
+
+    def take_batch(self):
+        # Caller holds the lock. Every pipeline has at most one request pending, so pending == running
+        # means nothing else can join a batch before one is sent.
+        if len(self.pending) == 0:
+            return None
+        groups = {}
+        for request in self.pending:
+            groups.setdefault(request.key, []).append(request)
+        everyone_waiting = len(self.pending) >= self.running
+        for group in groups.values():
+            if sum(len(request.masks) for request in group) >= self.batch_size or everyone_waiting:
+                batch = [group[0]]
+                for request in group[1:]:
+                    if sum(len(taken.masks) for taken in batch) + len(request.masks) > self.batch_size:
+                        break
+                    batch.append(request)
+                for request in batch:
+                    self.pending.remove(request)
+                return batch
+        return None
+
+    def process_batch(self, batch):
+        merged = copy.copy(batch[0].p)
+        merged.init_images = [image for request in batch for image in request.p.init_images]
+        merged.seed = [seed for request in batch for seed in request.p.seed]
+        merged.subseed = [subseed for request in batch for subseed in request.p.subseed]
+        merged.batch_size = len(merged.init_images)
+        masks = [mask for request in batch for mask in request.masks]
+        error = None
+        try:
+            processed = self.backend.process(merged, masks)
+        except BaseException as e:
+            error = e
+        self.calls += 1
+        self.samples += len(masks)
+        with self.lock:
+            offset = 0
+            for request in batch:
+                count = len(request.masks)
+                if error is None:
+                    images = processed.images[offset:offset + count]
+                    infotexts = [processed.infotext(merged, offset + index) for index in range(count)]
+                    request.result = ProcessedTiles(images, infotexts)
+                request.error = error
+                request.done = True
+                offset += count
+            self.lock.notify_all()
+        if error is not None and not isinstance(error, Exception):
+            raise error
+
+    def run(self, pipelines):
+        # pipelines are functions that each run one image and return its result, started at most
+        # images_at_once at a time. Returns their results in order.
+        results = [None] * len(pipelines)
+        errors = []
+        queued = list(range(len(pipelines)))
+
+        def run_pipeline(index):
+            try:
+                results[index] = pipelines[index]()
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.lock.notify_all()
+
+        self.backend.begin()
+        try:
+            while True:
+                with self.lock:
+                    while len(queued) > 0 and self.running < self.images_at_once and len(errors) == 0 and not self.backend.interrupted():
+                        self.running += 1
+                        threading.Thread(target=run_pipeline, args=(queued.pop(0),), name="gigadiffusion-image", daemon=True).start()
+                    if self.running == 0 and len(self.pending) == 0:
+                        break
+                    batch = self.take_batch()
+                    if batch is None:
+                        self.lock.wait()
+                        continue
+                self.process_batch(batch)
+        finally:
+            self.backend.end()
+        if self.calls > 0:
+            print(f"Shared batches: {self.samples} tiles in {self.calls} backend calls, {self.samples / self.calls:.2f} of {self.batch_size} per batch")
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+
+def run_many(backend, items, images_at_once=4, **kwargs):
+    # Like run() for several images at once, packing tiles of different images into shared batches.
+    # items are (p, image) or (p, image, overrides) with run() keyword arguments for that image only;
+    # image may be a function returning it, so queued images are only loaded when their turn comes.
+    # Every p should use the same tile and processing settings, or their tiles are batched separately.
+    # Batches hold up to the smallest p.batch_size, which every image's batches are known to fit.
+    # Images running at once can't share a metrics file, image i writes to <metrics_path stem>-<i>.
+    # Returns the upscaler of every image, None for images not started after an interrupt.
+    items = [item if len(item) == 3 else (item[0], item[1], {}) for item in items]
+    if kwargs.get("metrics_path"):
+        root, ext = os.path.splitext(kwargs["metrics_path"])
+        items = [(p, image, {"metrics_path": f"{root}-{index:05}{ext}", **overrides}) for index, (p, image, overrides) in enumerate(items)]
+    coordinator = BatchCoordinator(backend, min([p.batch_size for p, _, _ in items], default=1), images_at_once)
+
+    def pipeline(p, image, overrides):
+        def run_image():
+            source = image() if callable(image) else image
+            return run(SharedBatchBackend(coordinator), p, source, **{**kwargs, **overrides})
+        return run_image
+
+    return coordinator.run([pipeline(p, image, overrides) for p, image, overrides in items])
@@ -0,0 +1,1444 @@
+import collections
+import copy
+import hashlib
+import itertools
+import math
+import os
+import threading
+import time
+from enum import Enum
+from PIL import Image
+from gigadiffusion.backends import ProcessedTiles
+from gigadiffusion.cache import TileCache
+from gigadiffusion.canvas import DiskCanvas
+from gigadiffusion.checkpoint import CheckpointJournal
+from gigadiffusion.detail import DetailFilter, low_detail_tiles, seam_scores, tile_detail_scores, visible_seams
+from gigadiffusion.dispatch import TileDispatcher
+from gigadiffusion.masks import shared_masks
+from gigadiffusion.metrics import Metrics
+from gigadiffusion.planner import load_cost_model, plan_factors
+from gigadiffusion.prefetch import JobPrefetcher
+from gigadiffusion.pyramid import DeepZoomWriter
+from gigadiffusion.quadtree import TileLayout
+from gigadiffusion.seamgraph import SeamGraph
+from gigadiffusion.seeds import derive_seed
+from gigadiffusion.tileplan import TilePlan
+from gigadiffusion.upscale import TiledUpscaler
+from gigadiffusion.wavefront import WavefrontScheduler
+
+class RectCalculator:
+    @staticmethod
+    def prefer_double_draw():
+        # Set true to inset the last tile in rows/cols such that it sees as much of the original image as possible.
+        # This also causes 2x the redraws in certain areas of the image, adjacent to seams, which is distracting. 
+        return True
+        
+    @staticmethod
+    def calc_row_seam_in_tile(tile_size, padding, width, height, xi, yi, cols, rows):
+        mask = RectCalculator.calc_tile(tile_size, padding, width, height, xi, yi, cols, rows) 
+        y_shift = math.floor(tile_size // 2)
+        return (mask[0], mask[1] + y_shift, mask[2], mask[3] + y_shift)
+    
+    @staticmethod
+    def calc_col_seam_in_tile(tile_size, padding, width, height, xi, yi, cols, rows):
+        mask = RectCalculator.calc_tile(tile_size, padding, width, height, xi, yi, cols, rows) 
+        x_shift = math.floor(tile_size // 2)
+        return (mask[0] + x_shift, mask[1], mask[2] + x_shift, mask[3])
+
+    @staticmethod
+    def calc_intersection_in_tile(tile_size, width, height, xi, yi):
+        # A tile_size square centred on the corner shared by tiles (xi, yi) and (xi + 1, yi + 1),
+        # shifted back inside the canvas when the last row/col is narrower than half a tile.
+        start_x = (xi + 1) * tile_size - tile_size // 2
+        start_y = (yi + 1) * tile_size - tile_size // 2
+        left = max(min(start_x, width - tile_size), 0)
+        top = max(min(start_y, height - tile_size), 0)
+        tile = (left, top, left + tile_size, top + tile_size)
+        mask = (start_x - left, start_y - top, start_x - left + tile_size, start_y - top + tile_size)
+        return tile, mask
+
+    @staticmethod
+    def calc_block_in_tile(tile_size, padding, width, height, xi, yi, size):
+        # A block of size x size grid cells with half the padding around it, cut at the canvas edge.
+        left = xi * tile_size
+        top = yi * tile_size
+        right = min((xi + size) * tile_size, width)
+        bottom = min((yi + size) * tile_size, height)
+        tile = (max(left - padding // 2, 0), max(top - padding // 2, 0), min(right + padding // 2, width), min(bottom + padding // 2, height))
+        mask = (left - tile[0], top - tile[1], right - tile[0], bottom - tile[1])
+        return tile, mask
+
+    @staticmethod
+    def calc_region_cells(tile_size, rows, cols, region):
+        # Grid cells (xi, yi) whose area touches region, a (left, top, right, bottom) canvas rect or a
+        # canvas-sized mask image where anything not black is dirty.
+        if isinstance(region, Image.Image):
+            mask = region.convert("L")
+            bbox = mask.getbbox()
+            if bbox is None:
+                return set()
+            cells = RectCalculator.calc_region_cells(tile_size, rows, cols, bbox)
+            return {(xi, yi) for xi, yi in cells
+                    if mask.crop((xi * tile_size, yi * tile_size, (xi + 1) * tile_size, (yi + 1) * tile_size)).getbbox() is not None}
+        left, top, right, bottom = region
+        return {(xi, yi)
+                for yi in range(max(top // tile_size, 0), min(math.ceil(bottom / tile_size), rows))
+                for xi in range(max(left // tile_size, 0), min(math.ceil(right / tile_size), cols))}
+
+    @staticmethod
+    def calc_mask_in_tile(tile_size, padding, width, height, xi, yi, cols, rows):
+        start_x = 0
+        end_x = 0
+        if xi == 0:
+            start_x = 0
+            end_x = tile_size
+        elif xi == (cols - 1) and RectCalculator.prefer_double_draw():
+            mask_width = (width - (xi * tile_size))
+            tile_mask_width_difference = tile_size - mask_width
+            start_x = padding + tile_mask_width_difference
+            end_x = start_x + mask_width
+        else:
+            start_x = padding / 2
+            end_x = start_x + tile_size
+        
+        start_y = 0
+        end_y = 0
+        if yi == 0:
+            start_y = 0
+            end_y = tile_size
+        elif yi == (rows - 1) and RectCalculator.prefer_double_draw():
+            mask_height = (height - (yi * tile_size))
+            tile_mask_height_difference = tile_size - mask_height
+            start_y = padding + tile_mask_height_difference
+            end_y = start_y + mask_height
+        else:
+            start_y = padding // 2
+            end_y = start_y + tile_size
+        rect = math.floor(start_x), math.floor(start_y), math.floor(end_x), math.floor(end_y)
+        return rect
+
+    @staticmethod
+    def calc_tile(tile_size, padding, width, height, xi, yi, cols, rows):
+        start_x = 0
+        end_x = 0
+        if xi == 0:
+            start_x = 0
+            end_x = tile_size + padding
+        elif xi == (cols - 1) and RectCalculator.prefer_double_draw():
+            end_x = width
+            start_x = end_x - tile_size - padding
+        else:
+            start_x = tile_size * xi - (padding // 2)
+            end_x = start_x + padding + tile_size
+        
+        start_y = 0
+        end_y = 0
+        if yi == 0:
+            start_y = 0
+            end_y = tile_size + padding
+        elif yi == (rows - 1) and RectCalculator.prefer_double_draw():
+            end_y = height
+            start_y = end_y - tile_size - padding
+        else:
+            start_y = tile_size * yi - (padding // 2)
+            end_y = start_y + padding + tile_size
+        rect = math.floor(start_x), math.floor(start_y), math.floor(end_x), math.floor(end_y)
+        return rect
+
+
+class USDUJob():
+    __slots__ = ("mask_rects", "tile_rects", "stages", "denoise_scale")
+
+    def __init__(self) -> None:
+        self.mask_rects = []
+        self.tile_rects = []
+        # Stage of every tile when a job mixes passes, None uses the pass's own.
+        self.stages = []
+        self.denoise_scale = 1
+    def add(self, tile_rect, mask_rect, stage=None) -> bool:
+        # Every sample in a batch must share the output size, masks may differ per sample.
+        if len(self.tile_rects) > 0:
+            last_tile_rect = self.tile_rects[0]
+            width = tile_rect[2] - tile_rect[0]
+            last_width = last_tile_rect[2] - last_tile_rect[0]
+            height = tile_rect[3] - tile_rect[1]
+            last_height = last_tile_rect[3] - last_tile_rect[1]
+            if width != last_width or height != last_height:
+                return False
+        self.tile_rects.append(tile_rect)
+        self.mask_rects.append(mask_rect)
+        self.stages.append(stage)
+        return True
+
+    @staticmethod
+    def pack_filtered(tiles, flat, requested_batch_size, detail):
+        # Tiles flagged flat are dropped, or packed into their own jobs that run at a lower denoise.
+        if detail.worst_case and not detail.skip:
+            flat = USDUJob.worst_split(tiles, requested_batch_size)
+        jobs = USDUJob.pack([tile for tile, is_flat in zip(tiles, flat) if not is_flat], requested_batch_size)
+        if not detail.skip:
+            jobs += USDUJob.pack([tile for tile, is_flat in zip(tiles, flat) if is_flat], requested_batch_size, detail.denoise_scale)
+        return jobs
+
+    @staticmethod
+    def worst_split(tiles, requested_batch_size):
+        # Packed apart, k flat tiles of a size group of n cost at most one batch more than n together, and
+        # k = 1 costs it whenever the remainder n % batch size isn't 1. One tile of such groups is flagged.
+        counts = collections.Counter((tile[0][2] - tile[0][0], tile[0][3] - tile[0][1]) for tile in tiles)
+        split = {size for size, count in counts.items() if requested_batch_size > 1 and count > 1 and count % requested_batch_size != 1}
+        flat = []
+        for tile in tiles:
+            size = (tile[0][2] - tile[0][0], tile[0][3] - tile[0][1])
+            flat.append(size in split)
+            split.discard(size)
+        return flat
+
+    @staticmethod
+    def pack(tiles, requested_batch_size, denoise_scale=1):
+        # Group one pass worth of (tile_rect, mask_rect[, stage]) tiles by output size only, then fill batches.
+        # A group shares its size, so batches are filled by slicing without add()'s per-tile check.
+        groups = {}
+        for tile in tiles:
+            tile_rect = tile[0]
+            size = (tile_rect[2] - tile_rect[0], tile_rect[3] - tile_rect[1])
+            groups.setdefault(size, []).append(tile)
+        jobs = []
+        for group in groups.values():
+            for start in range(0, len(group), requested_batch_size):
+                batch = group[start:start + requested_batch_size]
+                job = USDUJob()
+                job.denoise_scale = denoise_scale
+                job.tile_rects = [tile[0] for tile in batch]
+                job.mask_rects = [tile[1] for tile in batch]
+                job.stages = [tile[2] if len(tile) > 2 else None for tile in batch]
+                jobs.append(job)
+        return jobs
+
+def tile_cache_settings(backend, p, seed, subseed):
+    # Everything besides the tile pixels and mask that decides what a tile comes back as.
+    return {
+        "prompt": p.prompt,
+        "negative_prompt": getattr(p, "negative_prompt", ""),
+        "model": backend.model_hash(),
+        "sampler": getattr(p, "sampler_name", None),
+        "steps": p.steps,
+        "cfg_scale": getattr(p, "cfg_scale", None),
+        "denoising_strength": p.denoising_strength,
+        "seed": seed,
+        "subseed": subseed,
+        "subseed_strength": getattr(p, "subseed_strength", 0),
+        "width": p.width,
+        "height": p.height,
+        "mask_blur": p.mask_blur,
+        "inpaint_full_res": p.inpaint_full_res,
+        "inpaint_full_res_padding": p.inpaint_full_res_padding,
+        "inpainting_fill": getattr(p, "inpainting_fill", None),
+    }
+
+def process_images_per_mask(backend, p, masks, cache=None):
+    # Serve what we can from the tile cache and only send the misses to the backend, as a smaller batch.
+    # p.seed and p.subseed hold one seed per sample.
+    if cache is None:
+        return backend.process(p, masks)
+    init_images = list(p.init_images)
+    seeds = list(p.seed)
+    subseeds = list(p.subseed)
+    keys = [TileCache.key(init_images[index], masks[index], tile_cache_settings(backend, p, seeds[index], subseeds[index])) for index in range(len(init_images))]
+    cached = [cache.get(key) for key in keys]
+    images = [entry[0] if entry is not None else None for entry in cached]
+    infotexts = [entry[1] if entry is not None else None for entry in cached]
+    misses = [index for index in range(len(init_images)) if cached[index] is None]
+    if len(misses) > 0:
+        p.init_images = [init_images[index] for index in misses]
+        p.seed = [seeds[index] for index in misses]
+        p.subseed = [subseeds[index] for index in misses]
+        p.batch_size = len(misses)
+        processed = backend.process(p, [masks[index] for index in misses])
+        for batch_index in range(min(len(misses), len(processed.images))):
+            index = misses[batch_index]
+            images[index] = processed.images[batch_index]
+            infotexts[index] = processed.infotext(p, batch_index)
+            cache.put(keys[index], images[index], infotexts[index])
+        p.init_images = init_images
+        p.seed = seeds
+        p.subseed = subseeds
+        p.batch_size = len(init_images)
+    return ProcessedTiles(images, infotexts)
+
+def process_jobs(owner, p, image, jobs, stage, create_mask):
+    # Crop, mask, process and paste the batched jobs of one pass through owner.prefetcher, which
+    # prepares the next jobs and pastes finished ones while the backend works on the current batch.
+    # Tile seeds are derived from the stage name, create_mask(job, index) builds one tile's mask.
+    def prepare(job):
+        timer = owner.metrics.job(stage, len(job.tile_rects))
+        init_images = [image.crop(tile_rect) for tile_rect in job.tile_rects]
+        timer.lap("crop", init_images)
+        masks = [create_mask(job, index) for index in range(len(job.tile_rects))]
+        timer.lap("mask", masks)
+        stages = [tile_stage or stage for tile_stage in job.stages]
+        seeds = [derive_seed(owner.seed, tile_stage, tile_rect) for tile_stage, tile_rect in zip(stages, job.tile_rects)]
+        subseeds = [derive_seed(owner.seed, f"{tile_stage} subseed", tile_rect) for tile_stage, tile_rect in zip(stages, job.tile_rects)]
+        return timer, init_images, masks, seeds, subseeds
+
+    def process(job, prepared, backend=None):
+        # A dispatcher may hand the job to another backend, which gets its own copy of p.
+        backend = backend or owner.backend
+        target = p if backend is owner.backend else copy.copy(p)
+        timer, init_images, masks, seeds, subseeds = prepared
+        timer.resume()
+        target.init_images = init_images
+        target.seed = seeds
+        target.subseed = subseeds
+        target.batch_size = len(init_images)
+        target.denoising_strength = owner.denoise * job.denoise_scale
+        processed = process_images_per_mask(backend, target, masks, owner.cache)
+        timer.lap("backend", processed.images)
+        return processed
+
+    def paste(job, prepared, processed):
+        timer, _, _, seeds, subseeds = prepared
+        timer.resume()
+        for index in range(min(len(processed.images), len(job.tile_rects))):
+            image.paste(processed.images[index], job.tile_rects[index])
+        timer.lap("paste")
+        owner.job_done(seeds, subseeds)
+        timer.done()
+
+    processed = owner.prefetcher.run(jobs, prepare, process, paste, owner.backend.interrupted)
+    # Flat tiles may have run at a lower denoise, the stage reports its own.
+    p.denoising_strength = owner.denoise
+    return processed
+
+class USDUMode(Enum):
+    LINEAR = 0
+    CHESS = 1
+    NONE = 2
+
+class USDUSFMode(Enum):
+    NONE = 0
+    BAND_PASS = 1
+    HALF_TILE = 2
+    HALF_TILE_PLUS_INTERSECTIONS = 3
+
+class USDUFlatMode(Enum):
+    REDRAW = 0
+    SKIP = 1
+    LOWER_DENOISE = 2
+
+class USDUpscaler():
+
+    def __init__(self, p, image, backend, save_redraw, save_seams_fix, tile_size) -> None:
+        self.p = p
+        self.image:Image = image
+        self.scale_factor = max(p.width, p.height) // max(image.width, image.height)
+        self.backend = backend
+        self.redraw = USDURedraw()
+        self.redraw.backend = backend
+        self.redraw.save = save_redraw
+        self.redraw.tile_size = tile_size
+        self.seams_fix = USDUSeamsFix()
+        self.seams_fix.backend = backend
+        self.seams_fix.save = save_seams_fix
+        self.seams_fix.tile_size = tile_size
+        self.initial_info = None
+        self.rows = math.ceil(self.p.height / tile_size)
+        self.cols = math.ceil(self.p.width / tile_size)
+        self.requested_batch_size = p.batch_size
+        self.disk_canvas = False
+        self.stream_output = False
+        self.writer = None
+        self.journal = None
+        self.resume = False
+        self.cache = None
+        self.upscale_tile_size = 256
+        self.upscale_overlap = 16
+        self.upscale_cache = None
+        self.metrics = Metrics()
+        self.redraw.metrics = self.metrics
+        self.seams_fix.metrics = self.metrics
+        self.flat_mode = USDUFlatMode.REDRAW
+        self.detail_threshold = 2.0
+        self.flat_denoise_scale = 0.5
+        self.quadtree_levels = 0
+        self.seam_threshold = 0
+        # Grid cells to re-render in region mode, None renders the whole image.
+        self.region = None
+        self.wavefront = False
+        self.redraw.layout = TileLayout(self.rows, self.cols)
+        self.seams_fix.layout = self.redraw.layout
+        # Per-tile seeds are derived from the run seed, p.seed itself becomes a per-sample list.
+        self.seed = p.seed
+        self.redraw.seed = self.seed
+        self.seams_fix.seed = self.seed
+
+    def upscale(self):
+        # Log info
+        print(f"Canvas size: {self.p.width}x{self.p.height}")
+        print(f"Image size: {self.image.width}x{self.image.height}")
+        print(f"Scale factor: {self.scale_factor}")
+        with self.metrics.stage("upscale"):
+            if self.resume_checkpoint():
+                return
+            canvas = self.create_canvas()
+            if self.region is not None:
+                # Region mode starts from the previous output, which is already at the target size.
+                for top in range(0, self.image.height, 1024):
+                    canvas.paste(self.image.crop((0, top, self.image.width, min(top + 1024, self.image.height))), (0, top))
+            else:
+                lock = None if self.backend.upscale_thread_safe else threading.Lock()
+                cost_model = load_cost_model(self.upscale_cache.path if self.upscale_cache is not None else None)
+                upscaler = TiledUpscaler(self.backend.upscale, None, self.upscale_tile_size, self.upscale_overlap, lock=lock,
+                                         cache=self.upscale_cache, cost_model=cost_model, upscaler_name=self.backend.upscaler_name)
+                # Check upscaler is not empty
+                if self.backend.upscaler_name != "None":
+                    upscaler.scales = plan_factors(cost_model, self.backend.upscaler_name, self.image.size, (self.p.width, self.p.height),
+                                                   cached=lambda chain: upscaler.is_cached(self.image, chain))
+                # Upscale over all factors and resize to the set values tile by tile, straight into the canvas
+                upscaler.run(self.image, canvas)
+                cost_model.save()
+            self.image = canvas
+            flat = self.analyze_detail()
+            if self.journal is not None:
+                self.journal.start(self.checkpoint_plan(), {"flat_tiles": sorted([xi, yi] for xi, yi in flat)})
+            self.attach_writer()
+
+    def setup_canvas(self, disk_canvas, stream_output=False):
+        # Streaming output listens to canvas pastes, so it always runs on the disk-backed canvas.
+        self.disk_canvas = disk_canvas or stream_output
+        self.stream_output = stream_output
+
+    def setup_cache(self, path, max_megabytes):
+        if not path:
+            return
+        self.cache = TileCache(path, max_megabytes * 1024 * 1024)
+        self.redraw.cache = self.cache
+        self.seams_fix.cache = self.cache
+
+    def setup_prefetch(self, depth):
+        # How many jobs ahead crops and masks are prepared while the backend runs, 0 runs serially.
+        self.redraw.prefetcher = JobPrefetcher(depth)
+        self.seams_fix.prefetcher = JobPrefetcher(depth)
+
+    def setup_dispatch(self, workers):
+        # Extra backends (other GPUs or hosts) that share the redraw and seams fix passes with this one.
+        # Linear redraw and band pass seams stay serial on this backend.
+        if not workers:
+            return
+        backends = [self.backend] + list(workers)
+        print(f"Dispatching tiles to {len(backends)} backends")
+        self.redraw.prefetcher = TileDispatcher(backends)
+        self.seams_fix.prefetcher = TileDispatcher(backends)
+
+    def setup_metrics(self, path):
+        # Timings are always collected for the summary, a path also exports them.
+        if not path:
+            return
+        self.metrics = Metrics(path)
+        self.redraw.metrics = self.metrics
+        self.seams_fix.metrics = self.metrics
+
+    def setup_detail(self, flat_mode, threshold, denoise_scale):
+        # Tiles whose upscaled content is nearly flat (sky, walls, backgrounds) gain little from a
+        # redraw; they can be skipped or redrawn at denoise * denoise_scale.
+        self.flat_mode = USDUFlatMode(flat_mode)
+        self.detail_threshold = threshold
+        self.flat_denoise_scale = denoise_scale
+
+    def setup_quadtree(self, levels):
+        # Flat areas are redrawn as blocks of up to 2 ** levels x 2 ** levels tiles, scaled down to the model.
+        self.quadtree_levels = levels
+
+    def analyze_detail(self):
+        if self.flat_mode == USDUFlatMode.REDRAW and self.quadtree_levels == 0:
+            return set()
+        scores = tile_detail_scores(self.image, self.redraw.tile_size, self.rows, self.cols)
+        flat = low_detail_tiles(scores, self.detail_threshold)
+        self.set_flat_tiles(flat)
+        return flat
+
+    def set_flat_tiles(self, flat):
+        layout = TileLayout(self.rows, self.cols, flat, self.quadtree_levels)
+        self.redraw.layout = layout
+        self.seams_fix.layout = layout
+        if self.quadtree_levels > 0:
+            print(f"Quadtree: {len(layout.leaves)} redraw tiles in {layout.passes()} passes instead of {self.rows * self.cols}")
+        if self.flat_mode == USDUFlatMode.REDRAW:
+            return
+        detail = DetailFilter(flat, self.flat_mode == USDUFlatMode.SKIP, self.flat_denoise_scale)
+        self.redraw.detail = detail
+        self.seams_fix.detail = detail
+        action = "skipped" if detail.skip else f"redrawn at {self.flat_denoise_scale}x denoise"
+        print(f"Detail: {len(detail.flat)} of {self.rows * self.cols} tiles are flat and will be {action}")
+
+    def setup_seam_detection(self, threshold):
+        # Half tile seams fix only the boundaries that still show after the redraw, 0 fixes them all.
+        self.seam_threshold = threshold
+
+    def setup_wavefront(self, enabled):
+        # Run the chess redraw and half tile seams fix as one wavefront instead of pass after pass.
+        self.wavefront = enabled
+
+    def setup_seam_coloring(self, enabled):
+        # Run the half tile seams fix as the colours of its overlap graph instead of rows, then columns.
+        self.seams_fix.coloring = enabled
+
+    def setup_region(self, region):
+        # Re-render only where region touches a finished image: the tiles over it are redrawn, then the
+        # seams and intersections around them are fixed, and everything else keeps its pixels.
+        if region is None:
+            return
+        if isinstance(region, Image.Image) and region.size != (self.p.width, self.p.height):
+            region = region.resize((self.p.width, self.p.height), resample=Image.NEAREST)
+        cells = RectCalculator.calc_region_cells(self.redraw.tile_size, self.rows, self.cols, region)
+        self.region = cells
+        self.redraw.region = cells
+        self.seams_fix.visible_rows = {(xi, yi) for yi in range(self.rows - 1) for xi in range(self.cols)
+                                       if (xi, yi) in cells or (xi, yi + 1) in cells}
+        self.seams_fix.visible_cols = {(xi, yi) for yi in range(self.rows) for xi in range(self.cols - 1)
+                                       if (xi, yi) in cells or (xi + 1, yi) in cells}
+        print(f"Region: re-rendering {len(cells)} of {self.rows * self.cols} tiles")
+
+    def select_seams(self):
+        if self.seam_threshold <= 0 or self.seams_fix.mode not in [USDUSFMode.HALF_TILE, USDUSFMode.HALF_TILE_PLUS_INTERSECTIONS]:
+            return
+        # The selection is measured once on the finished redraw, a resumed seams fix reuses it.
+        analysis = self.journal.analysis if self.journal is not None else {}
+        if "visible_seams" in analysis:
+            rows = {(xi, yi) for xi, yi in analysis["visible_seams"]["rows"]}
+            cols = {(xi, yi) for xi, yi in analysis["visible_seams"]["cols"]}
+        else:
+            with self.metrics.stage("seam detection"):
+                row_scores, col_scores = seam_scores(self.image, self.redraw.tile_size, self.rows, self.cols, band=max(2, self.p.mask_blur))
+            rows, cols = visible_seams(row_scores, col_scores, self.seam_threshold)
+            analysis["visible_seams"] = {"rows": sorted([xi, yi] for xi, yi in rows), "cols": sorted([xi, yi] for xi, yi in cols)}
+        if self.region is not None:
+            rows &= self.seams_fix.visible_rows
+            cols &= self.seams_fix.visible_cols
+        self.seams_fix.visible_rows = rows
+        self.seams_fix.visible_cols = cols
+        total_rows, total_cols, total_corners = [self.seams_fix.count_tiles(stage) for stage in ["row seam", "column seam", "intersection"]]
+        self.calc_jobs_count()
+        kept_rows, kept_cols, kept_corners = [self.seams_fix.count_tiles(stage) for stage in ["row seam", "column seam", "intersection"]]
+        print(f"Seam detection: fixing {kept_rows} of {total_rows} row seams, {kept_cols} of {total_cols} column seams"
+              f" and {kept_corners} of {total_corners} intersections above {self.seam_threshold}, the rest are not visible")
+
+    def setup_upscale_cache(self, path, max_megabytes):
+        # Model outputs per source tile, shared between renders of the same source at any size.
+        if not path:
+            return
+        self.upscale_cache = TileCache(path, max_megabytes * 1024 * 1024)
+
+    def setup_checkpoint(self, path, every, resume):
+        # Checkpoints keep the partially painted canvas in the checkpoint directory.
+        if not path:
+            return
+        self.journal = CheckpointJournal(path, every)
+        self.resume = resume
+        self.disk_canvas = True
+        self.source_hash = hashlib.sha256(self.image.tobytes()).hexdigest()
+
+    def checkpoint_plan(self):
+        return {
+            "source": self.source_hash,
+            "width": self.p.width,
+            "height": self.p.height,
+            "upscaler": self.backend.upscaler_name,
+            "tile_size": self.redraw.tile_size,
+            "batch_size": self.requested_batch_size,
+            "denoising_strength": self.p.denoising_strength,
+            "redraw_mode": self.redraw.mode.name,
+            "redraw_padding": self.redraw.padding,
+            "redraw_mask_blur": self.p.mask_blur,
+            "seams_fix_mode": self.seams_fix.mode.name,
+            "seams_fix_padding": self.seams_fix.padding,
+            "seams_fix_denoise": self.seams_fix.denoise,
+            "seams_fix_mask_blur": self.seams_fix.mask_blur,
+            "seams_fix_width": self.seams_fix.width,
+            "seams_fix_coloring": self.seams_fix.coloring,
+            "flat_tiles": self.flat_mode.name,
+            "detail_threshold": self.detail_threshold,
+            "flat_denoise_scale": self.flat_denoise_scale,
+            "quadtree_levels": self.quadtree_levels,
+            "seam_threshold": self.seam_threshold,
+            "region": sorted([xi, yi] for xi, yi in self.region) if self.region is not None else None,
+        }
+
+    def resume_checkpoint(self) -> bool:
+        if self.journal is None or not self.resume:
+            return False
+        if not self.journal.exists():
+            print(f"No checkpoint to resume in {self.journal.path}, starting over")
+            return False
+        self.journal.load()
+        if self.journal.complete or not self.journal.matches(self.checkpoint_plan()):
+            print(f"Checkpoint in {self.journal.path} is finished or was made with other settings, starting over")
+            return False
+        self.image = self.journal.open_canvas()
+        self.set_flat_tiles({(xi, yi) for xi, yi in self.journal.analysis.get("flat_tiles", [])})
+        self.redraw.completed_jobs = self.journal.completed("redraw")
+        self.seams_fix.completed_jobs = self.journal.completed("seams_fix")
+        print(f"Resuming from {self.journal.path}: {self.redraw.completed_jobs} redraw and {self.seams_fix.completed_jobs} seams fix jobs already done")
+        self.attach_writer()
+        return True
+
+    def create_canvas(self):
+        # Redraw and seams fix only crop and paste tile rects, so they can work on a memory-mapped
+        # canvas and keep just the tiles in flight in RAM.
+        if self.journal is not None:
+            return self.journal.create_canvas(self.p.width, self.p.height)
+        if self.disk_canvas:
+            print(f"Creating {self.p.width}x{self.p.height} canvas on disk")
+            return DiskCanvas.create_temp(self.p.width, self.p.height)
+        return Image.new("RGB", (self.p.width, self.p.height))
+
+    def attach_writer(self):
+        if self.stream_output and self.writer is None:
+            os.makedirs(self.p.outpath_samples, exist_ok=True)
+            path = os.path.join(self.p.outpath_samples, f"gigadiffusion-{self.seed}-{time.strftime('%Y%m%d-%H%M%S')}")
+            print(f"Streaming Deep Zoom output to {path}.dzi")
+            self.writer = DeepZoomWriter(self.image, path)
+            self.image.listeners.append(self.writer.update)
+
+    def result_image(self, copy):
+        if isinstance(self.image, DiskCanvas):
+            return self.image.preview()
+        return self.image.copy() if copy else self.image
+
+    def release_canvas(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.journal is not None:
+            if self.backend.interrupted():
+                self.journal.checkpoint()
+                print(f"Interrupted, resume from checkpoint {self.journal.path} to continue")
+            else:
+                self.journal.finish()
+        if isinstance(self.image, DiskCanvas):
+            self.image.close()
+
+    def setup_redraw(self, redraw_mode, padding, mask_blur):
+        self.redraw.upscaler = self
+        self.redraw.mode = USDUMode(redraw_mode)
+        self.redraw.enabled = self.redraw.mode != USDUMode.NONE
+        self.redraw.padding = padding
+        self.redraw.denoise = self.p.denoising_strength
+        self.p.mask_blur = mask_blur
+
+    def setup_seams_fix(self, padding, denoise, mask_blur, width, mode):
+        self.seams_fix.padding = padding
+        self.seams_fix.denoise = denoise
+        self.seams_fix.mask_blur = mask_blur
+        self.seams_fix.width = width
+        self.seams_fix.mode = USDUSFMode(mode)
+        self.seams_fix.enabled = self.seams_fix.mode != USDUSFMode.NONE
+
+    def save_image(self, suffix=""):
+        with self.metrics.stage("save"):
+            if self.writer is not None:
+                # Tiles were written as they were pasted, only the remaining zoom levels are left to build.
+                self.writer.flush(write_missing=True)
+                path = self.writer.path
+                if suffix:
+                    # Later passes keep streaming into the pyramid, so this result gets a copy of its own.
+                    path += suffix
+                    self.writer.snapshot(path)
+                if self.initial_info is not None:
+                    with open(path + ".txt", "w", encoding="utf-8") as file:
+                        file.write(self.initial_info)
+                print(f"Saved Deep Zoom image {path}.dzi")
+                return
+            if isinstance(self.image, DiskCanvas):
+                # Too large to load for the backend's saver, the canvas is written as PNG strip by strip.
+                os.makedirs(self.p.outpath_samples, exist_ok=True)
+                path = os.path.join(self.p.outpath_samples, f"gigadiffusion-{self.seed}-{time.strftime('%Y%m%d-%H%M%S')}{suffix}.png")
+                self.image.save_png(path, self.initial_info)
+                print(f"Saved {path}")
+                return
+            self.backend.save_image(self.image, self.p, self.seed, self.initial_info)
+
+    def calc_jobs_count(self):
+        redraw_job_count = self.redraw.calc_jobs_count(self.image.width, self.image.height, self.rows, self.cols, self.requested_batch_size)
+        seams_job_count = self.seams_fix.calc_jobs_count(self.image.width, self.image.height, self.rows, self.cols, self.requested_batch_size)
+        redraw_job_count -= self.redraw.completed_jobs
+        seams_job_count -= self.seams_fix.completed_jobs
+        redraw_step_count = expected_steps(self.p.steps, self.p.denoising_strength)
+        seams_step_count = expected_steps(self.p.steps, self.seams_fix.denoise)
+        print("expecting", redraw_step_count, "redraw steps &", seams_step_count, "seams steps")
+        self.backend.set_job_count(redraw_job_count + math.ceil(seams_step_count / redraw_step_count * seams_job_count))
+
+    def plan_calls(self):
+        # Every backend call the redraw and seams fix will make, per stage, as (samples, denoise,
+        # processing size, cropped pixels), built from the same job lists the passes run.
+        width, height = self.p.width, self.p.height
+        if self.flat_mode == USDUFlatMode.LOWER_DENOISE:
+            # Flat tiles are only found once the image is upscaled, and they can't share a batch with
+            # the others. Every pass is planned with the split that costs the most calls.
+            detail = DetailFilter(skip=False, denoise_scale=self.flat_denoise_scale, worst_case=True)
+            self.redraw.detail = detail
+            self.seams_fix.detail = detail
+        if self.wavefront_ready():
+            # Both passes share the wavefront's batches, they are planned as one stage.
+            self.redraw.chess_process_create_jobs(width, height, self.rows, self.cols, self.requested_batch_size)
+            self.seams_fix.calc_jobs_count(width, height, self.rows, self.cols, self.requested_batch_size)
+            return {"wavefront": [(sum(len(group.indexes) for group in batch), batch[0].key[1], batch[0].stage_pass["settings"][:2],
+                                   sum(rect_pixels(rect) for group in batch for rect in group.rects))
+                                  for batch in self.create_wavefront().batches()]}
+        stages = {}
+        if self.redraw.enabled:
+            redraw = self.redraw
+            size = math.ceil((redraw.tile_size + redraw.padding) / 64) * 64
+            if redraw.mode == USDUMode.LINEAR:
+                stages["redraw"] = [(1, redraw.denoise * (redraw.detail.denoise_scale if flat else 1), (size, size),
+                                     rect_pixels(redraw.calc_leaf(width, height, self.rows, self.cols, leaf)[0]))
+                                    for leaf, flat in redraw.linear_tiles()]
+            else:
+                redraw.chess_process_create_jobs(width, height, self.rows, self.cols, self.requested_batch_size)
+                stages["redraw"] = [job_call(job, redraw.denoise, (size, size)) for job in redraw.jobs]
+        if self.seams_fix.enabled:
+            seams = self.seams_fix
+            if seams.mode == USDUSFMode.BAND_PASS:
+                size = seams.width + seams.padding * 2
+                stages["seams_fix"] = [(1, seams.denoise, (size, rect[3] - rect[1]) if column else (rect[2] - rect[0], size),
+                                        rect_pixels(seams.calc_band_rect(width, height, rect)))
+                                       for column, rect in seams.band_rects(width, height, self.rows, self.cols)]
+            else:
+                seams.calc_jobs_count(width, height, self.rows, self.cols, self.requested_batch_size)
+                stages["seams_fix"] = [job_call(job, seams.denoise, (seams.tile_size, seams.tile_size)) for job in seams.all_jobs()]
+        return stages
+
+    def plan_memory(self, stages):
+        # Rough peak host memory in bytes: the source, the canvas unless it lives on disk, the copy of
+        # the redrawn canvas kept in result_images during the seams fix, and whatever is in flight at
+        # once: tiles on the upscale threads, or crops, masks and results of the prepared and running jobs.
+        canvas = 0 if self.disk_canvas else self.p.width * self.p.height * 3
+        redraw_copy = canvas if self.redraw.enabled and self.seams_fix.enabled and "wavefront" not in stages else 0
+        ratio = math.ceil(max(self.p.width / self.image.width, self.p.height / self.image.height))
+        upscale_tiles = ((self.upscale_tile_size + 2 * self.upscale_overlap) * ratio) ** 2 * 3 * (2 * (os.cpu_count() or 1) + 1)
+        if self.region is not None:
+            upscale_tiles = 0
+        in_flight = getattr(self.redraw.prefetcher, "depth", 0) + 2
+        jobs = {name: max([call[3] for call in calls], default=0) * 9 * in_flight for name, calls in stages.items()}
+        memory = {
+            "source": self.image.width * self.image.height * 3,
+            "canvas": canvas,
+            "redraw_copy": redraw_copy,
+            "upscale_tiles": upscale_tiles,
+            "redraw_jobs": jobs.get("redraw", 0),
+            "seams_fix_jobs": jobs.get("seams_fix", 0),
+            "wavefront_jobs": jobs.get("wavefront", 0),
+        }
+        working = max(upscale_tiles, memory["redraw_jobs"], redraw_copy + memory["seams_fix_jobs"], memory["wavefront_jobs"])
+        return memory["source"] + canvas + working, memory
+
+    def plan(self):
+        # What a run with these settings costs, without upscaling or calling the backend. Flat tiles and
+        # invisible seams are only known once the image is upscaled and redrawn, so with those filters
+        # on every tile and seam is counted and the plan is an upper bound.
+        stages = self.plan_calls()
+        peak, memory = self.plan_memory(stages)
+        summaries = {name: summarize_calls(calls, self.requested_batch_size, self.p.steps) for name, calls in stages.items()}
+        return {
+            "source": list(self.image.size),
+            "canvas": [self.p.width, self.p.height],
+            "grid": [self.rows, self.cols],
+            "tile_size": self.redraw.tile_size,
+            "padding": self.redraw.padding,
+            "batch_size": self.requested_batch_size,
+            "stages": summaries,
+            "total": summarize_calls([call for calls in stages.values() for call in calls], self.requested_batch_size, self.p.steps),
+            "peak_memory_bytes": peak,
+            "memory": memory,
+            "upper_bound": self.flat_mode != USDUFlatMode.REDRAW or self.quadtree_levels > 0 or self.seam_threshold > 0,
+        }
+
+    def print_info(self):
+        print(f"Tiles amount: {self.rows * self.cols}")
+        print(f"Grid: {self.rows}x{self.cols}")
+        print(f"Redraw enabled: {self.redraw.enabled}")
+        print(f"Seams fix mode: {self.seams_fix.mode.name}")
+
+    def add_extra_info(self):
+        self.p.extra_generation_params["Gigadiffusion upscaler"] = self.backend.upscaler_name
+        self.p.extra_generation_params["Gigadiffusion redraw tile_size"] = self.redraw.tile_size
+        self.p.extra_generation_params["Gigadiffusion redraw mask_blur"] = self.p.mask_blur
+        self.p.extra_generation_params["Gigadiffusion redraw padding"] = self.redraw.padding
+
+    def process(self):
+        self.backend.begin()
+        self.calc_jobs_count()
+        self.result_images = []
+        if self.wavefront_ready():
+            with self.metrics.stage("wavefront"):
+                self.process_wavefront()
+        else:
+            self.process_passes()
+        if self.cache is not None:
+            print(f"Tile cache: {self.cache.hits} tiles served from {self.cache.path}, {self.cache.misses} processed")
+        print(self.metrics.summary())
+        self.metrics.close()
+        self.release_canvas()
+
+    def process_passes(self):
+        # Redraw, then seams fix, each pass run to completion before the next one.
+        if self.journal is not None:
+            self.redraw.journal = self.journal
+            self.seams_fix.journal = self.journal
+            if self.redraw.enabled:
+                self.journal.begin_stage("redraw", self.redraw.job_rects(self.image.width, self.image.height, self.rows, self.cols))
+        if self.redraw.enabled and not (self.journal is not None and self.journal.stage_complete("redraw")):
+            with self.metrics.stage("redraw"):
+                self.image = self.redraw.start(self.p, self.image, self.rows, self.cols)
+            self.initial_info = self.redraw.initial_info
+            self.result_images.append(self.result_image(copy=True))
+            if self.redraw.save:
+                self.save_image("-redraw" if self.seams_fix.enabled else "")
+            if self.journal is not None and not self.backend.interrupted():
+                self.journal.finish_stage("redraw")
+        if self.backend.interrupted():
+            if self.seams_fix.enabled:
+                print("interrupted before seams fix, won't save image")
+            self.backend.end()
+        elif self.seams_fix.enabled:
+            self.select_seams()
+            if self.journal is not None:
+                self.journal.begin_stage("seams_fix", self.seams_fix.job_rects(self.image.width, self.image.height, self.rows, self.cols))
+            with self.metrics.stage("seams_fix"):
+                self.image = self.seams_fix.start(self.p, self.image, self.rows, self.cols)
+            self.initial_info = self.seams_fix.initial_info
+            if self.journal is not None and not self.backend.interrupted():
+                self.journal.finish_stage("seams_fix")
+            self.result_images.append(self.result_image(copy=False))
+            if self.seams_fix.save:
+                self.save_image()
+            self.backend.end()
+
+    def wavefront_ready(self) -> bool:
+        if not self.wavefront:
+            return False
+        reason = None
+        if self.redraw.mode != USDUMode.CHESS or self.seams_fix.mode not in [USDUSFMode.HALF_TILE, USDUSFMode.HALF_TILE_PLUS_INTERSECTIONS]:
+            reason = "it needs the chess redraw and a half tile seams fix"
+        elif self.seams_fix.coloring:
+            reason = "seam coloring orders the seams fix itself"
+        elif self.journal is not None:
+            reason = "checkpoints resume pass by pass"
+        elif self.seam_threshold > 0:
+            reason = "seam detection measures the finished redraw"
+        elif isinstance(self.redraw.prefetcher, TileDispatcher):
+            reason = "it runs on a single backend"
+        if reason is not None:
+            print(f"Wavefront: off, {reason}")
+            return False
+        return True
+
+    def create_wavefront(self):
+        # The scheduler over the redraw and seams fix jobs, for the run and for its plan.
+        redraw = self.redraw
+        seams = self.seams_fix
+        redraw_size = math.ceil((redraw.tile_size + redraw.padding) / 64) * 64
+        scheduler = WavefrontScheduler(self.requested_batch_size, redraw.tile_size,
+                                       lambda p, masks: process_images_per_mask(self.backend, p, masks, self.cache),
+                                       lambda: self.backend.interrupted(), self.metrics)
+        scheduler.add_pass(redraw, "redraw", redraw.jobs, redraw.create_mask, (redraw_size, redraw_size, redraw.padding, self.p.mask_blur))
+        scheduler.add_pass(seams, "row seam", seams.row_jobs, seams.create_row_mask, (seams.tile_size, seams.tile_size, seams.padding, seams.mask_blur))
+        scheduler.add_pass(seams, "column seam", seams.col_jobs, seams.create_col_mask, (seams.tile_size, seams.tile_size, seams.padding, seams.mask_blur))
+        if seams.mode == USDUSFMode.HALF_TILE_PLUS_INTERSECTIONS:
+            scheduler.add_pass(seams, "intersection", seams.corner_jobs, seams.create_corner_mask, (seams.tile_size, seams.tile_size, 0, seams.mask_blur))
+        return scheduler
+
+    def process_wavefront(self):
+        # Redraw and seams fix as one dependency graph, see WavefrontScheduler. There is no separate
+        # redraw image to keep or save.
+        redraw = self.redraw
+        seams = self.seams_fix
+        processed = self.create_wavefront().run(self.p, self.image)
+        self.p.width = self.image.width
+        self.p.height = self.image.height
+        self.p.denoising_strength = redraw.denoise
+        if processed is not None:
+            self.initial_info = processed.infotext(self.p, 0)
+        if self.backend.interrupted():
+            print("interrupted during wavefront, won't save image")
+            self.backend.end()
+            return
+        self.result_images.append(self.result_image(copy=False))
+        if seams.save:
+            self.save_image()
+        self.backend.end()
+
+class USDURedraw():
+
+    def __init__(self) -> None:
+        self.journal = None
+        self.cache = None
+        self.metrics = Metrics()
+        self.prefetcher = JobPrefetcher()
+        self.masks = shared_masks
+        # TilePlan of the last grid the stage planned.
+        self.tiles = None
+        self.detail = DetailFilter()
+        # Grid cells of the region to redraw, None redraws every tile.
+        self.region = None
+        self.completed_jobs = 0
+
+    def job_done(self, seeds, subseeds):
+        if self.journal is not None:
+            self.journal.job_done("redraw", seeds[0], seeds, subseeds)
+
+    def in_region(self, leaf) -> bool:
+        return self.region is None or any(cell in self.region for cell in self.layout.cells(leaf))
+
+    def job_rects(self, width, height, rows, cols):
+        if self.mode == USDUMode.LINEAR:
+            return [[self.calc_leaf(width, height, rows, cols, leaf)[0]] for leaf, _ in self.linear_tiles()]
+        return [job.tile_rects for job in self.jobs]
+
+    def init_processing(self, p):
+        p.inpaint_full_res = True
+        p.inpaint_full_res_padding = self.padding
+        p.width = math.ceil((self.tile_size+self.padding) / 64) * 64
+        p.height = math.ceil((self.tile_size+self.padding) / 64) * 64
+
+    def linear_tiles(self):
+        # (leaf, flat) of every tile the linear pass redraws, in order.
+        tiles = []
+        for leaf in self.layout.leaves:
+            flat = self.detail.is_flat(*self.layout.cells(leaf))
+            if (flat and self.detail.skip) or not self.in_region(leaf):
+                continue
+            tiles.append((leaf, flat))
+        return tiles
+
+    def linear_process(self, p, image, rows, cols):
+        processed = None
+        for leaf, flat in self.linear_tiles()[self.completed_jobs:]:
+            if self.backend.interrupted():
+                break              
+            tile_rect, mask_rect = self.calc_leaf(image.width, image.height, rows, cols, leaf)
+            timer = self.metrics.job("redraw", 1)
+            cropped = image.crop(tile_rect)              
+            timer.lap("crop", [cropped])
+            self.init_processing(p)
+            mask = self.masks.rect(cropped.size, mask_rect)
+            timer.lap("mask", [mask])
+            p.init_images = [cropped]
+            p.seed = [derive_seed(self.seed, "redraw", tile_rect)]
+            p.subseed = [derive_seed(self.seed, "redraw subseed", tile_rect)]
+            p.batch_size = 1
+            p.denoising_strength = self.denoise * (self.detail.denoise_scale if flat else 1)
+            processed = process_images_per_mask(self.backend, p, [mask], self.cache)
+            timer.lap("backend", processed.images)
+            if (len(processed.images) > 0):
+                image.paste(processed.images[0], tile_rect)
+            timer.lap("paste")
+            self.job_done(p.seed, p.subseed)
+            timer.done()
+
+        p.denoising_strength = self.denoise
+        p.width = image.width
+        p.height = image.height
+        if processed is not None:
+            self.initial_info = processed.infotext(p, 0)
+
+        return image
+    
+    def tile_plan(self, width, height, rows, cols):
+        key = (self.tile_size, self.padding, width, height, rows, cols, RectCalculator.prefer_double_draw())
+        if self.tiles is None or self.tiles.key != key:
+            self.tiles = TilePlan(*key)
+        return self.tiles
+
+    def calc_mask_in_tile(self, xi, yi, width, height, cols, rows):
+        return self.tile_plan(width, height, rows, cols).mask(xi, yi)
+
+    def calc_tile(self, width, height, rows, cols, xi, yi):
+        return self.tile_plan(width, height, rows, cols).tile(xi, yi)
+
+    def calc_leaf(self, width, height, rows, cols, leaf):
+        # (tile_rect, mask_rect) of a layout leaf, single cells keep the grid tiles.
+        xi, yi, size = leaf
+        if size == 1:
+            plan = self.tile_plan(width, height, rows, cols)
+            return plan.tiles[yi][xi], plan.masks[yi][xi]
+        return RectCalculator.calc_block_in_tile(self.tile_size, self.padding, width, height, xi, yi, size)
+
+    def calc_jobs_count(self, width, height, rows, cols, requested_batch_size):
+        if self.enabled != True:
+            return 0
+        if self.mode == USDUMode.LINEAR:
+            return len(self.linear_tiles())
+        if self.mode == USDUMode.CHESS:
+            self.chess_process_create_jobs(width, height, rows, cols, requested_batch_size)
+            return len(self.jobs)
+
+    def chess_process_create_jobs(self, width, height, rows, cols, requested_batch_size):
+        # Checkerboard passes (two on the plain grid); tiles of one pass never share an edge, so they can
+        # be batched together.
+        passes = [[] for _ in range(self.layout.passes())]
+        flats = [[] for _ in range(self.layout.passes())]
+        for leaf, color in zip(self.layout.leaves, self.layout.colors):
+            if not self.in_region(leaf):
+                continue
+            passes[color].append(self.calc_leaf(width, height, rows, cols, leaf))
+            flats[color].append(self.detail.is_flat(*self.layout.cells(leaf)))
+        jobs = []
+        for index in range(len(passes)):
+            jobs += USDUJob.pack_filtered(passes[index], flats[index], requested_batch_size, self.detail)
+        self.jobs = jobs
+        print(len(self.jobs), "redraw chess jobs with max batch size", requested_batch_size)
+
+    def create_mask(self, job, index):
+        tile_rect = job.tile_rects[index]
+        return self.masks.rect((tile_rect[2] - tile_rect[0], tile_rect[3] - tile_rect[1]), job.mask_rects[index])
+
+    def chess_process(self, p, image):
+        self.init_processing(p)
+        processed = process_jobs(self, p, image, self.jobs[self.completed_jobs:], "redraw", self.create_mask)
+        p.width = image.width
+        p.height = image.height
+        if processed is not None:
+            self.initial_info = processed.infotext(p, 0)
+
+        return image
+    
+    def start(self, p, image, rows, cols):
+        self.initial_info = None
+        if self.mode == USDUMode.LINEAR:
+            return self.linear_process(p, image, rows, cols)
+        if self.mode == USDUMode.CHESS:
+            return self.chess_process(p, image)
+
+class USDUSeamsFix():
+
+    def __init__(self) -> None:
+        self.journal = None
+        self.cache = None
+        self.metrics = Metrics()
+        self.prefetcher = JobPrefetcher()
+        self.masks = shared_masks
+        # TilePlan of the last grid the stage planned.
+        self.tiles = None
+        self.detail = DetailFilter()
+        # Row and column seams (xi, yi) left to fix, None fixes every seam.
+        self.visible_rows = None
+        self.visible_cols = None
+        self.completed_jobs = 0
+        self.coloring = False
+        self.row_jobs = []
+        self.col_jobs = []
+        self.corner_jobs = []
+        # Row, column and intersection tiles regrouped by color_jobs(), which empties the lists above.
+        self.colored_jobs = []
+
+    def job_done(self, seeds, subseeds):
+        if self.journal is not None:
+            self.journal.job_done("seams_fix", seeds[0], seeds, subseeds)
+
+    def job_rects(self, width, height, rows, cols):
+        if self.mode == USDUSFMode.BAND_PASS:
+            return [[rect] for _, rect in self.band_rects(width, height, rows, cols)]
+        return [job.tile_rects for job in self.all_jobs()]
+
+    def all_jobs(self):
+        return self.row_jobs + self.col_jobs + self.corner_jobs + self.colored_jobs
+
+    def count_tiles(self, stage):
+        return sum(tile_stage == stage for job in self.all_jobs() for tile_stage in job.stages)
+
+    def band_rects(self, width, height, rows, cols):
+        # (column, gradient rect) of every band the band pass runs, columns first. A band runs along each
+        # stretch of consecutive seams to fix, the whole image when every seam is.
+        bands = []
+        for xi in range(1, cols):
+            x = xi * self.tile_size - self.padding
+            for start, end in self.seam_runs(rows, lambda yi: self.visible_cols is None or (xi - 1, yi) in self.visible_cols):
+                bands.append((True, (x, start * self.tile_size, x + self.width, min(end * self.tile_size, height))))
+        for yi in range(1, rows):
+            y = yi * self.tile_size - self.padding
+            for start, end in self.seam_runs(cols, lambda xi: self.visible_rows is None or (xi, yi - 1) in self.visible_rows):
+                bands.append((False, (start * self.tile_size, y, min(end * self.tile_size, width), y + self.width)))
+        return bands
+
+    @staticmethod
+    def seam_runs(count, visible):
+        # (start, end) of every run of consecutive indexes below count whose seam is visible.
+        runs = []
+        for index in range(count):
+            if not visible(index):
+                continue
+            if len(runs) > 0 and runs[-1][1] == index:
+                runs[-1] = (runs[-1][0], index + 1)
+            else:
+                runs.append((index, index + 1))
+        return runs
+
+    def skip_completed_jobs(self):
+        # Jobs run rows, then columns, then intersections (or by color); drop the ones a resumed checkpoint already did.
+        skip = self.completed_jobs
+        for jobs in [self.row_jobs, self.col_jobs, self.corner_jobs, self.colored_jobs]:
+            done = min(skip, len(jobs))
+            del jobs[:done]
+            skip -= done
+
+    def init_draw(self, p):
+        self.initial_info = None
+        p.width = math.ceil((self.tile_size+self.padding) / 64) * 64
+        p.height = math.ceil((self.tile_size+self.padding) / 64) * 64
+
+    def calc_jobs_count(self, width, height, rows, cols, requested_batch_size):
+        if self.enabled != True:
+            return 0;
+        seams_job_count = 0
+        if self.mode == USDUSFMode.BAND_PASS:
+            return len(self.band_rects(width, height, rows, cols))
+        self.create_jobs(width, height, rows, cols, requested_batch_size)   
+        self.corner_jobs = []
+        if self.mode == USDUSFMode.HALF_TILE_PLUS_INTERSECTIONS:
+            self.create_corner_jobs(width, height, rows, cols, requested_batch_size)
+        self.colored_jobs = []
+        if self.coloring:
+            self.color_jobs(requested_batch_size)
+        seams_job_count = len(self.all_jobs())
+        return seams_job_count
+
+    def create_jobs(self, width, height, rows, cols, requested_batch_size):
+        # A seam between two flat tiles is flat too. Cells merged into one quadtree block have no seam.
+        plan = self.tile_plan(width, height, rows, cols)
+        row_passes = [[], []]
+        row_flats = [[], []]
+        for yi in range(rows - 1):
+            for xi in range(cols):
+                if self.layout.same_leaf((xi, yi), (xi, yi + 1)) or not self.seam_visible(self.visible_rows, xi, yi):
+                    continue
+                row_passes[(xi + yi) % 2].append((plan.row_seams[yi][xi], plan.masks[yi][xi], "row seam"))
+                row_flats[(xi + yi) % 2].append(self.detail.is_flat((xi, yi), (xi, yi + 1)))
+        print("processing", len(row_passes[0]) + len(row_passes[1]), "row seams")
+        self.row_jobs = []
+        for index in range(2):
+            self.row_jobs += USDUJob.pack_filtered(row_passes[index], row_flats[index], requested_batch_size, self.detail)
+
+        col_passes = [[], []]
+        col_flats = [[], []]
+        for yi in range(rows):
+            for xi in range(cols - 1):
+                if self.layout.same_leaf((xi, yi), (xi + 1, yi)) or not self.seam_visible(self.visible_cols, xi, yi):
+                    continue
+                col_passes[(xi + yi) % 2].append((plan.col_seams[yi][xi], plan.masks[yi][xi], "column seam"))
+                col_flats[(xi + yi) % 2].append(self.detail.is_flat((xi, yi), (xi + 1, yi)))
+        print("processing", len(col_passes[0]) + len(col_passes[1]), "column seams")
+        self.col_jobs = []
+        for index in range(2):
+            self.col_jobs += USDUJob.pack_filtered(col_passes[index], col_flats[index], requested_batch_size, self.detail)
+        print(len(self.col_jobs) + len(self.row_jobs), "seams fix jobs with max batch size", requested_batch_size)
+
+    def create_corner_jobs(self, width, height, rows, cols, requested_batch_size):
+        plan = self.tile_plan(width, height, rows, cols)
+        corner_passes = [[], []]
+        corner_flats = [[], []]
+        for yi in range(rows - 1):
+            for xi in range(cols - 1):
+                if not self.layout.junction(xi, yi) or not self.corner_visible(xi, yi):
+                    continue
+                corner_passes[(xi + yi) % 2].append((plan.intersections[yi][xi], plan.intersection_masks[yi][xi], "intersection"))
+                corner_flats[(xi + yi) % 2].append(self.detail.is_flat((xi, yi), (xi + 1, yi), (xi, yi + 1), (xi + 1, yi + 1)))
+        print("processing", len(corner_passes[0]) + len(corner_passes[1]), "intersections")
+        self.corner_jobs = []
+        for index in range(2):
+            self.corner_jobs += USDUJob.pack_filtered(corner_passes[index], corner_flats[index], requested_batch_size, self.detail)
+        print(len(self.corner_jobs), "intersection jobs with max batch size", requested_batch_size)
+
+    def color_jobs(self, requested_batch_size):
+        # Repacks the row seams, column seams and intersections into batches of patches that don't
+        # overlap, taken colour by colour from their overlap graph, so a batch mixes orientations and the
+        # leftovers of one colour fill the batches of the others. Intersections run without padding, so
+        # they only share batches with seams when the seams have none either, and still run after the
+        # seams they overlap. The checkerboard jobs are kept when packing doesn't need fewer batches.
+        if self.detail.worst_case:
+            # A run keeps the checkerboard or something smaller, so its worst case bounds the plan.
+            return
+        tiles = [(tile_rect, mask_rect, stage, job.denoise_scale) for job in self.row_jobs + self.col_jobs + self.corner_jobs
+                 for tile_rect, mask_rect, stage in zip(job.tile_rects, job.mask_rects, job.stages)]
+        if len(tiles) == 0:
+            return
+        graph = SeamGraph([tile[0] for tile in tiles], self.tile_size)
+        # Samples of a batch share their size, denoise and inpaint padding.
+        groups = [(tile_rect[2] - tile_rect[0], tile_rect[3] - tile_rect[1], denoise_scale, 0 if stage == "intersection" else self.padding)
+                  for tile_rect, _, stage, denoise_scale in tiles]
+        jobs = []
+        for batch in graph.batches(requested_batch_size, groups, [tile[2] == "intersection" for tile in tiles]):
+            job = USDUJob()
+            for index in batch:
+                job.add(*tiles[index][:3])
+            job.denoise_scale = tiles[batch[0]][3]
+            jobs.append(job)
+        checkerboard = len(self.row_jobs) + len(self.col_jobs) + len(self.corner_jobs)
+        print(f"Seam coloring: {len(tiles)} patches in {graph.passes()} colors, {len(jobs)} jobs against {checkerboard} checkerboard jobs with max batch size {requested_batch_size}")
+        if len(jobs) >= checkerboard:
+            return
+        self.row_jobs = []
+        self.col_jobs = []
+        self.corner_jobs = []
+        self.colored_jobs = jobs
+
+    @staticmethod
+    def seam_visible(visible, xi, yi) -> bool:
+        return visible is None or (xi, yi) in visible
+
+    def corner_visible(self, xi, yi) -> bool:
+        # An intersection is fixed when any of the four seams meeting there is.
+        return (self.seam_visible(self.visible_rows, xi, yi) or self.seam_visible(self.visible_rows, xi + 1, yi)
+                or self.seam_visible(self.visible_cols, xi, yi) or self.seam_visible(self.visible_cols, xi, yi + 1))
+
+    def tile_plan(self, width, height, rows, cols):
+        key = (self.tile_size, self.padding, width, height, rows, cols, RectCalculator.prefer_double_draw())
+        if self.tiles is None or self.tiles.key != key:
+            self.tiles = TilePlan(*key)
+        return self.tiles
+
+    def calc_mask_in_tile(self, xi, yi,width, height,  cols, rows):
+        return self.tile_plan(width, height, rows, cols).mask(xi, yi)
+
+    def calc_row_gradient_tile(self, rows, cols, width, height, xi, yi):
+        return self.tile_plan(width, height, rows, cols).row_seam(xi, yi)
+
+    def calc_col_gradient_tile(self, rows, cols, width, height, xi, yi):
+        return self.tile_plan(width, height, rows, cols).col_seam(xi, yi)
+       
+    def calc_intersection_tile(self, width, height, rows, cols, xi, yi):
+        return self.tile_plan(width, height, rows, cols).intersection(xi, yi)
+
+    def create_row_mask(self, job, index):
+        tile_rect = job.tile_rects[index]
+        return self.masks.seam("row", self.tile_size, (tile_rect[2] - tile_rect[0], tile_rect[3] - tile_rect[1]), job.mask_rects[index][:2], "RGB")
+
+    def create_col_mask(self, job, index):
+        tile_rect = job.tile_rects[index]
+        return self.masks.seam("col", self.tile_size, (tile_rect[2] - tile_rect[0], tile_rect[3] - tile_rect[1]), job.mask_rects[index][:2], "RGB")
+
+    def create_corner_mask(self, job, index):
+        return self.masks.seam("corner", self.tile_size, (self.tile_size, self.tile_size), job.mask_rects[index][:2])
+
+    def create_seam_mask(self, job, index):
+        create_mask = {"row seam": self.create_row_mask, "column seam": self.create_col_mask, "intersection": self.create_corner_mask}
+        return create_mask[job.stages[index]](job, index)
+
+    def colored_process(self, p, image):
+        self.init_draw(p)
+        processed = None
+
+        p.denoising_strength = self.denoise
+        p.mask_blur = self.mask_blur
+
+        p.width = self.tile_size
+        p.height = self.tile_size
+        p.inpaint_full_res = True
+        p.inpaint_full_res_padding = self.padding
+
+        # Runs of seam jobs and of intersection jobs, in order, each with its own inpaint padding.
+        for corners, jobs in itertools.groupby(self.colored_jobs, lambda job: job.stages[0] == "intersection"):
+            if self.backend.interrupted():
+                break
+            p.inpaint_full_res_padding = 0 if corners else self.padding
+            processed = process_jobs(self, p, image, list(jobs), "intersection" if corners else "seams", self.create_seam_mask) or processed
+
+        p.width = image.width
+        p.height = image.height
+        if processed is not None:
+            self.initial_info = processed.infotext(p, 0)
+        return image
+
+    def half_tile_process(self, p, image, rows, cols):
+        self.init_draw(p)
+        processed = None
+
+        p.denoising_strength = self.denoise
+        p.mask_blur = self.mask_blur
+
+        p.width = self.tile_size
+        p.height = self.tile_size
+        p.inpaint_full_res = True
+        p.inpaint_full_res_padding = self.padding
+
+        processed = process_jobs(self, p, image, self.row_jobs, "row seam", self.create_row_mask)
+        if not self.backend.interrupted():
+            processed = process_jobs(self, p, image, self.col_jobs, "column seam", self.create_col_mask) or processed
+
+        p.width = image.width
+        p.height = image.height
+        if processed is not None:
+            self.initial_info = processed.infotext(p, 0)
+        return image
+
+    def half_tile_process_corners(self, p, image, rows, cols):
+        fixed_image = self.half_tile_process(p, image, rows, cols)
+        processed = None
+        self.init_draw(p)
+        p.denoising_strength = self.denoise
+        p.mask_blur = self.mask_blur
+
+        p.width = self.tile_size
+        p.height = self.tile_size
+        p.inpaint_full_res = True
+        p.inpaint_full_res_padding = 0
+
+        if not self.backend.interrupted():
+            processed = process_jobs(self, p, fixed_image, self.corner_jobs, "intersection", self.create_corner_mask)
+
+        p.width = fixed_image.width
+        p.height = fixed_image.height
+        if processed is not None:
+            self.initial_info = processed.infotext(p, 0)
+
+        return fixed_image
+
+    def band_pass_process(self, p, image, cols, rows):
+        self.init_draw(p)
+        processed = None
+
+        p.denoising_strength = self.denoise
+        p.mask_blur = 0
+
+        for column, gradient_rect in self.band_rects(image.width, image.height, rows, cols)[self.completed_jobs:]:
+            if self.backend.interrupted():
+                    break
+            p.width = self.width + self.padding * 2 if column else gradient_rect[2] - gradient_rect[0]
+            p.height = gradient_rect[3] - gradient_rect[1] if column else self.width + self.padding * 2
+            p.inpaint_full_res = True
+            p.inpaint_full_res_padding = self.padding
+            processed = self.band_pass_seam(p, image, column, gradient_rect)
+            self.job_done(p.seed, p.subseed)
+
+        p.width = image.width
+        p.height = image.height
+        if processed is not None:
+            self.initial_info = processed.infotext(p, 0)
+
+        return image
+
+    def calc_band_rect(self, width, height, gradient_rect):
+        # Crop only the seam band plus enough context for inpaint_full_res to find the same crop region
+        # (mask bounds + padding, expanded to the processing aspect ratio) it would find on the full canvas.
+        margin = self.padding + self.width
+        left = max(gradient_rect[0] - margin, 0)
+        top = max(gradient_rect[1] - margin, 0)
+        right = min(gradient_rect[2] + margin, width)
+        bottom = min(gradient_rect[3] + margin, height)
+        return left, top, right, bottom
+
+    def band_pass_seam(self, p, image, column, gradient_rect):
+        band_rect = self.calc_band_rect(image.width, image.height, gradient_rect)
+        timer = self.metrics.job("band pass", 1)
+        length = gradient_rect[3] - gradient_rect[1] if column else gradient_rect[2] - gradient_rect[0]
+        mask = self.masks.band(column, length, self.width, (band_rect[2] - band_rect[0], band_rect[3] - band_rect[1]),
+                               (gradient_rect[0] - band_rect[0], gradient_rect[1] - band_rect[1]))
+        timer.lap("mask", [mask])
+        p.init_images = [image.crop(band_rect)]
+        timer.lap("crop", p.init_images)
+        p.seed = [derive_seed(self.seed, "band pass", gradient_rect)]
+        p.subseed = [derive_seed(self.seed, "band pass subseed", gradient_rect)]
+        p.batch_size = 1
+        processed = process_images_per_mask(self.backend, p, [mask], self.cache)
+        timer.lap("backend", processed.images)
+        if (len(processed.images) > 0):
+            image.paste(processed.images[0], band_rect)
+        timer.lap("paste")
+        timer.done()
+        return processed
+
+    def start(self, p, image, rows, cols):
+        self.skip_completed_jobs()
+        if USDUSFMode(self.mode) == USDUSFMode.BAND_PASS:
+            return self.band_pass_process(p, image, cols, rows)
+        elif len(self.colored_jobs) > 0:
+            return self.colored_process(p, image)
+        elif USDUSFMode(self.mode) == USDUSFMode.HALF_TILE:
+            return self.half_tile_process(p, image, rows, cols)
+        elif USDUSFMode(self.mode) == USDUSFMode.HALF_TILE_PLUS_INTERSECTIONS:
+            return self.half_tile_process_corners(p, image, rows, cols)
+        else:
+            return image
+
+def expected_steps(steps, denoise):
+    # Sampler steps img2img runs at this denoise.
+    return math.ceil((denoise + 0.001) * steps)
+
+def rect_pixels(rect):
+    return (rect[2] - rect[0]) * (rect[3] - rect[1])
+
+def job_call(job, denoise, size):
+    return (len(job.tile_rects), denoise * job.denoise_scale, size, sum(rect_pixels(rect) for rect in job.tile_rects))
+
+def summarize_calls(calls, batch_size, steps):
+    # A batch runs its sampler steps once for all of its samples.
+    samples = sum(call[0] for call in calls)
+    return {
+        "backend_calls": len(calls),
+        "samples": samples,
+        "batch_fill": samples / (len(calls) * batch_size) if len(calls) > 0 else 0,
+        "diffused_pixels": sum(count * size[0] * size[1] for count, _, size, _ in calls),
+        "sampler_steps": sum(expected_steps(steps, denoise) for _, denoise, _, _ in calls),
+    }
+
+def calc_target_size(width, height, scale):
+    # Same rounding as the webui "Scale from image size" option.
+    return math.ceil((width * scale) / 64) * 64, math.ceil((height * scale) / 64) * 64
+
+def run(backend, p, image, tile_size=512, padding=128, redraw_mode=USDUMode.CHESS.value, redraw_blur=0,
+        seams_fix_type=USDUSFMode.HALF_TILE.value, seams_fix_width=64, seams_fix_denoise=0.45, seams_fix_padding=128,
+        seams_blur=0, save_redraw=True, save_seams_fix=True, disk_canvas=False, stream_output=False,
+        checkpoint_dir="", checkpoint_every=8, resume=False, cache_dir="", cache_size=4096, metrics_path="", prefetch=2, upscale_cache_dir="",
+        flat_tiles=USDUFlatMode.REDRAW.value, detail_threshold=2.0, flat_denoise_scale=0.5, quadtree_levels=0,
+        seam_threshold=0, workers=(), region=None, wavefront=False, seam_coloring=False):
+    # Upscale image to p.width x p.height, then redraw and deseam it tile by tile through backend.
+    # With a region, image is a previous output that is only re-rendered around the region.
+    # Returns the upscaler, its result_images and initial_info hold what was rendered.
+    if region is not None:
+        p.width, p.height = image.size
+    upscaler = USDUpscaler(p, image, backend, save_redraw, save_seams_fix, tile_size)
+    upscaler.setup_canvas(disk_canvas, stream_output)
+    upscaler.setup_checkpoint(checkpoint_dir, checkpoint_every, resume)
+    upscaler.setup_cache(cache_dir, cache_size)
+    upscaler.setup_upscale_cache(upscale_cache_dir, cache_size)
+    upscaler.setup_metrics(metrics_path)
+    upscaler.setup_prefetch(prefetch)
+    upscaler.setup_dispatch(workers)
+    # Redraw and seams fix settings are part of the checkpoint plan, which upscale() checks before resuming
+    upscaler.setup_redraw(redraw_mode, padding, redraw_blur)
+    upscaler.setup_seams_fix(seams_fix_padding, seams_fix_denoise, seams_blur, seams_fix_width, seams_fix_type)
+    upscaler.setup_detail(flat_tiles, detail_threshold, flat_denoise_scale)
+    upscaler.setup_quadtree(quadtree_levels)
+    upscaler.setup_seam_detection(seam_threshold)
+    upscaler.setup_region(region)
+    upscaler.setup_wavefront(wavefront)
+    upscaler.setup_seam_coloring(seam_coloring)
+    upscaler.upscale()
+
+    # Drawing
+    upscaler.print_info()
+    upscaler.add_extra_info()
+    upscaler.process()
+    return upscaler
+
+def dry_run(p, image, tile_size=512, padding=128, redraw_mode=USDUMode.CHESS.value, redraw_blur=0,
+            seams_fix_type=USDUSFMode.HALF_TILE.value, seams_fix_width=64, seams_fix_denoise=0.45, seams_fix_padding=128,
+            seams_blur=0, disk_canvas=False, stream_output=False, prefetch=2, flat_tiles=USDUFlatMode.REDRAW.value,
+            detail_threshold=2.0, flat_denoise_scale=0.5, quadtree_levels=0, seam_threshold=0, region=None, seam_coloring=False,
+            wavefront=False, **run_kwargs):
+    # Plans what run() with the same arguments would do to image, as a JSON-ready dict of backend calls,
+    # batch fill, diffused pixels, sampler steps and peak host memory per stage. Only image.size is
+    # read; the other run() arguments don't change the plan.
+    if region is not None:
+        p.width, p.height = image.size
+    upscaler = USDUpscaler(p, image, None, False, False, tile_size)
+    upscaler.setup_canvas(disk_canvas, stream_output)
+    upscaler.setup_prefetch(prefetch)
+    upscaler.setup_redraw(redraw_mode, padding, redraw_blur)
+    upscaler.setup_seams_fix(seams_fix_padding, seams_fix_denoise, seams_blur, seams_fix_width, seams_fix_type)
+    upscaler.setup_detail(flat_tiles, detail_threshold, flat_denoise_scale)
+    upscaler.setup_quadtree(quadtree_levels)
+    upscaler.setup_seam_detection(seam_threshold)
+    upscaler.setup_region(region)
+    upscaler.setup_seam_coloring(seam_coloring)
+    upscaler.setup_wavefront(wavefront)
+    return upscaler.plan()
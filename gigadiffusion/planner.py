@@ -0,0 +1,108 @@
+import itertools
+import json
+import math
+import os
+import threading
+
+# Seconds per input megapixel of a model pass, before anything has been measured. Models are far slower
+# than a resize, so unmeasured chains are planned to use as few and as small passes as possible.
+default_pass_seconds = 1.0
+resize_seconds = 0.01
+
+
+class UpscaleCostModel():
+    # Measured throughput of each upscaler per factor, as an exponential moving average of seconds per
+    # input megapixel. Kept in throughput.json when given a directory, so later runs plan with it.
+    smoothing = 0.3
+
+    def __init__(self, path=None) -> None:
+        self.path = os.path.join(path, "throughput.json") if path else None
+        self.lock = threading.Lock()
+        self.seconds = {}
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as file:
+                    self.seconds = json.load(file)
+            except (OSError, ValueError):
+                self.seconds = {}
+
+    def pass_seconds(self, upscaler, factor, pixels):
+        measured = self.seconds.get(upscaler, {})
+        if str(factor) in measured:
+            per_megapixel = measured[str(factor)]
+        elif len(measured) > 0:
+            # Scale another measured factor of this upscaler by output pixels.
+            other, seconds = next(iter(measured.items()))
+            per_megapixel = seconds * factor ** 2 / int(other) ** 2
+        else:
+            per_megapixel = default_pass_seconds * factor ** 2 / 16
+        return per_megapixel * pixels / 1e6
+
+    def record(self, upscaler, factor, pixels, seconds):
+        if pixels <= 0:
+            return
+        per_megapixel = seconds / (pixels / 1e6)
+        with self.lock:
+            measured = self.seconds.setdefault(upscaler, {})
+            previous = measured.get(str(factor))
+            measured[str(factor)] = per_megapixel if previous is None else previous + self.smoothing * (per_megapixel - previous)
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with self.lock:
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(self.seconds, file, indent=2)
+        os.replace(temp_path, self.path)
+
+
+def chain_cost(cost_model, upscaler, chain, source_size, target_size, cached_passes=0):
+    # Model passes on the growing image, then the final LANCZOS resize from the chain output to the
+    # target. Passes covered by a cached intermediate cost nothing.
+    width, height = source_size
+    seconds = 0
+    for index, factor in enumerate(chain):
+        if index >= cached_passes:
+            seconds += cost_model.pass_seconds(upscaler, factor, width * height)
+        width *= factor
+        height *= factor
+    seconds += resize_seconds * (width * height + target_size[0] * target_size[1]) / 1e6
+    return seconds
+
+
+def plan_factors(cost_model, upscaler, source_size, target_size, factors=(2, 3, 4), max_passes=4, cached=None):
+    # Cheapest chain of model passes whose product reaches at least the whole part of the scale, the
+    # rest is left to the final resize (as before, 2.5x runs a 2x pass and resizes up by 1.25).
+    # cached(chain) tells whether an intermediate for that chain already exists.
+    ratio = max(target_size[0] / source_size[0], target_size[1] / source_size[1])
+    minimum = max(2, math.floor(ratio))
+    best = None
+    max_passes = max(max_passes, math.ceil(math.log(minimum, max(factors))))
+    for passes in range(1, max_passes + 1):
+        for chain in itertools.product(factors, repeat=passes):
+            total = math.prod(chain)
+            # Skip chains that still reach the minimum without one of their passes.
+            if total < minimum or any(total // factor >= minimum for factor in chain):
+                continue
+            cached_passes = 0
+            if cached is not None:
+                for length in range(len(chain), 0, -1):
+                    if cached(list(chain[:length])):
+                        cached_passes = length
+                        break
+            cost = chain_cost(cost_model, upscaler, chain, source_size, target_size, cached_passes)
+            if best is None or cost < best[0]:
+                best = (cost, list(chain))
+    return best[1]
+
+
+cost_models = {}
+
+
+def load_cost_model(path=None):
+    # One model per directory for the whole process, so webui sessions and folder runs keep learning.
+    if path not in cost_models:
+        cost_models[path] = UpscaleCostModel(path)
+    return cost_models[path]
@@ -0,0 +1,75 @@
+import concurrent.futures
+import threading
+
+
+def rects_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def jobs_overlap(a, b):
+    return any(rects_overlap(rect_a, rect_b) for rect_a in a.tile_rects for rect_b in b.tile_rects)
+
+
+class JobPrefetcher():
+    # Runs batched jobs as a pipeline: worker threads crop and build masks for the next `depth` jobs,
+    # and a paste thread writes finished batches back in job order, while the calling thread keeps
+    # the backend busy. A job is only prepared once every earlier job whose tile rects overlap its own
+    # has been pasted, so its crops read exactly what the serial loop would have read. Within a chess
+    # pass no tiles overlap and the next jobs are prepared during inference; across passes the
+    # pipeline waits for the pastes it depends on.
+    def __init__(self, depth=2, workers=2) -> None:
+        self.depth = depth
+        self.workers = workers
+        self.lock = threading.Condition()
+        self.pasted = 0
+
+    def ready(self, jobs, index):
+        # Caller holds the lock. Only jobs still waiting for their paste can block a crop.
+        return not any(jobs_overlap(jobs[earlier], jobs[index]) for earlier in range(self.pasted, index))
+
+    def paste(self, paste, index, job, prepared, processed):
+        try:
+            paste(job, prepared, processed)
+        finally:
+            with self.lock:
+                self.pasted = index + 1
+                self.lock.notify_all()
+
+    def run(self, jobs, prepare, process, paste, interrupted):
+        # prepare(job) runs on a worker and returns what process needs, process(job, prepared) runs on
+        # the calling thread (webui's processing must), paste(job, prepared, processed) on the paste thread.
+        # Returns the last processed result.
+        processed = None
+        if self.depth <= 0:
+            for job in jobs:
+                if interrupted():
+                    break
+                prepared = prepare(job)
+                processed = process(job, prepared)
+                paste(job, prepared, processed)
+            return processed
+
+        self.pasted = 0
+        futures = {}
+        pastes = []
+        with concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="gigadiffusion-prepare") as prepare_pool, \
+                concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="gigadiffusion-paste") as paste_pool:
+            for index, job in enumerate(jobs):
+                if interrupted():
+                    break
+                with self.lock:
+                    for ahead in range(index + 1, min(index + 1 + self.depth, len(jobs))):
+                        if ahead not in futures and self.ready(jobs, ahead):
+                            futures[ahead] = prepare_pool.submit(prepare, jobs[ahead])
+                    if index not in futures:
+                        while not self.ready(jobs, index):
+                            self.lock.wait()
+                        futures[index] = prepare_pool.submit(prepare, job)
+                prepared = futures.pop(index).result()
+                processed = process(job, prepared)
+                pastes.append(paste_pool.submit(self.paste, paste, index, job, prepared, processed))
+            for future in futures.values():
+                future.cancel()
+        for future in pastes:
+            future.result()
+        return processed
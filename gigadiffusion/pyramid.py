@@ -0,0 +1,163 @@
+import math
+import os
+import shutil
+import threading
+from PIL import Image
+
+
+class DeepZoomWriter():
+    # Streams a canvas into a Deep Zoom image (<path>.dzi + <path>_files/<level>/<col>_<row>.<format>).
+    # Pasted rects only mark the full-resolution tiles they touch; a background thread encodes those
+    # and, whenever it has nothing else to do, rebuilds the lower zoom levels from the tiles below.
+    def __init__(self, canvas, path, tile_size=254, overlap=1, format="jpg", quality=90) -> None:
+        self.canvas = canvas
+        self.path = path
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.format = format
+        self.quality = quality
+        self.files_path = path + "_files"
+        self.max_level = max(0, math.ceil(math.log2(max(canvas.width, canvas.height))))
+        # One dirty set per level, the worker always drains the highest resolution level first.
+        self.pending = [set() for _ in range(self.max_level + 1)]
+        self.written = set()
+        self.busy = False
+        self.closed = False
+        self.error = None
+        self.lock = threading.Condition()
+        for level in range(self.max_level + 1):
+            os.makedirs(os.path.join(self.files_path, str(level)), exist_ok=True)
+        self.write_descriptor()
+        self.thread = threading.Thread(target=self.run, name="gigadiffusion-deepzoom", daemon=True)
+        self.thread.start()
+
+    def write_descriptor(self):
+        descriptor = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{self.format}" '
+            f'Overlap="{self.overlap}" TileSize="{self.tile_size}">\n'
+            f'  <Size Width="{self.canvas.width}" Height="{self.canvas.height}"/>\n'
+            '</Image>\n'
+        )
+        with open(self.path + ".dzi", "w", encoding="utf-8") as file:
+            file.write(descriptor)
+
+    def level_size(self, level):
+        scale = 2 ** (self.max_level - level)
+        return math.ceil(self.canvas.width / scale), math.ceil(self.canvas.height / scale)
+
+    def tile_rect(self, level, col, row):
+        width, height = self.level_size(level)
+        left = col * self.tile_size - (self.overlap if col > 0 else 0)
+        top = row * self.tile_size - (self.overlap if row > 0 else 0)
+        right = min((col + 1) * self.tile_size + self.overlap, width)
+        bottom = min((row + 1) * self.tile_size + self.overlap, height)
+        return left, top, right, bottom
+
+    def tiles_in_rect(self, level, rect):
+        width, height = self.level_size(level)
+        first_col = max(0, (rect[0] - self.overlap) // self.tile_size)
+        first_row = max(0, (rect[1] - self.overlap) // self.tile_size)
+        last_col = min(math.ceil(width / self.tile_size) - 1, (rect[2] + self.overlap - 1) // self.tile_size)
+        last_row = min(math.ceil(height / self.tile_size) - 1, (rect[3] + self.overlap - 1) // self.tile_size)
+        return [(col, row) for row in range(first_row, last_row + 1) for col in range(first_col, last_col + 1)]
+
+    def tile_path(self, level, col, row):
+        return os.path.join(self.files_path, str(level), f"{col}_{row}.{self.format}")
+
+    def update(self, rect):
+        # Called by the canvas after every paste.
+        tiles = self.tiles_in_rect(self.max_level, tuple(int(v) for v in rect))
+        with self.lock:
+            self.pending[self.max_level].update(tiles)
+            self.lock.notify_all()
+
+    def next_tile(self):
+        for level in range(self.max_level, -1, -1):
+            if len(self.pending[level]) > 0:
+                return level, self.pending[level].pop()
+        return None
+
+    def run(self):
+        while True:
+            with self.lock:
+                work = self.next_tile()
+                while work is None and not self.closed:
+                    self.busy = False
+                    self.lock.notify_all()
+                    self.lock.wait()
+                    work = self.next_tile()
+                if work is None:
+                    self.busy = False
+                    self.lock.notify_all()
+                    return
+                self.busy = True
+            level, (col, row) = work
+            try:
+                self.write_tile(level, col, row)
+            except Exception as e:
+                self.error = e
+            with self.lock:
+                self.written.add((level, col, row))
+                if level > 0:
+                    # Parents stitch every child their rect touches, overlap included, not only their 2x2 block.
+                    rect = self.tile_rect(level, col, row)
+                    self.pending[level - 1].update(self.tiles_in_rect(level - 1, (rect[0] // 2, rect[1] // 2, math.ceil(rect[2] / 2), math.ceil(rect[3] / 2))))
+
+    def write_tile(self, level, col, row):
+        rect = self.tile_rect(level, col, row)
+        if level == self.max_level:
+            tile = self.canvas.crop(rect)
+        else:
+            tile = self.downscale_children(level, rect)
+        path = self.tile_path(level, col, row)
+        # Write next to the target and rename, so viewers never read a half written tile.
+        temp_path = f"{path}.tmp"
+        if self.format == "jpg":
+            tile.save(temp_path, "JPEG", quality=self.quality)
+        else:
+            tile.save(temp_path, self.format.upper())
+        os.replace(temp_path, path)
+
+    def downscale_children(self, level, rect):
+        # Stitch the covering tiles of the next level and halve them.
+        child_width, child_height = self.level_size(level + 1)
+        child_rect = (rect[0] * 2, rect[1] * 2, min(rect[2] * 2, child_width), min(rect[3] * 2, child_height))
+        stitched = Image.new("RGB", (child_rect[2] - child_rect[0], child_rect[3] - child_rect[1]))
+        for col, row in self.tiles_in_rect(level + 1, child_rect):
+            path = self.tile_path(level + 1, col, row)
+            if not os.path.exists(path):
+                continue
+            tile_rect = self.tile_rect(level + 1, col, row)
+            with Image.open(path) as tile:
+                stitched.paste(tile.convert("RGB"), (tile_rect[0] - child_rect[0], tile_rect[1] - child_rect[1]))
+        return stitched.resize((rect[2] - rect[0], rect[3] - rect[1]), resample=Image.LANCZOS)
+
+    def flush(self, write_missing=False):
+        # Block until every pasted tile and all zoom levels above it are on disk.
+        if write_missing:
+            width, height = self.level_size(self.max_level)
+            with self.lock:
+                for tile in self.tiles_in_rect(self.max_level, (0, 0, width, height)):
+                    if (self.max_level,) + tile not in self.written:
+                        self.pending[self.max_level].add(tile)
+                self.lock.notify_all()
+        with self.lock:
+            while self.busy or any(len(pending) > 0 for pending in self.pending):
+                self.lock.notify_all()
+                self.lock.wait()
+        if self.error is not None:
+            raise self.error
+
+    def snapshot(self, path):
+        # Copy of the pyramid as it is now at path, for a result later pastes would overwrite.
+        self.flush(write_missing=True)
+        shutil.copyfile(self.path + ".dzi", path + ".dzi")
+        shutil.copytree(self.files_path, path + "_files", dirs_exist_ok=True)
+
+    def close(self):
+        self.flush(write_missing=True)
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.thread.join()
@@ -0,0 +1,75 @@
+class TileLayout():
+    # Leaves of a quadtree over the tile grid, as (xi, yi, size) in grid cells. Where every cell of an
+    # aligned size x size block is flat, the block is one leaf up to 2 ** levels cells wide, and is
+    # redrawn as a single tile that the backend scales down to model resolution. Everything else
+    # stays a single grid cell. Without flat cells or levels this is the plain tile grid.
+    def __init__(self, rows, cols, flat=(), levels=0) -> None:
+        self.rows = rows
+        self.cols = cols
+        self.leaves = []
+        # Leaf index of every grid cell.
+        self.owner = {}
+        flat = set(flat)
+        if levels == 0 or len(flat) == 0:
+            # The plain grid: every cell is its own leaf and the colouring is the checkerboard.
+            self.leaves = [(xi, yi, 1) for yi in range(rows) for xi in range(cols)]
+            self.owner = {(xi, yi): yi * cols + xi for yi in range(rows) for xi in range(cols)}
+            self.colors = [(xi + yi) % 2 for yi in range(rows) for xi in range(cols)]
+            return
+        for yi in range(rows):
+            for xi in range(cols):
+                if (xi, yi) in self.owner:
+                    continue
+                # Aligned blocks nest, so the first cell of a block is always reached before any other.
+                size = 1
+                for level in range(levels, 0, -1):
+                    if self.block_fits(xi, yi, 2 ** level, flat):
+                        size = 2 ** level
+                        break
+                for cell in self.block_cells(xi, yi, size):
+                    self.owner[cell] = len(self.leaves)
+                self.leaves.append((xi, yi, size))
+        self.colors = self.color_leaves()
+
+    def block_fits(self, xi, yi, size, flat):
+        if xi % size != 0 or yi % size != 0 or xi + size > self.cols or yi + size > self.rows:
+            return False
+        return all(cell in flat for cell in self.block_cells(xi, yi, size))
+
+    @staticmethod
+    def block_cells(xi, yi, size):
+        return [(x, y) for y in range(yi, yi + size) for x in range(xi, xi + size)]
+
+    def cells(self, leaf):
+        return self.block_cells(*leaf)
+
+    def neighbours(self, index):
+        xi, yi, size = self.leaves[index]
+        around = [(x, yi - 1) for x in range(xi, xi + size)] + [(x, yi + size) for x in range(xi, xi + size)]
+        around += [(xi - 1, y) for y in range(yi, yi + size)] + [(xi + size, y) for y in range(yi, yi + size)]
+        return {self.owner[cell] for cell in around if cell in self.owner}
+
+    def color_leaves(self):
+        # Greedy colouring in raster order, so leaves sharing an edge land in different redraw passes.
+        # On the plain grid this is the (xi + yi) % 2 checkerboard.
+        colors = []
+        for index in range(len(self.leaves)):
+            used = {colors[other] for other in self.neighbours(index) if other < index}
+            color = 0
+            while color in used:
+                color += 1
+            colors.append(color)
+        return colors
+
+    def passes(self):
+        return max(self.colors, default=0) + 1
+
+    def same_leaf(self, a, b) -> bool:
+        # No seam runs between two cells of one leaf.
+        return self.owner[a] == self.owner[b]
+
+    def junction(self, xi, yi) -> bool:
+        # The corner between cells (xi, yi) and (xi + 1, yi + 1) is where seams meet only when at
+        # least three leaves touch it; with two it lies on a straight seam, with one inside a block.
+        cells = [(xi, yi), (xi + 1, yi), (xi, yi + 1), (xi + 1, yi + 1)]
+        return len({self.owner[cell] for cell in cells}) >= 3
@@ -0,0 +1,82 @@
+import heapq
+from gigadiffusion.tileplan import SpatialIndex
+
+
+class SeamGraph():
+    # Overlap graph of seams fix patches, given as tile rects. Patches whose rects overlap read or paste
+    # each other's pixels and have to run one after the other; patches of one colour never overlap, so
+    # they can be batched together in any mix of row seams, column seams or intersections. Overlaps
+    # come from a SpatialIndex with grid_size buckets, so building the graph stays linear in the patches.
+    def __init__(self, rects, grid_size) -> None:
+        self.rects = list(rects)
+        self.index = SpatialIndex(self.rects, grid_size)
+        self.adjacent = [set() for _ in self.rects]
+        for a, b in self.index.pairs():
+            self.adjacent[a].add(b)
+            self.adjacent[b].add(a)
+        self.colors = self.color_patches()
+
+    def neighbours(self, index):
+        return {other for other in self.index.query(self.rects[index]) if other != index}
+
+    def color_patches(self):
+        # Greedy colouring, most constrained patch first (DSatur): the patch whose neighbours already use
+        # the most colours takes the lowest free one, ties go to the most neighbours, then raster order.
+        # Row and column seams without padding get 2 colours, intersections without padding a third.
+        neighbours = self.adjacent
+        colors = [None] * len(self.rects)
+        used = [set() for _ in self.rects]
+
+        def priority(index):
+            return (-len(used[index]), -len(neighbours[index]), self.rects[index][1], self.rects[index][0], index)
+
+        # A patch is pushed again whenever its neighbours gain a colour, older entries are skipped.
+        heap = [priority(index) for index in range(len(self.rects))]
+        heapq.heapify(heap)
+        while len(heap) > 0:
+            index = heapq.heappop(heap)[-1]
+            if colors[index] is not None:
+                continue
+            color = 0
+            while color in used[index]:
+                color += 1
+            colors[index] = color
+            for other in neighbours[index]:
+                if colors[other] is None and color not in used[other]:
+                    used[other].add(color)
+                    heapq.heappush(heap, priority(other))
+        return colors
+
+    def passes(self):
+        return max(self.colors, default=-1) + 1
+
+    def color_sets(self):
+        # Patch indexes of every colour, in colour order.
+        sets = [[] for _ in range(self.passes())]
+        for index, color in enumerate(self.colors):
+            sets[color].append(index)
+        return sets
+
+    def batches(self, capacity, groups, after):
+        # Packs the patches, colour by colour, into batches of up to capacity patches that don't overlap
+        # and share their groups entry (what has to match within a batch). A patch takes the first open
+        # batch of its group holding nothing it overlaps, so the leftovers of one colour fill up the
+        # batches of others instead of each colour ending in a part batch. Patches flagged in after are
+        # placed last and go past every batch holding a patch they overlap, so they see its output.
+        batch_of = [None] * len(self.rects)
+        batches = []
+        open_batches = {}
+        for index in sorted(range(len(self.rects)), key=lambda index: (after[index], self.colors[index])):
+            taken = {batch_of[other] for other in self.adjacent[index] if batch_of[other] is not None}
+            first = max(taken) + 1 if after[index] and len(taken) > 0 else 0
+            candidates = open_batches.setdefault(groups[index], [])
+            batch = next((batch for batch in candidates if batch >= first and batch not in taken), None)
+            if batch is None:
+                batch = len(batches)
+                batches.append([])
+                candidates.append(batch)
+            batches[batch].append(index)
+            batch_of[index] = batch
+            if len(batches[batch]) >= capacity:
+                candidates.remove(batch)
+        return batches
@@ -0,0 +1,10 @@
+import hashlib
+import json
+
+
+def derive_seed(seed, *parts):
+    # Stable per-tile seed from the run seed and whatever identifies the tile (stage, rect, ...),
+    # so re-runs, resumed runs and cache lookups all see the same seeds. Same range as the
+    # random.randint(0, 1048576) seeds it replaces.
+    digest = hashlib.sha256(json.dumps([seed, *parts]).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little") % 1048577
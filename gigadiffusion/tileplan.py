@@ -0,0 +1,129 @@
+import numpy as np
+
+
+class TilePlan():
+    # Tile, mask, seam and intersection rects of the whole grid, computed in one vectorized pass with
+    # the same arithmetic as RectCalculator (calc_tile, calc_mask_in_tile, calc_row_seam_in_tile,
+    # calc_col_seam_in_tile and calc_intersection_in_tile), so the rects are identical. The lists are
+    # indexed [yi][xi] and hold plain int tuples, as the calculator returns.
+    __slots__ = ("key", "tiles", "masks", "row_seams", "col_seams", "intersections", "intersection_masks")
+
+    def __init__(self, tile_size, padding, width, height, rows, cols, double_draw=True) -> None:
+        self.key = (tile_size, padding, width, height, rows, cols, double_draw)
+        tile_x, mask_x = self.axis(tile_size, padding, width, cols, double_draw)
+        tile_y, mask_y = self.axis(tile_size, padding, height, rows, double_draw)
+        tiles = self.combine(tile_x, tile_y)
+        shift = tile_size // 2
+        self.tiles = self.tuples(tiles)
+        self.masks = self.tuples(self.combine(mask_x, mask_y))
+        self.row_seams = self.tuples(tiles + [0, shift, 0, shift])
+        self.col_seams = self.tuples(tiles + [shift, 0, shift, 0])
+        # Intersections are centred on the corner shared by tiles (xi, yi) and (xi + 1, yi + 1).
+        start_x = (np.arange(max(cols - 1, 0)) + 1) * tile_size - shift
+        start_y = (np.arange(max(rows - 1, 0)) + 1) * tile_size - shift
+        left = np.maximum(np.minimum(start_x, width - tile_size), 0)
+        top = np.maximum(np.minimum(start_y, height - tile_size), 0)
+        self.intersections = self.tuples(self.combine(np.stack([left, left + tile_size], axis=1), np.stack([top, top + tile_size], axis=1)))
+        self.intersection_masks = self.tuples(self.combine(np.stack([start_x - left, start_x - left + tile_size], axis=1),
+                                                           np.stack([start_y - top, start_y - top + tile_size], axis=1)))
+
+    @staticmethod
+    def axis(tile_size, padding, extent, count, double_draw):
+        # (start, end) of the tiles and of their masks along one axis, for every index at once.
+        index = np.arange(count)
+        first = index == 0
+        last = (index == count - 1) & double_draw
+        tile_start = np.where(last, extent - tile_size - padding, index * tile_size - padding // 2)
+        tile_end = np.where(last, extent, tile_start + padding + tile_size)
+        tile_start = np.where(first, 0, tile_start)
+        tile_end = np.where(first, tile_size + padding, tile_end)
+        mask_size = extent - index * tile_size
+        mask_start = np.where(last, padding + tile_size - mask_size, padding // 2)
+        mask_end = np.where(last, mask_start + mask_size, mask_start + tile_size)
+        mask_start = np.where(first, 0, mask_start)
+        mask_end = np.where(first, tile_size, mask_end)
+        return np.stack([tile_start, tile_end], axis=1), np.stack([mask_start, mask_end], axis=1)
+
+    @staticmethod
+    def combine(x, y):
+        # [yi][xi] -> (left, top, right, bottom) from per-column and per-row (start, end) pairs.
+        rects = np.empty((len(y), len(x), 4), dtype=np.int64)
+        rects[:, :, 0] = x[None, :, 0]
+        rects[:, :, 1] = y[:, None, 0]
+        rects[:, :, 2] = x[None, :, 1]
+        rects[:, :, 3] = y[:, None, 1]
+        return rects
+
+    @staticmethod
+    def tuples(rects):
+        return [[tuple(rect) for rect in row] for row in rects.tolist()]
+
+    def tile(self, xi, yi):
+        return self.tiles[yi][xi]
+
+    def mask(self, xi, yi):
+        return self.masks[yi][xi]
+
+    def row_seam(self, xi, yi):
+        return self.row_seams[yi][xi]
+
+    def col_seam(self, xi, yi):
+        return self.col_seams[yi][xi]
+
+    def intersection(self, xi, yi):
+        return self.intersections[yi][xi], self.intersection_masks[yi][xi]
+
+
+class SpatialIndex():
+    # Grid buckets over a fixed list of rects, for "which rects touch this one". Rects only reach the
+    # buckets their cells cover, so building the index and finding every overlapping pair take time
+    # linear in the rects for tiles of about cell_size.
+    def __init__(self, rects, cell_size) -> None:
+        self.rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+        self.cell_size = max(1, cell_size)
+        self.buckets = {}
+        for index, (x0, y0, x1, y1) in enumerate(self.cell_ranges(self.rects).tolist()):
+            for y in range(y0, y1 + 1):
+                for x in range(x0, x1 + 1):
+                    self.buckets.setdefault((x, y), []).append(index)
+
+    def cell_ranges(self, rects):
+        # First and last bucket column and row of every rect; rects reaching past the top or left
+        # edge share the first buckets.
+        ranges = np.maximum(rects - [0, 0, 1, 1], 0) // self.cell_size
+        return ranges.reshape(-1, 4)
+
+    def overlaps(self, rect, candidates):
+        rects = self.rects[candidates]
+        return (rects[:, 0] < rect[2]) & (rect[0] < rects[:, 2]) & (rects[:, 1] < rect[3]) & (rect[1] < rects[:, 3])
+
+    def query(self, rect):
+        # Indexes of the rects overlapping rect, in index order.
+        x0, y0, x1, y1 = self.cell_ranges(np.asarray(rect, dtype=np.int64)).tolist()[0]
+        candidates = sorted({index for y in range(y0, y1 + 1) for x in range(x0, x1 + 1) for index in self.buckets.get((x, y), [])})
+        if len(candidates) == 0:
+            return []
+        candidates = np.asarray(candidates)
+        return candidates[self.overlaps(rect, candidates)].tolist()
+
+    def pairs(self):
+        # Every (a, b) with a < b whose rects overlap, sorted. Candidates are all pairs sharing a bucket,
+        # generated and tested as arrays.
+        members = [np.asarray(bucket) for bucket in self.buckets.values() if len(bucket) > 1]
+        if len(members) == 0:
+            return []
+        sizes = np.array([len(bucket) for bucket in members])
+        flat = np.concatenate(members)
+        starts = np.repeat(np.cumsum(sizes) - sizes, sizes)
+        # Each member is paired with every member of its bucket: repeat it bucket size times and walk
+        # the bucket alongside.
+        repeats = np.repeat(sizes, sizes)
+        first = np.repeat(flat, repeats)
+        offsets = np.arange(len(first)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        second = flat[np.repeat(starts, repeats) + offsets]
+        keep = first < second
+        first, second = first[keep], second[keep]
+        a, b = self.rects[first], self.rects[second]
+        hit = (a[:, 0] < b[:, 2]) & (b[:, 0] < a[:, 2]) & (a[:, 1] < b[:, 3]) & (b[:, 1] < a[:, 3])
+        unique = np.unique(first[hit] * len(self.rects) + second[hit])
+        return list(zip((unique // len(self.rects)).tolist(), (unique % len(self.rects)).tolist()))
@@ -0,0 +1,68 @@
+import contextlib
+import copy
+import io
+import math
+from gigadiffusion.pipeline import dry_run
+
+# VRAM of a batch: the model, plus activations linear in the pixels of the batch (as with xformers or
+# sdp attention). Rough figures for SD 1.5 in fp16, measured setups should pass their own.
+model_megabytes = 3000
+megabytes_per_megapixel = 3500
+# Fixed cost of a backend call (model setup, VAE, transfers) in diffused pixels, about one 512x512 sample.
+call_overhead_pixels = 512 * 512
+
+tile_sizes = range(256, 2048 + 1, 64)
+batch_sizes = range(1, 9)
+
+
+def batch_megabytes(size, batch_size):
+    return model_megabytes + batch_size * size[0] * size[1] / 1e6 * megabytes_per_megapixel
+
+
+def plan_cost(plan):
+    return plan["total"]["diffused_pixels"] + plan["total"]["backend_calls"] * call_overhead_pixels
+
+
+def auto_tune(p, image, vram_budget, ram_budget=0, tile_size=1024, padding=128, **settings):
+    # Picks tile_size, padding and batch size for image (only its size is read) with the fewest diffused
+    # pixels and backend calls whose largest batch fits vram_budget and whose planned peak host memory fits
+    # ram_budget, both in MB (0 leaves RAM unlimited). Every candidate is costed with dry_run(), so edge
+    # tiles inset over their neighbours count as the extra samples they are. tile_size is the largest tile
+    # tried, since bigger tiles always diffuse less but models redraw poorly far above their resolution.
+    # padding is the least context a tile gets; it grows to fill the 64 pixel rounding of the processing
+    # size, which is diffused anyway.
+    # Sets p.batch_size and records the choice in p.extra_generation_params, returns the run() arguments
+    # to override and the plan.
+    best = None
+    largest = max(min(tile_size, math.ceil(max(p.width, p.height) / 64) * 64), tile_sizes[0])
+    for candidate_size in tile_sizes:
+        if candidate_size > largest:
+            break
+        tile_padding = math.ceil((candidate_size + padding) / 64) * 64 - candidate_size
+        process_size = candidate_size + tile_padding
+        for batch_size in batch_sizes:
+            # Redraw runs at the padded size, the seams fix at the tile size.
+            if batch_megabytes((process_size, process_size), batch_size) > vram_budget:
+                break
+            candidate = copy.copy(p)
+            candidate.batch_size = batch_size
+            with contextlib.redirect_stdout(io.StringIO()):
+                plan = dry_run(candidate, image, **{**settings, "tile_size": candidate_size, "padding": tile_padding})
+            if ram_budget > 0 and plan["peak_memory_bytes"] > ram_budget * 1024 * 1024:
+                continue
+            if best is None or plan_cost(plan) < plan_cost(best[3]):
+                best = (candidate_size, tile_padding, batch_size, plan)
+    if best is None:
+        tile_size = tile_sizes[0]
+        print(f"Auto tune: nothing fits {vram_budget} MB VRAM and {ram_budget or 'unlimited'} MB RAM, using tile size {tile_size} at batch size 1")
+        tile_padding = math.ceil((tile_size + padding) / 64) * 64 - tile_size
+        candidate = copy.copy(p)
+        candidate.batch_size = 1
+        with contextlib.redirect_stdout(io.StringIO()):
+            best = (tile_size, tile_padding, 1, dry_run(candidate, image, **{**settings, "tile_size": tile_size, "padding": tile_padding}))
+    tile_size, tile_padding, batch_size, plan = best
+    print(f"Auto tune: tile size {tile_size}, padding {tile_padding}, batch size {batch_size}: "
+          f"{plan['total']['backend_calls']} backend calls, {plan['total']['diffused_pixels'] / 1e6:.1f} MP diffused")
+    p.batch_size = batch_size
+    p.extra_generation_params["Gigadiffusion auto tune"] = f"tile {tile_size}, padding {tile_padding}, batch {batch_size} under {vram_budget} MB VRAM"
+    return {"tile_size": tile_size, "padding": tile_padding}, plan
@@ -0,0 +1,138 @@
+import collections
+import concurrent.futures
+import contextlib
+import math
+import os
+import time
+import numpy as np
+from PIL import Image
+from gigadiffusion.cache import TileCache
+
+
+class TiledUpscaler():
+    # First-stage upscale in overlapping source tiles. Each tile runs the whole factor chain and the
+    # final resize to its part of the target canvas on a thread pool, then is pasted with a linear
+    # feather across the overlap with the tiles left of and above it, so the degraded tile borders get
+    # no weight. Tiles are pasted in raster order as they finish, so only the tiles in flight and the
+    # output canvas are ever held, never a second full-size image.
+    # With a cache, the output of the factor chain is kept per source tile, so renders of the same source
+    # at other sizes skip the model passes; a cached shorter chain is continued from.
+    def __init__(self, upscale, scales=None, tile_size=256, overlap=16, workers=None, lock=None, cache=None,
+                 cost_model=None, upscaler_name="") -> None:
+        self.upscale = upscale
+        self.scales = scales or []
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.workers = workers or os.cpu_count() or 1
+        # Held around upscale() for upscalers that can't run on several threads (e.g. GPU models).
+        self.lock = lock
+        self.cache = cache
+        self.cost_model = cost_model
+        self.upscaler_name = upscaler_name
+        # Source pixels cropped past every side of a tile for the final resize to read: the Lanczos
+        # support of 3 plus one for the rounded target rects, enough for any upscale.
+        self.margin = 4
+
+    def cache_key(self, tile, chain):
+        return TileCache.key(tile, None, {"upscaler": self.upscaler_name, "chain": chain, "overlap": self.overlap})
+
+    def is_cached(self, source, chain):
+        # Checks the first tile only, as a cheap stand-in for the whole source.
+        if self.cache is None:
+            return False
+        rect = self.source_rect(self.tile_rects(source.width, source.height)[0], source.width, source.height)
+        return os.path.exists(self.cache.entry_path(self.cache_key(source.crop(rect), chain)))
+
+    def cached_tile(self, tile):
+        # Longest cached prefix of the chain, as (image, passes done).
+        if self.cache is None or len(self.scales) == 0:
+            return tile, 0
+        for length in range(len(self.scales), 0, -1):
+            entry = self.cache.get(self.cache_key(tile, self.scales[:length]))
+            if entry is not None:
+                return entry[0], length
+        return tile, 0
+
+    def tile_rects(self, width, height):
+        rects = []
+        for top in range(0, height, self.tile_size):
+            for left in range(0, width, self.tile_size):
+                rects.append((
+                    max(left - self.overlap, 0),
+                    max(top - self.overlap, 0),
+                    min(left + self.tile_size + self.overlap, width),
+                    min(top + self.tile_size + self.overlap, height),
+                ))
+        return rects
+
+    def source_rect(self, rect, width, height):
+        return (max(rect[0] - self.margin, 0), max(rect[1] - self.margin, 0),
+                min(rect[2] + self.margin, width), min(rect[3] + self.margin, height))
+
+    @staticmethod
+    def target_rect(rect, scale_x, scale_y):
+        return (round(rect[0] * scale_x), round(rect[1] * scale_y), round(rect[2] * scale_x), round(rect[3] * scale_y))
+
+    @staticmethod
+    def ramp(length, fade):
+        weights = np.ones(length, dtype=np.float32)
+        if fade > 0:
+            weights[:fade] = (np.arange(fade, dtype=np.float32) + 0.5) / fade
+        return weights
+
+    def feather_mask(self, target, fade_left, fade_top):
+        width = target[2] - target[0]
+        height = target[3] - target[1]
+        if fade_left <= 0 and fade_top <= 0:
+            return None
+        weights = np.outer(self.ramp(height, fade_top), self.ramp(width, fade_left))
+        return Image.fromarray(np.rint(weights * 255).astype(np.uint8), "L")
+
+    def upscale_tile(self, source, rect, target, scale_x, scale_y):
+        rect = self.source_rect(rect, source.width, source.height)
+        source_tile = source.crop(rect)
+        tile, done = self.cached_tile(source_tile)
+        for value in self.scales[done:]:
+            with self.lock if self.lock is not None else contextlib.nullcontext():
+                started = time.perf_counter()
+                pixels = tile.width * tile.height
+                tile = self.upscale(tile, value)
+                if self.cost_model is not None:
+                    self.cost_model.record(self.upscaler_name, value, pixels, time.perf_counter() - started)
+        if self.cache is not None and done < len(self.scales):
+            self.cache.put(self.cache_key(source_tile, self.scales), tile)
+        # Target rects are rounded to whole pixels, so resample exactly the source area they cover to
+        # stay on the same sampling grid as a full-image resize. The margin keeps that area and the
+        # pixels around it inside the tile, it is only clamped at the image edges.
+        chain_x = tile.width / (rect[2] - rect[0])
+        chain_y = tile.height / (rect[3] - rect[1])
+        box = (
+            min(max((target[0] / scale_x - rect[0]) * chain_x, 0), tile.width),
+            min(max((target[1] / scale_y - rect[1]) * chain_y, 0), tile.height),
+            min(max((target[2] / scale_x - rect[0]) * chain_x, 0), tile.width),
+            min(max((target[3] / scale_y - rect[1]) * chain_y, 0), tile.height),
+        )
+        return tile.resize((target[2] - target[0], target[3] - target[1]), resample=Image.LANCZOS, box=box)
+
+    def run(self, source, canvas):
+        scale_x = canvas.width / source.width
+        scale_y = canvas.height / source.height
+        rects = self.tile_rects(source.width, source.height)
+        targets = [self.target_rect(rect, scale_x, scale_y) for rect in rects]
+        cols = math.ceil(source.width / self.tile_size)
+        print(f"Upscaling {len(rects)} tiles with factors {self.scales} on {self.workers} threads")
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="gigadiffusion-upscale") as pool:
+            for index in range(len(rects)):
+                pending.append(pool.submit(self.upscale_tile, source, rects[index], targets[index], scale_x, scale_y))
+                # Keep a bounded window of tiles in flight and paste them in raster order.
+                while len(pending) > self.workers * 2 or (index == len(rects) - 1 and len(pending) > 0):
+                    done = index - len(pending) + 1
+                    self.paste(canvas, pending.popleft().result(), done, targets, cols)
+        return canvas
+
+    def paste(self, canvas, tile, index, targets, cols):
+        target = targets[index]
+        fade_left = targets[index - 1][2] - target[0] if index % cols > 0 else 0
+        fade_top = targets[index - cols][3] - target[1] if index >= cols else 0
+        canvas.paste(tile, target[:2], self.feather_mask(target, fade_left, fade_top))
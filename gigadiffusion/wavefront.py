@@ -0,0 +1,145 @@
+import heapq
+from gigadiffusion.prefetch import rects_overlap
+from gigadiffusion.seeds import derive_seed
+from gigadiffusion.tileplan import SpatialIndex
+
+
+class WavefrontGroup():
+    # Tiles of one pass job whose rects overlap each other. The pass crops them all before pasting any,
+    # so they always run in the same batch.
+    def __init__(self, order, stage_pass, job, indexes) -> None:
+        self.order = order
+        self.stage_pass = stage_pass
+        self.job = job
+        self.indexes = indexes
+        self.rects = [job.tile_rects[index] for index in indexes]
+        self.key = (stage_pass["settings"], stage_pass["owner"].denoise * job.denoise_scale)
+        self.waiting = 0
+        self.dependents = []
+
+
+class WavefrontScheduler():
+    # Runs the tiles of several passes (chess redraw, row and column seams, intersections) as one
+    # dependency graph instead of pass after pass. A tile group may run once every group of an earlier
+    # pass or job whose rects overlap its own has been pasted, so every crop reads what it would have
+    # read pass by pass and the result is the same; a seam is fixed as soon as the tiles around it are
+    # redrawn. Batches are built from whatever is ready with the same processing settings, earliest
+    # first, so passes fill each other's partial batches and finished areas reach the canvas early.
+    def __init__(self, batch_size, grid_size, process, interrupted, metrics) -> None:
+        self.batch_size = max(1, batch_size)
+        self.grid_size = grid_size
+        # process(p, masks) runs one batch on the backend.
+        self.process = process
+        self.interrupted = interrupted
+        self.metrics = metrics
+        self.passes = []
+
+    def add_pass(self, owner, stage, jobs, create_mask, settings):
+        # settings are (width, height, inpaint_full_res_padding, mask_blur) of the pass's batches.
+        self.passes.append({"owner": owner, "stage": stage, "jobs": jobs, "create_mask": create_mask, "settings": settings})
+
+    @staticmethod
+    def overlap_groups(job):
+        groups = []
+        for index, rect in enumerate(job.tile_rects):
+            touching = [group for group in groups if any(rects_overlap(rect, job.tile_rects[other]) for other in group)]
+            merged = sorted([index] + [other for group in touching for other in group])
+            groups = [group for group in groups if group not in touching] + [merged]
+        return sorted(groups)
+
+    def build_groups(self):
+        # Groups in pass order. A group waits for every group of an earlier job whose rects overlap its
+        # own; groups of one job never overlap. Overlaps are the pairs of a SpatialIndex over all tiles.
+        groups = []
+        for stage_pass in self.passes:
+            for job in stage_pass["jobs"]:
+                groups += [WavefrontGroup(len(groups) + offset, stage_pass, job, indexes)
+                           for offset, indexes in enumerate(self.overlap_groups(job))]
+        owners = [group for group in groups for _ in group.rects]
+        index = SpatialIndex([rect for group in groups for rect in group.rects], self.grid_size)
+        edges = {(owners[a].order, owners[b].order) for a, b in index.pairs() if owners[a].job is not owners[b].job}
+        for earlier, later in sorted(edges):
+            groups[earlier].dependents.append(groups[later])
+            groups[later].waiting += 1
+        return groups
+
+    def next_batch(self, ready, ready_samples):
+        # Settings with a full batch ready go first, then the one holding the earliest ready group.
+        key = min((key for key in ready if len(ready[key]) > 0),
+                  key=lambda key: (ready_samples[key] < self.batch_size, ready[key][0][0]))
+        batch = []
+        samples = 0
+        while len(ready[key]) > 0 and samples + len(ready[key][0][1].indexes) <= self.batch_size:
+            group = heapq.heappop(ready[key])[1]
+            batch.append(group)
+            samples += len(group.indexes)
+        ready_samples[key] -= samples
+        return batch
+
+    def run_batch(self, p, image, batch):
+        stage_pass = batch[0].stage_pass
+        tiles = [(group, index) for group in batch for index in group.indexes]
+        timer = self.metrics.job(stage_pass["stage"] if all(group.stage_pass is stage_pass for group in batch) else "wavefront", len(tiles))
+        tile_rects = [group.job.tile_rects[index] for group, index in tiles]
+        init_images = [image.crop(tile_rect) for tile_rect in tile_rects]
+        timer.lap("crop", init_images)
+        masks = [group.stage_pass["create_mask"](group.job, index) for group, index in tiles]
+        timer.lap("mask", masks)
+        width, height, padding, mask_blur = stage_pass["settings"]
+        p.width = width
+        p.height = height
+        p.inpaint_full_res = True
+        p.inpaint_full_res_padding = padding
+        p.mask_blur = mask_blur
+        p.denoising_strength = batch[0].key[1]
+        p.init_images = init_images
+        # Same per-tile seeds as the passes derive.
+        p.seed = [derive_seed(group.stage_pass["owner"].seed, group.stage_pass["stage"], tile_rect) for (group, _), tile_rect in zip(tiles, tile_rects)]
+        p.subseed = [derive_seed(group.stage_pass["owner"].seed, f"{group.stage_pass['stage']} subseed", tile_rect) for (group, _), tile_rect in zip(tiles, tile_rects)]
+        p.batch_size = len(init_images)
+        processed = self.process(p, masks)
+        timer.lap("backend", processed.images)
+        for index in range(min(len(processed.images), len(tile_rects))):
+            image.paste(processed.images[index], tile_rects[index])
+        timer.lap("paste")
+        timer.done()
+        return processed
+
+    def batches(self):
+        # Yields the batches (lists of groups) in the order they run. A batch's dependents become ready
+        # when the next one is asked for, so the caller runs each batch first; a plan just collects them.
+        groups = self.build_groups()
+        ready = {}
+        ready_samples = {}
+        for group in groups:
+            ready.setdefault(group.key, [])
+            ready_samples.setdefault(group.key, 0)
+            if group.waiting == 0:
+                heapq.heappush(ready[group.key], (group.order, group))
+                ready_samples[group.key] += len(group.indexes)
+        remaining = len(groups)
+        while remaining > 0:
+            batch = self.next_batch(ready, ready_samples)
+            yield batch
+            for group in batch:
+                remaining -= 1
+                for dependent in group.dependents:
+                    dependent.waiting -= 1
+                    if dependent.waiting == 0:
+                        heapq.heappush(ready[dependent.key], (dependent.order, dependent))
+                        ready_samples[dependent.key] += len(dependent.indexes)
+
+    def run(self, p, image):
+        # Returns the last processed batch, or None when nothing ran.
+        processed = None
+        calls = 0
+        samples = 0
+        for batch in self.batches():
+            if self.interrupted():
+                break
+            processed = self.run_batch(p, image, batch)
+            calls += 1
+            samples += sum(len(group.indexes) for group in batch)
+        if calls > 0:
+            print(f"Wavefront: {samples} tiles in {calls} batches, {samples / calls:.2f} of {self.batch_size} per batch")
+        return processed
@@ -0,0 +1,94 @@
+import argparse
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from gigadiffusion.backends import Processing, decode_image, encode_image
+from gigadiffusion.cli import create_backend
+
+
+def create_processing(payload):
+    p = Processing(payload["width"], payload["height"], prompt=payload.get("prompt", ""),
+                   negative_prompt=payload.get("negative_prompt", ""), seed=payload.get("seed", 0),
+                   steps=payload.get("steps", 20), cfg_scale=payload.get("cfg_scale", 7.0),
+                   sampler_name=payload.get("sampler_name"), denoising_strength=payload.get("denoising_strength", 0.75),
+                   batch_size=1)
+    p.subseed = payload.get("subseed", 0)
+    p.subseed_strength = payload.get("subseed_strength", 0)
+    p.mask_blur = payload.get("mask_blur", 0)
+    p.inpaint_full_res = bool(payload.get("inpaint_full_res", True))
+    p.inpaint_full_res_padding = payload.get("inpaint_full_res_padding", 0)
+    p.inpainting_fill = payload.get("inpainting_fill", 1)
+    p.init_images = [decode_image(payload["init_images"][0]).convert("RGB")]
+    return p
+
+
+def create_handler(backend):
+    # The subset of webui's API that WebUIAPIBackend uses: img2img with one init image and mask, and
+    # the options it reads the model from. Requests are handled one at a time, like a GPU would.
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, body, status=200):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/sdapi/v1/options":
+                return self.reply({"detail": "Not Found"}, 404)
+            self.reply({"sd_model_checkpoint": backend.model_hash()})
+
+        def do_POST(self):
+            if self.path != "/sdapi/v1/img2img":
+                return self.reply({"detail": "Not Found"}, 404)
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            p = create_processing(payload)
+            p.seed = [p.seed]
+            p.subseed = [p.subseed]
+            with lock:
+                processed = backend.process(p, [decode_image(payload["mask"])])
+            info = {"infotexts": [processed.infotext(p, 0)]}
+            self.reply({"images": [encode_image(processed.images[0])], "info": json.dumps(info)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog="gigadiffusion.worker", description="Serve a tile backend over webui's img2img API, for --workers.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--backend", choices=["stub", "diffusers"], default="stub")
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--device", default=None, help="e.g. cuda:1, one worker per GPU")
+    parser.add_argument("--stub-delay", type=float, default=0)
+    parser.add_argument("--upscaler", default="None")
+    return parser
+
+
+def serve(backend, host="127.0.0.1", port=7861):
+    server = ThreadingHTTPServer((host, port), create_handler(backend))
+    print(f"Serving tiles on http://{host}:{server.server_address[1]}")
+    return server
+
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    server = serve(create_backend(args), args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,670 +1,155 @@
-import math
-import random
+import contextlib
+import copy
+import functools
+import inspect
+import os
+import numpy as np
 import gradio as gr
-from PIL import Image, ImageDraw, ImageFont, ImageOps
-from modules import processing, shared, images, devices, scripts
-from modules.processing import StableDiffusionProcessing
+from PIL import Image, ImageChops, ImageFilter
+from modules import processing, shared, images, devices, scripts, masking
 from modules.processing import Processed
 from modules.shared import opts, state
-from enum import Enum
+from gigadiffusion.backends import ProcessedTiles, TileInpaintBackend, WebUIAPIBackend
+from gigadiffusion.multi import run_many
+from gigadiffusion.pipeline import calc_target_size, run
+from gigadiffusion.tune import auto_tune
+
+class WebUIBackend(TileInpaintBackend):
+    # Runs the pipeline inside AUTOMATIC1111 webui: tiles go through processing.process_images on the
+    # p webui handed to Script.run, upscaling uses the selected webui upscaler.
+    # Webui upscalers mostly run models on the GPU, one tile at a time.
+    upscale_thread_safe = False
+
+    def __init__(self, upscaler_index:int) -> None:
+        self.upscaler = shared.sd_upscalers[upscaler_index]
+        self.upscaler_name = self.upscaler.name
+        # Whether webui's img2img init sets the latent mask we swap per sample, checked on first use.
+        self.sample_masks = None
 
-class RectCalculator:
-    @staticmethod
-    def prefer_double_draw():
-        # Set true to inset the last tile in rows/cols such that it sees as much of the original image as possible.
-        # This also causes 2x the redraws in certain areas of the image, adjacent to seams, which is distracting. 
-        return True
-        
-    @staticmethod
-    def calc_row_seam_in_tile(tile_size, padding, width, height, xi, yi, cols, rows):
-        mask = RectCalculator.calc_tile(tile_size, padding, width, height, xi, yi, cols, rows) 
-        y_shift = math.floor(tile_size // 2)
-        return (mask[0], mask[1] + y_shift, mask[2], mask[3] + y_shift)
-    
-    @staticmethod
-    def calc_col_seam_in_tile(tile_size, padding, width, height, xi, yi, cols, rows):
-        mask = RectCalculator.calc_tile(tile_size, padding, width, height, xi, yi, cols, rows) 
-        x_shift = math.floor(tile_size // 2)
-        return (mask[0] + x_shift, mask[1], mask[2] + x_shift, mask[3])
+    def upscale(self, image, scale):
+        return self.upscaler.scaler.upscale(image, scale, self.upscaler.data_path)
 
-    @staticmethod
-    def calc_mask_in_tile(tile_size, padding, width, height, xi, yi, cols, rows):
-        start_x = 0
-        end_x = 0
-        if xi == 0:
-            start_x = 0
-            end_x = tile_size
-        elif xi == (cols - 1) and RectCalculator.prefer_double_draw():
-            mask_width = (width - (xi * tile_size))
-            tile_mask_width_difference = tile_size - mask_width
-            start_x = padding + tile_mask_width_difference
-            end_x = start_x + mask_width
-        else:
-            start_x = padding / 2
-            end_x = start_x + tile_size
-        
-        start_y = 0
-        end_y = 0
-        if yi == 0:
-            start_y = 0
-            end_y = tile_size
-        elif yi == (rows - 1) and RectCalculator.prefer_double_draw():
-            mask_height = (height - (yi * tile_size))
-            tile_mask_height_difference = tile_size - mask_height
-            start_y = padding + tile_mask_height_difference
-            end_y = start_y + mask_height
-        else:
-            start_y = padding // 2
-            end_y = start_y + tile_size
-        rect = math.floor(start_x), math.floor(start_y), math.floor(end_x), math.floor(end_y)
-        return rect
+    def model_hash(self):
+        return getattr(shared.sd_model, "sd_model_hash", None)
 
-    @staticmethod
-    def calc_tile(tile_size, padding, width, height, xi, yi, cols, rows):
-        start_x = 0
-        end_x = 0
-        if xi == 0:
-            start_x = 0
-            end_x = tile_size + padding
-        elif xi == (cols - 1) and RectCalculator.prefer_double_draw():
-            end_x = width
-            start_x = end_x - tile_size - padding
-        else:
-            start_x = tile_size * xi - (padding // 2)
-            end_x = start_x + padding + tile_size
-        
-        start_y = 0
-        end_y = 0
-        if yi == 0:
-            start_y = 0
-            end_y = tile_size + padding
-        elif yi == (rows - 1) and RectCalculator.prefer_double_draw():
-            end_y = height
-            start_y = end_y - tile_size - padding
-        else:
-            start_y = tile_size * yi - (padding // 2)
-            end_y = start_y + padding + tile_size
-        rect = math.floor(start_x), math.floor(start_y), math.floor(end_x), math.floor(end_y)
-        return rect
-
-
-class USDUJob():
-    def __init__(self) -> None:
-        self.mask_rect = None
-        self.tile_rects = []
-    def add(self, tile_rect, mask_rect) -> bool:
-        if len(self.tile_rects) > 0:
-            last_tile_rect = self.tile_rects[0]
-            width = tile_rect[2] - tile_rect[0]
-            last_width = last_tile_rect[2] - last_tile_rect[0]
-            height = tile_rect[3] - tile_rect[1]
-            last_height = last_tile_rect[3] - last_tile_rect[1]
-            if width != last_width or height != last_height:
-                return False
-        if self.mask_rect != None and self.mask_rect != mask_rect:
-            return False
-        self.tile_rects.append(tile_rect)
-        self.mask_rect = mask_rect
-        return True
-
-class USDUMode(Enum):
-    LINEAR = 0
-    CHESS = 1
-    NONE = 2
-
-class USDUSFMode(Enum):
-    NONE = 0
-    BAND_PASS = 1
-    HALF_TILE = 2
-    HALF_TILE_PLUS_INTERSECTIONS = 3
-
-class USDUpscaler():
-
-    def __init__(self, p, image, upscaler_index:int, save_redraw, save_seams_fix, tile_size) -> None:
-        self.p:StableDiffusionProcessing = p
-        self.image:Image = image
-        self.scale_factor = max(p.width, p.height) // max(image.width, image.height)
-        self.upscaler = shared.sd_upscalers[upscaler_index]
-        self.redraw = USDURedraw()
-        self.redraw.save = save_redraw
-        self.redraw.tile_size = tile_size
-        self.seams_fix = USDUSeamsFix()
-        self.seams_fix.save = save_seams_fix
-        self.seams_fix.tile_size = tile_size
-        self.initial_info = None
-        self.rows = math.ceil(self.p.height / tile_size)
-        self.cols = math.ceil(self.p.width / tile_size)
-        self.requested_batch_size = p.batch_size
-        
-    def get_factor(self, num):
-        # Its just return, don't need elif
-        if num == 1:
-            return 2
-        if num % 4 == 0:
-            return 4
-        if num % 3 == 0:
-            return 3
-        if num % 2 == 0:
-            return 2
-        return 0
-
-    def get_factors(self):
-        scales = []
-        current_scale = 1
-        current_scale_factor = self.get_factor(self.scale_factor)
-        while current_scale_factor == 0:
-            self.scale_factor += 1
-            current_scale_factor = self.get_factor(self.scale_factor)
-        while current_scale < self.scale_factor:
-            current_scale_factor = self.get_factor(self.scale_factor // current_scale)
-            scales.append(current_scale_factor)
-            current_scale = current_scale * current_scale_factor
-            if current_scale_factor == 0:
-                break
-        self.scales = enumerate(scales)
-
-    def upscale(self):
-        # Log info
-        print(f"Canvas size: {self.p.width}x{self.p.height}")
-        print(f"Image size: {self.image.width}x{self.image.height}")
-        print(f"Scale factor: {self.scale_factor}")
-        # Check upscaler is not empty
-        if self.upscaler.name == "None":
-            self.image = self.image.resize((self.p.width, self.p.height), resample=Image.LANCZOS)
-            return
-        # Get list with scale factors
-        self.get_factors()
-        # Upscaling image over all factors
-        for index, value in self.scales:
-            print(f"Upscaling iteration {index+1} with scale factor {value}")
-            self.image = self.upscaler.scaler.upscale(self.image, value, self.upscaler.data_path)
-        # Resize image to set values
-        self.image = self.image.resize((self.p.width, self.p.height), resample=Image.LANCZOS)
-
-    def setup_redraw(self, redraw_mode, padding, mask_blur):
-        self.redraw.upscaler = self
-        self.redraw.mode = USDUMode(redraw_mode)
-        self.redraw.enabled = self.redraw.mode != USDUMode.NONE
-        self.redraw.padding = padding
-        self.p.mask_blur = mask_blur
-
-    def setup_seams_fix(self, padding, denoise, mask_blur, width, mode):
-        self.seams_fix.padding = padding
-        self.seams_fix.denoise = denoise
-        self.seams_fix.mask_blur = mask_blur
-        self.seams_fix.width = width
-        self.seams_fix.mode = USDUSFMode(mode)
-        self.seams_fix.enabled = self.seams_fix.mode != USDUSFMode.NONE
-
-    def save_image(self):
-        images.save_image(self.image, self.p.outpath_samples, "", self.p.seed, self.p.prompt, opts.grid_format, info=self.initial_info, p=self.p)
-
-    def calc_jobs_count(self):
-        redraw_job_count = self.redraw.calc_jobs_count(self.image.width, self.image.height, self.rows, self.cols, self.requested_batch_size)
-        seams_job_count = self.seams_fix.calc_jobs_count(self.image.width, self.image.height, self.rows, self.cols, self.requested_batch_size)
-        redraw_step_count = math.ceil((self.p.denoising_strength + 0.001) * self.p.steps)
-        seams_step_count = math.ceil((self.seams_fix.denoise + 0.001) * self.p.steps)
-        print("expecting", redraw_step_count, "redraw steps &", seams_step_count, "seams steps")
-        state.job_count = redraw_job_count + math.ceil(seams_step_count / redraw_step_count * seams_job_count)
-
-    def print_info(self):
-        print(f"Tiles amount: {self.rows * self.cols}")
-        print(f"Grid: {self.rows}x{self.cols}")
-        print(f"Redraw enabled: {self.redraw.enabled}")
-        print(f"Seams fix mode: {self.seams_fix.mode.name}")
-
-    def add_extra_info(self):
-        self.p.extra_generation_params["Gigadiffusion upscaler"] = self.upscaler.name
-        self.p.extra_generation_params["Gigadiffusion redraw tile_size"] = self.redraw.tile_size
-        self.p.extra_generation_params["Gigadiffusion redraw mask_blur"] = self.p.mask_blur
-        self.p.extra_generation_params["Gigadiffusion redraw padding"] = self.redraw.padding
-
-    def process(self):
+    def interrupted(self) -> bool:
+        return state.interrupted
+
+    def begin(self):
         state.begin()
-        self.calc_jobs_count()
-        self.result_images = []
-        if self.redraw.enabled:
-            self.image = self.redraw.start(self.p, self.image, self.rows, self.cols)
-            self.initial_info = self.redraw.initial_info
-            self.result_images.append(self.image.copy())
-            if self.redraw.save:
-                self.save_image()
-        if state.interrupted:
-            if self.seams_fix.enabled:
-                print("interrupted before seams fix, won't save image")
-            state.end()
-        elif self.seams_fix.enabled:
-            self.image = self.seams_fix.start(self.p, self.image, self.rows, self.cols)
-            self.initial_info = self.seams_fix.initial_info
-            self.result_images.append(self.image)
-            if self.seams_fix.save:
-                self.save_image()
-            state.end()
-
-class USDURedraw():
-
-    def init_draw(self, p, width, height):
-        p.inpaint_full_res = True
-        p.inpaint_full_res_padding = self.padding
-        p.width = math.ceil((self.tile_size+self.padding) / 64) * 64
-        p.height = math.ceil((self.tile_size+self.padding) / 64) * 64
-        mask = Image.new("L", (width, height), "black")
-        draw = ImageDraw.Draw(mask)
-        return mask, draw
-
-    def linear_process(self, p, image, rows, cols):
-        for yi in range(rows):
-            for xi in range(cols):
-                if state.interrupted:
-                    break              
-                tile_rect = self.calc_tile(image.width, image.height, rows, cols, xi, yi)
-                cropped = image.crop(tile_rect)              
-                mask, draw = self.init_draw(p, cropped.width, cropped.height)
-                mask_rect = self.calc_mask_in_tile(xi, yi, image.width, image.height, cols, rows)
-                draw.rectangle(mask_rect, fill="white")
-                p.init_images = [cropped]
-                p.image_mask = mask
-                processed = processing.process_images(p)
-                if (len(processed.images) > 0):
-                    image.paste(processed.images[0], tile_rect)
-
-        p.width = image.width
-        p.height = image.height
-        self.initial_info = processed.infotext(p, 0)
-
-        return image
-    
-    def calc_mask_in_tile(self, xi, yi, width, height, cols, rows):
-        return RectCalculator.calc_mask_in_tile(self.tile_size, self.padding,  width, height, xi, yi, cols, rows)
-
-    def calc_tile(self, width, height, rows, cols, xi, yi):
-        return RectCalculator.calc_tile(self.tile_size, self.padding, width, height, xi, yi, cols, rows)
-
-    def calc_jobs_count(self, width, height, rows, cols, requested_batch_size):
-        if self.enabled != True:
-            return 0
-        if self.mode == USDUMode.LINEAR:
-            return rows * cols
-        if self.mode == USDUMode.CHESS:
-            self.chess_process_create_jobs(width, height, rows, cols, requested_batch_size)
-            return len(self.jobs)
-
-    def chess_process_create_jobs(self, width, height, rows, cols, requested_batch_size):
-        tiles = []
-        for yi in range(rows):
-            for xi in range(cols):
-                even_row = yi % 2 == 0
-                even_column = xi % 2 == 0
-                if (even_row and not even_column):
-                    continue
-                if (not even_row and even_column):
-                    continue
-                tiles.append((xi, yi))
-        for yi in range(rows):
-            for xi in range(cols):
-                even_row = yi % 2 == 0
-                even_column = xi % 2 == 0
-                if (even_row and even_column):
-                    continue
-                if (not even_row and not even_column):
-                    continue
-                tiles.append((xi, yi))
-        jobs = []
-        while(len(tiles) > 0):
-            batch_size = requested_batch_size
-            actual_batch_size = 0
-            job = USDUJob()
-            for pair_index in range(batch_size):
-                if pair_index >= len(tiles):
-                    break
-                pair = tiles[pair_index]
-                xi = pair[0]
-                yi = pair[1]
-                mask_rect = self.calc_mask_in_tile(xi, yi, width, height, cols, rows)
-                tile_rect = self.calc_tile(width, height, rows, cols, xi, yi)
-                if False == job.add(tile_rect, mask_rect):
-                    break
-                actual_batch_size += 1
-            tiles = tiles[actual_batch_size:]
-            if (len(job.tile_rects) > 0):
-                jobs.append(job)
-        self.jobs = jobs
-        print(len(self.jobs), "redraw chess jobs with max batch size", requested_batch_size)
-
-    def chess_process(self, p, image):
-        jobs = self.jobs
-        processed_count = 0
-        while(len(jobs) > 0):
-            if state.interrupted:
-                break
-            job = jobs.pop(0)
-            init_images = []
-            for index in range(len(job.tile_rects)):
-                init_images.append(image.crop(job.tile_rects[index]))
-            p.init_images = init_images
-            p.seed = random.randint(0, 1048576)
-            p.all_seeds = [random.randint(0, 1048576) for i in range(len(init_images))]; 
-            p.all_subseeds = [random.randint(0, 1048576) for i in range(len(init_images))];
-            tile_rect = job.tile_rects[0]
-            mask, draw = self.init_draw(p, tile_rect[2] - tile_rect[0],tile_rect[3] - tile_rect[1])
-            draw.rectangle(job.mask_rect, fill="white") 
-            p.image_mask = mask
-            p.batch_size = len(init_images)
-            processed = processing.process_images(p)
-            processed_count += len(processed.images)
-            for index in range(len(job.tile_rects)):
-                paste_image = processed.images[index]
-                tile_rect = job.tile_rects[index]
-                mask_rect = job.mask_rect
-                left = tile_rect[0] + mask_rect[0]
-                top = tile_rect[1] + mask_rect[1]
-                right = left + (mask_rect[2] - mask_rect[0])
-                bottom = top + (mask_rect[3] - mask_rect[1])
-                image.paste(paste_image,  tile_rect)
-        p.width = image.width
-        p.height = image.height
-        self.initial_info = processed.infotext(p, 0)
-
-        return image
-    
-    def start(self, p, image, rows, cols):
-        self.initial_info = None
-        if self.mode == USDUMode.LINEAR:
-            return self.linear_process(p, image, rows, cols)
-        if self.mode == USDUMode.CHESS:
-            return self.chess_process(p, image)
-
-class USDUSeamsFix():
-
-    def init_draw(self, p):
-        self.initial_info = None
-        p.width = math.ceil((self.tile_size+self.padding) / 64) * 64
-        p.height = math.ceil((self.tile_size+self.padding) / 64) * 64
-
-    def calc_jobs_count(self, width, height, rows, cols, requested_batch_size):
-        if self.enabled != True:
-            return 0;
-        seams_job_count = 0
-        if self.mode == USDUSFMode.BAND_PASS:
-            return self.rows + self.cols - 2
-        self.create_jobs(width, height, rows, cols, requested_batch_size)   
-        seams_job_count = len(self.row_jobs) + len(self.col_jobs) 
-        if self.mode == USDUSFMode.HALF_TILE_PLUS_INTERSECTIONS:
-            seams_job_count += (rows - 1) * (cols - 1)
-        return seams_job_count
-
-    def create_jobs(self, width, height, rows, cols, requested_batch_size):
-        row_jobs = []
-        row_tiles = []
-        for yi in range(rows - 1):
-            for xi in range(cols):
-                even_row = yi % 2 == 0
-                even_column = xi % 2 == 0
-                if (even_row and not even_column):
-                    continue
-                if (not even_row and even_column):
-                    continue
-                row_tiles.append((xi, yi))
-        for yi in range(rows - 1):
-            for xi in range(cols):
-                even_row = yi % 2 == 0
-                even_column = xi % 2 == 0
-                if (even_row and even_column):
-                    continue
-                if (not even_row and not even_column):
-                    continue
-                row_tiles.append((xi, yi))
-        print("processing", len(row_tiles), "row seams")
-
-        while(len(row_tiles) > 0):
-            batch_size = requested_batch_size
-            actual_batch_size = 0
-            job = USDUJob()
-            for pair_index in range(batch_size):
-                if pair_index >= len(row_tiles):
-                    break
-                pair = row_tiles[pair_index]
-                xi = pair[0]
-                yi = pair[1]
-                mask_rect = self.calc_mask_in_tile(xi, yi, width, height, cols, rows)
-                tile_rect = self.calc_row_gradient_tile(rows, cols, width, height, xi, yi)
-                if False == job.add(tile_rect, mask_rect):
-                    break
-                actual_batch_size += 1
-            row_tiles = row_tiles[actual_batch_size:]
-            if (len(job.tile_rects) > 0):
-                row_jobs.append(job)
-        self.row_jobs = row_jobs
-
-        col_jobs = []
-        col_tiles = []
-        for yi in range(rows):
-            for xi in range(cols - 1):
-                even_row = yi % 2 == 0
-                even_column = xi % 2 == 0
-                if (even_row and not even_column):
-                    continue
-                if (not even_row and even_column):
-                    continue
-                col_tiles.append((xi, yi))
-        for yi in range(rows):
-            for xi in range(cols - 1):
-                even_row = yi % 2 == 0
-                even_column = xi % 2 == 0
-                if (even_row and even_column):
-                    continue
-                if (not even_row and not even_column):
-                    continue
-                col_tiles.append((xi, yi))
-        print("processing", len(col_tiles), "column seams")
-         
-        while(len(col_tiles) > 0):
-            batch_size = requested_batch_size
-            actual_batch_size = 0
-            job = USDUJob()
-            for pair_index in range(batch_size):
-                if pair_index >= len(col_tiles):
-                    break
-                pair = col_tiles[pair_index]
-                xi = pair[0]
-                yi = pair[1]
-                mask_rect = self.calc_mask_in_tile(xi, yi, width, height, cols, rows)
-                tile_rect = self.calc_col_gradient_tile(rows, cols, width, height, xi, yi)
-                if False == job.add(tile_rect, mask_rect):
-                    break
-                actual_batch_size += 1
-            col_tiles = col_tiles[actual_batch_size:]
-            if (len(job.tile_rects) > 0):
-                col_jobs.append(job)
-        self.col_jobs = col_jobs
-        print(len(self.col_jobs) + len(self.row_jobs), "seams fix jobs with max batch size", requested_batch_size)
-
-        
-    def calc_mask_in_tile(self, xi, yi,width, height,  cols, rows):
-        return RectCalculator.calc_mask_in_tile(self.tile_size, self.padding,  width, height, xi,yi, cols, rows)
-
-    def calc_row_gradient_tile(self, rows, cols, width, height, xi, yi):
-        return RectCalculator.calc_row_seam_in_tile(self.tile_size, self.padding, width, height, xi, yi, cols, rows)
-
-    def calc_col_gradient_tile(self, rows, cols, width, height, xi, yi):
-        return RectCalculator.calc_col_seam_in_tile(self.tile_size, self.padding, width, height, xi, yi, cols, rows)
-       
-    def half_tile_process(self, p, image, rows, cols):
-        self.init_draw(p)
-        processed = None
-
-        gradient = Image.linear_gradient("L")
-        row_gradient = Image.new("L", (self.tile_size, self.tile_size), "black")
-        row_gradient.paste(gradient.resize(
-            (self.tile_size, self.tile_size//2), resample=Image.BICUBIC), (0, 0))
-        row_gradient.paste(gradient.rotate(180).resize(
-                (self.tile_size, self.tile_size//2), resample=Image.BICUBIC), 
-                (0, self.tile_size//2))
-        col_gradient = Image.new("L", (self.tile_size, self.tile_size), "black")
-        col_gradient.paste(gradient.rotate(90).resize(
-            (self.tile_size//2, self.tile_size), resample=Image.BICUBIC), (0, 0))
-        col_gradient.paste(gradient.rotate(270).resize(
-            (self.tile_size//2, self.tile_size), resample=Image.BICUBIC), (self.tile_size//2, 0))
-
-        p.denoising_strength = self.denoise
-        p.mask_blur = self.mask_blur
-
-        processed_count = 0
-        jobs = self.row_jobs
-        while(len(jobs) > 0):
-            if state.interrupted:
-                break
-            job = jobs.pop(0)
-            init_images = []
-            for index in range(len(job.tile_rects)):
-                init_images.append(image.crop(job.tile_rects[index]))
-            p.width = self.tile_size
-            p.height = self.tile_size
-            p.inpaint_full_res = True
-            p.inpaint_full_res_padding = self.padding
-            p.seed = random.randint(0, 1048576)
-            p.all_seeds = [random.randint(0, 1048576) for i in range(len(init_images))]; 
-            p.all_subseeds = [random.randint(0, 1048576) for i in range(len(init_images))];
-            p.init_images = init_images   
-            p.batch_size = len(init_images)
-            
-            tile_width = job.tile_rects[0][2] - job.tile_rects[0][0]
-            tile_height = job.tile_rects[0][3] - job.tile_rects[0][1]
-            mask = Image.new("RGB", (tile_width, tile_height), "black")
-            mask.paste(row_gradient, (job.mask_rect[0],job.mask_rect[1]))
-            p.image_mask = mask
-            processed = processing.process_images(p)
-            processed_count += len(processed.images)
-            for index in range(len(job.tile_rects)):
-                image.paste(processed.images[index], job.tile_rects[index])    
-        jobs = self.col_jobs
-        while(len(jobs) > 0):
-            if state.interrupted:
-                break
-            job = jobs.pop(0)
-            init_images = []
-            for index in range(len(job.tile_rects)):
-                init_images.append(image.crop(job.tile_rects[index]))
-            p.width = self.tile_size
-            p.height = self.tile_size
-            p.inpaint_full_res = True
-            p.inpaint_full_res_padding = self.padding
-            p.seed = random.randint(0, 1048576)
-            p.all_seeds = [random.randint(0, 1048576) for i in range(len(init_images))]; 
-            p.all_subseeds = [random.randint(0, 1048576) for i in range(len(init_images))];
-            p.init_images = init_images   
-            p.batch_size = len(init_images)
-            tile_width = job.tile_rects[0][2] - job.tile_rects[0][0]
-            tile_height = job.tile_rects[0][3] - job.tile_rects[0][1]
-            mask = Image.new("RGB", (tile_width, tile_height), "black")
-            mask.paste(col_gradient, (job.mask_rect[0],job.mask_rect[1]))
-            p.image_mask = mask
-            processed = processing.process_images(p)
-            processed_count += len(processed.images)
-            for index in range(len(job.tile_rects)):
-                image.paste(processed.images[index], job.tile_rects[index])    
-    
-        p.width = image.width
-        p.height = image.height
-        self.initial_info = processed.infotext(p, 0)
-        return image
-
-    def half_tile_process_corners(self, p, image, rows, cols):
-        fixed_image = self.half_tile_process(p, image, rows, cols)
-        processed = None
-        self.init_draw(p)
-        gradient = Image.radial_gradient("L").resize(
-            (self.tile_size, self.tile_size), resample=Image.BICUBIC)
-        gradient = ImageOps.invert(gradient)
-        p.denoising_strength = self.denoise
-        p.mask_blur = self.mask_blur
-
-        for yi in range(rows-1):
-            for xi in range(cols-1):
-                if state.interrupted:
-                    break
-                p.width = self.tile_size
-                p.height = self.tile_size
-                p.inpaint_full_res = True
-                p.inpaint_full_res_padding = 0
-                mask = Image.new("L", (fixed_image.width, fixed_image.height), "black")
-                mask.paste(gradient, (xi*self.tile_size + self.tile_size//2,
-                                      yi*self.tile_size + self.tile_size//2))
-                p.init_images = [fixed_image]
-                p.image_mask = mask
-                processed = processing.process_images(p)
-                if (len(processed.images) > 0):
-                    fixed_image = processed.images[0]
-
-        p.width = fixed_image.width
-        p.height = fixed_image.height
-        if processed is not None:
-            self.initial_info = processed.infotext(p, 0)
-
-        return fixed_image
-
-    def band_pass_process(self, p, image, cols, rows):
-        self.init_draw(p)
-        processed = None
-
-        p.denoising_strength = self.denoise
-        p.mask_blur = 0
-
-        gradient = Image.linear_gradient("L")
-        mirror_gradient = Image.new("L", (256, 256), "black")
-        mirror_gradient.paste(gradient.resize((256, 128), resample=Image.BICUBIC), (0, 0))
-        mirror_gradient.paste(gradient.rotate(180).resize((256, 128), resample=Image.BICUBIC), (0, 128))
-
-        row_gradient = mirror_gradient.resize((image.width, self.width), resample=Image.BICUBIC)
-        col_gradient = mirror_gradient.rotate(90).resize((self.width, image.height), resample=Image.BICUBIC)
-
-        for xi in range(1, cols):
-            if state.interrupted:
-                    break
-            p.width = self.width + self.padding * 2
-            p.height = image.height
-            p.inpaint_full_res = True
-            p.inpaint_full_res_padding = self.padding
-            mask = Image.new("L", (image.width, image.height), "black")
-            mask.paste(col_gradient, (xi * self.tile_size -self.padding, 0))
-
-            p.init_images = [image]
-            p.image_mask = mask
-            processed = processing.process_images(p)
-            if (len(processed.images) > 0):
-                image = processed.images[0]
-        for yi in range(1, rows):
-            if state.interrupted:
-                    break
-            p.width = image.width
-            p.height = self.width + self.padding * 2
-            p.inpaint_full_res = True
-            p.inpaint_full_res_padding = self.padding
-            mask = Image.new("L", (image.width, image.height), "black")
-            mask.paste(row_gradient, (0, yi * self.tile_size - self.padding))
-
-            p.init_images = [image]
-            p.image_mask = mask
+
+    def end(self):
+        state.end()
+
+    def set_job_count(self, job_count):
+        state.job_count = job_count
+
+    def save_image(self, image, p, seed, info):
+        images.save_image(image, p.outpath_samples, "", seed, p.prompt, opts.grid_format, info=info, p=p)
+
+    def supports_sample_masks(self, p):
+        # The per-sample latent mask replaces the p.mask and p.nmask webui's img2img init sets. Webui
+        # versions or forks whose init keeps the latent mask elsewhere run one mask per batch instead.
+        if self.sample_masks is None:
+            try:
+                source = inspect.getsource(type(p).init)
+            except (OSError, TypeError):
+                source = ""
+            self.sample_masks = "self.mask =" in source and "self.nmask =" in source
+            if not self.sample_masks:
+                print("Gigadiffusion: this webui sets no img2img latent mask to swap, batches run one mask each")
+        return self.sample_masks
+
+    @staticmethod
+    def crop_region(p, mask):
+        # Region inpaint_full_res crops around mask alone, None when webui uses the whole image.
+        if not p.inpaint_full_res:
+            return None
+        region = masking.get_crop_region(np.array(mask), p.inpaint_full_res_padding)
+        return tuple(masking.expand_crop_region(region, p.width, p.height, mask.width, mask.height))
+
+    def process(self, p, masks):
+        # Run p.init_images as batches where sample i is inpainted with masks[i]. Samples go to webui
+        # in groups whose masks get the same crop region, so the union mask of a group crops exactly
+        # the context each sample would get alone. Where webui doesn't support per-sample latent masks,
+        # groups are split further by mask.
+        blurred = [mask.convert("L") for mask in masks]
+        if p.mask_blur > 0:
+            blurred = [mask.filter(ImageFilter.GaussianBlur(p.mask_blur)) for mask in blurred]
+        groups = {}
+        for index, mask in enumerate(blurred):
+            key = self.crop_region(p, mask)
+            if not self.supports_sample_masks(p):
+                key = (key, masks[index].convert("L").tobytes())
+            groups.setdefault(key, []).append(index)
+        if len(groups) == 1:
+            return self.process_group(p, masks, blurred)
+
+        init_images, seeds, subseeds = list(p.init_images), list(p.seed), list(p.subseed)
+        results = [None] * len(init_images)
+        infotexts = [None] * len(init_images)
+        for indexes in groups.values():
+            p.init_images = [init_images[index] for index in indexes]
+            p.seed = [seeds[index] for index in indexes]
+            p.subseed = [subseeds[index] for index in indexes]
+            p.batch_size = len(indexes)
+            processed = self.process_group(p, [masks[index] for index in indexes], [blurred[index] for index in indexes])
+            for batch_index, index in enumerate(indexes[:len(processed.images)]):
+                results[index] = processed.images[batch_index]
+                infotexts[index] = processed.infotext(p, batch_index)
+        p.init_images, p.seed, p.subseed = init_images, seeds, subseeds
+        p.batch_size = len(init_images)
+        return ProcessedTiles(results, infotexts)
+
+    def process_group(self, p, masks, blurred):
+        # One webui batch. When masks differ, webui gets their union, the latent mask is swapped for a
+        # per-sample one after p.init, and each output is composited with its own mask.
+        first = masks[0].convert("L")
+        if all(mask.convert("L").tobytes() == first.tobytes() for mask in masks[1:]):
+            p.image_mask = masks[0]
+            return processing.process_images(p)
+
+        union = first
+        for mask in masks[1:]:
+            union = ImageChops.lighter(union, mask.convert("L"))
+        init_images = list(p.init_images)
+
+        original_init = p.init
+        def init_with_sample_masks(*args, **kwargs):
+            original_init(*args, **kwargs)
+            if getattr(p, "mask", None) is None or getattr(p, "nmask", None) is None:
+                # Every sample is still composited with its own mask below; later batches split by mask.
+                self.sample_masks = False
+                return
+            import torch
+            latent_height, latent_width = p.mask.shape[-2], p.mask.shape[-1]
+            crop_region = None
+            if getattr(p, "paste_to", None) is not None:
+                x1, y1, w, h = p.paste_to
+                crop_region = (x1, y1, x1 + w, y1 + h)
+            latmasks = []
+            for mask in blurred:
+                if crop_region is not None:
+                    mask = mask.crop(crop_region)
+                mask = mask.resize((latent_width, latent_height), resample=Image.LANCZOS)
+                latmask = np.array(mask, dtype=np.float32) / 255
+                if getattr(p, "mask_round", True):
+                    latmask = np.around(latmask)
+                latmasks.append(np.tile(latmask[None], (p.mask.shape[-3], 1, 1)))
+            latmask = torch.asarray(np.stack(latmasks)).to(device=p.mask.device, dtype=p.mask.dtype)
+            p.mask = 1.0 - latmask
+            p.nmask = latmask
+
+        p.image_mask = union
+        p.init = init_with_sample_masks
+        try:
             processed = processing.process_images(p)
-            if (len(processed.images) > 0):
-                image = processed.images[0]
-
-        p.width = image.width
-        p.height = image.height
-        if processed is not None:
-            self.initial_info = processed.infotext(p, 0)
-
-        return image
-
-    def start(self, p, image, rows, cols):
-        if USDUSFMode(self.mode) == USDUSFMode.BAND_PASS:
-            return self.band_pass_process(p, image, rows, cols)
-        elif USDUSFMode(self.mode) == USDUSFMode.HALF_TILE:
-            return self.half_tile_process(p, image, rows, cols)
-        elif USDUSFMode(self.mode) == USDUSFMode.HALF_TILE_PLUS_INTERSECTIONS:
-            return self.half_tile_process_corners(p, image, rows, cols)
-        else:
-            return image
+        finally:
+            p.init = original_init
+        for index in range(min(len(processed.images), len(init_images))):
+            init_image = init_images[index].convert("RGB")
+            processed.images[index] = Image.composite(processed.images[index].convert("RGB"), init_image, blurred[index])
+        return processed
 
 class Script(scripts.Script):
     def title(self):
@@ -693,6 +178,12 @@ class Script(scripts.Script):
             "None"
         ]
 
+        flat_tile_modes = [
+            "Redraw",
+            "Skip",
+            "Lower denoise"
+        ]
+
         with gr.Row():
             target_size_type = gr.Dropdown(label="Size", choices=[k for k in target_size_types], type="index",
                                   value=target_size_types[2])
@@ -718,6 +209,38 @@ class Script(scripts.Script):
         with gr.Row():
             save_upscaled_image = gr.Checkbox(label="Save Redraw", value=True)
             save_seams_fix_image = gr.Checkbox(label="Save Deseam", value=True)
+            disk_canvas = gr.Checkbox(label="Disk-backed canvas (gigapixel)", value=False)
+            stream_output = gr.Checkbox(label="Stream Deep Zoom output", value=False)
+        with gr.Row():
+            checkpoint_dir = gr.Textbox(label="Checkpoint directory", value="", placeholder="leave empty to disable checkpoints")
+            checkpoint_every = gr.Slider(label="Checkpoint every N jobs", minimum=1, maximum=64, step=1, value=8)
+            resume = gr.Checkbox(label="Resume from checkpoint", value=False)
+        with gr.Row():
+            cache_dir = gr.Textbox(label="Tile cache directory", value="", placeholder="leave empty to disable the tile cache")
+            cache_size = gr.Slider(label="Tile cache size (MB)", minimum=256, maximum=65536, step=256, value=4096)
+            upscale_cache_dir = gr.Textbox(label="Upscale cache directory", value="", placeholder="leave empty to disable the upscale cache")
+        with gr.Row():
+            metrics_path = gr.Textbox(label="Timing log", value="", placeholder="path ending in .jsonl or .prom, leave empty to only print a summary")
+            prefetch = gr.Slider(label="Prepare jobs ahead", minimum=0, maximum=8, step=1, value=2)
+        with gr.Row():
+            flat_tiles = gr.Dropdown(label="Flat tiles", choices=[k for k in flat_tile_modes], type="index", value=flat_tile_modes[0])
+            detail_threshold = gr.Slider(label="Flat below detail", minimum=0, maximum=20, step=0.1, value=2)
+            flat_denoise_scale = gr.Slider(label="Flat tiles denoise scale", minimum=0, maximum=1, step=0.01, value=0.5)
+            quadtree_levels = gr.Slider(label="Merge flat tiles (quadtree levels)", minimum=0, maximum=3, step=1, value=0)
+            seam_threshold = gr.Slider(label="Deseam only seams above (0 = all)", minimum=0, maximum=5, step=0.1, value=0)
+        with gr.Row():
+            workers = gr.Textbox(label="Extra workers", value="", placeholder="API URLs of other webui instances started with --api, comma separated")
+        with gr.Row():
+            input_dir = gr.Textbox(label="Batch input folder", value="", placeholder="also upscale every image in this folder")
+            images_at_once = gr.Slider(label="Images at once (shared batches)", minimum=1, maximum=16, step=1, value=4)
+        with gr.Row():
+            vram_budget = gr.Slider(label="Auto tile size: VRAM budget (MB, 0 = off, tile size is the largest tried)", minimum=0, maximum=81920, step=512, value=0)
+            ram_budget = gr.Slider(label="Auto tile size: RAM budget (MB, 0 = unlimited)", minimum=0, maximum=262144, step=1024, value=0)
+        with gr.Row():
+            region_mode = gr.Checkbox(label="Re-render a region of a finished image (inpaint mask or rect)", value=False)
+            region_rect = gr.Textbox(label="Region rect", value="", placeholder="left, top, right, bottom in output pixels, used without an inpaint mask")
+            wavefront = gr.Checkbox(label="Wavefront: deseam while redrawing (Chess + Half tile, no Save Redraw)", value=False)
+            seam_coloring = gr.Checkbox(label="Pack non-overlapping seams into shared batches when it saves calls (Half tile)", value=False)
 
         def select_fix_type(fix_index):
             all_visible = fix_index != 0
@@ -751,11 +274,17 @@ class Script(scripts.Script):
         )
         return [tile_size, redraw_blur, padding, seams_fix_width, seams_fix_denoise, seams_fix_padding,
                 upscaler_index, save_upscaled_image, redraw_mode, save_seams_fix_image, seams_blur, 
-                seams_fix_type, target_size_type, custom_width, custom_height, custom_scale]
+                seams_fix_type, target_size_type, custom_width, custom_height, custom_scale, disk_canvas, stream_output,
+                checkpoint_dir, checkpoint_every, resume, cache_dir, cache_size, metrics_path, prefetch, upscale_cache_dir,
+                flat_tiles, detail_threshold, flat_denoise_scale, quadtree_levels, seam_threshold, workers,
+                input_dir, images_at_once, vram_budget, ram_budget, region_mode, region_rect, wavefront, seam_coloring]
 
     def run(self, p, tile_size, redraw_blur, padding, seams_fix_width, seams_fix_denoise, seams_fix_padding, 
             upscaler_index, save_upscaled_image, redraw_mode, save_seams_fix_image, seams_blur, 
-            seams_fix_type, target_size_type, custom_width, custom_height, custom_scale):
+            seams_fix_type, target_size_type, custom_width, custom_height, custom_scale, disk_canvas=False, stream_output=False,
+            checkpoint_dir="", checkpoint_every=8, resume=False, cache_dir="", cache_size=4096, metrics_path="", prefetch=2, upscale_cache_dir="",
+            flat_tiles=0, detail_threshold=2, flat_denoise_scale=0.5, quadtree_levels=0, seam_threshold=0, workers="",
+            input_dir="", images_at_once=4, vram_budget=0, ram_budget=0, region_mode=False, region_rect="", wavefront=False, seam_coloring=False):
 
         # Init
         processing.fix_seed(p)
@@ -768,30 +297,83 @@ class Script(scripts.Script):
 
         seed = p.seed
 
-        # Init image
-        init_img = p.init_images[0]
-        if init_img == None:
+        # Init images, and image files from input_dir, which are only loaded when their turn comes
+        sources = [image for image in p.init_images if image is not None]
+        if input_dir:
+            sources += [os.path.join(input_dir, name) for name in sorted(os.listdir(input_dir))
+                        if name.lower().endswith((".png", ".jpg", ".jpeg", ".webp", ".bmp")) and os.path.isfile(os.path.join(input_dir, name))]
+        if len(sources) == 0:
             return Processed(p, [], seed, "Empty image")
-        init_img = images.flatten(init_img, opts.img2img_background_color)
+
+        def opened(source):
+            # Files are opened for their header only, the pixels are read by load().
+            return Image.open(source) if isinstance(source, str) else contextlib.nullcontext(source)
+
+        def load(source):
+            with opened(source) as image:
+                return images.flatten(image, opts.img2img_background_color)
+
+        settings = dict(tile_size=tile_size, padding=padding,
+                        redraw_mode=redraw_mode, redraw_blur=redraw_blur, seams_fix_type=seams_fix_type,
+                        seams_fix_width=seams_fix_width, seams_fix_denoise=seams_fix_denoise,
+                        seams_fix_padding=seams_fix_padding, seams_blur=seams_blur,
+                        save_redraw=save_upscaled_image, save_seams_fix=save_seams_fix_image,
+                        disk_canvas=disk_canvas, stream_output=stream_output, checkpoint_dir=checkpoint_dir,
+                        checkpoint_every=checkpoint_every, resume=resume, cache_dir=cache_dir, cache_size=cache_size,
+                        metrics_path=metrics_path, prefetch=prefetch,
+                        upscale_cache_dir=upscale_cache_dir, flat_tiles=flat_tiles,
+                        detail_threshold=detail_threshold, flat_denoise_scale=flat_denoise_scale,
+                        quadtree_levels=quadtree_levels, seam_threshold=seam_threshold,
+                        workers=[WebUIAPIBackend(url.strip()) for url in workers.split(",") if url.strip()],
+                        wavefront=wavefront, seam_coloring=seam_coloring)
+
+        # Region mode: init images are finished outputs, only the tiles and seams around the region are redone
+        if region_mode:
+            if getattr(p, "image_mask", None) is not None:
+                settings["region"] = p.image_mask
+            elif region_rect.strip():
+                settings["region"] = tuple(int(value) for value in region_rect.split(","))
+            else:
+                return Processed(p, [], seed, "Region mode needs an inpaint mask or a region rect")
 
         #override size
-        if target_size_type == 1:
-            p.width = custom_width
-            p.height = custom_height
-        if target_size_type == 2:
-            p.width = math.ceil((init_img.width * custom_scale) / 64) * 64
-            p.height = math.ceil((init_img.height * custom_scale) / 64) * 64
-        print("Target size type ", target_size_type, " thus tile width and height are", p.width, p.height)
-        # Upscaling
-        upscaler = USDUpscaler(p, init_img, upscaler_index, save_upscaled_image, save_seams_fix_image, tile_size)
-        upscaler.upscale()
-        
-        # Drawing
-        upscaler.setup_redraw(redraw_mode, padding, redraw_blur)
-        upscaler.setup_seams_fix(seams_fix_padding, seams_fix_denoise, seams_blur, seams_fix_width, seams_fix_type)
-        upscaler.print_info()
-        upscaler.add_extra_info()
-        upscaler.process()
-        result_images = upscaler.result_images
-
-        return Processed(p, result_images, seed, upscaler.initial_info if upscaler.initial_info is not None else "")
+        def target_size(init_img):
+            if target_size_type == 1:
+                return custom_width, custom_height
+            if target_size_type == 2:
+                return calc_target_size(init_img.width, init_img.height, custom_scale)
+            return p.width, p.height
+
+        # Tile size, padding and batch size picked per image to fit the budgets
+        def tuned_settings(image_p, init_img):
+            if vram_budget <= 0:
+                return {}
+            tuned, _ = auto_tune(image_p, init_img, vram_budget, ram_budget, **settings)
+            return tuned
+
+        if len(sources) == 1:
+            init_img = load(sources[0])
+            p.width, p.height = target_size(init_img)
+            print("Target size type ", target_size_type, " thus tile width and height are", p.width, p.height)
+            # Upscaling, redraw and seams fix
+            upscaler = run(WebUIBackend(upscaler_index), p, init_img, **{**settings, **tuned_settings(p, init_img)})
+            result_images = upscaler.result_images
+            return Processed(p, result_images, seed, upscaler.initial_info if upscaler.initial_info is not None else "")
+
+        # Several images: each gets its own p and seed, their tiles share batches of p.batch_size.
+        items = []
+        for index, source in enumerate(sources):
+            image_p = copy.copy(p)
+            image_p.init_images = []
+            image_p.extra_generation_params = dict(p.extra_generation_params)
+            image_p.seed = seed + index
+            overrides = {"checkpoint_dir": os.path.join(checkpoint_dir, f"{index:05}")} if checkpoint_dir else {}
+            with opened(source) as init_img:
+                image_p.width, image_p.height = target_size(init_img)
+                overrides.update(tuned_settings(image_p, init_img))
+            items.append((image_p, functools.partial(load, source), overrides))
+        print(f"Upscaling {len(items)} images, {images_at_once} at once")
+        upscalers = run_many(WebUIBackend(upscaler_index), items, images_at_once=images_at_once, **settings)
+        result_images = [image for upscaler in upscalers if upscaler is not None for image in upscaler.result_images]
+        infos = [upscaler.initial_info for upscaler in upscalers if upscaler is not None and upscaler.initial_info is not None]
+        return Processed(p, result_images, seed, infos[0] if len(infos) > 0 else "")
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from PIL import Image
+from gigadiffusion.backends import ProcessedTiles, StubBackend
+
+
+class SeededBackend(StubBackend):
+    # Changes every tile by a value derived from its pixels, seed, denoise and processing width, inside
+    # its mask, so outputs depend on the order tiles run in and on what each one reads.
+    def __init__(self) -> None:
+        super().__init__("Lanczos")
+        self.samples = 0
+
+    def process(self, p, masks):
+        self.calls += 1
+        self.samples += len(masks)
+        images = []
+        for image, mask, seed in zip(p.init_images, masks, p.seed):
+            pixels = np.asarray(image).astype(np.int64)
+            value = (pixels.sum() // 997 + seed + int(p.denoising_strength * 100) + p.width) % 256
+            filled = Image.fromarray((pixels // 2 + value // 2).astype(np.uint8))
+            images.append(Image.composite(filled, image, mask.convert("L")))
+        return ProcessedTiles(images, [None] * len(masks))
+
+    def save_image(self, image, p, seed, info):
+        pass
+
+
+@pytest.fixture
+def seeded_backend():
+    return SeededBackend
+
+
+@pytest.fixture
+def source():
+    # Noise with one flat area, so flat tile handling has something to find.
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 255, (300, 420, 3), dtype=np.uint8))
+    image.paste((90, 90, 90), (0, 0, 200, 150))
+    return image
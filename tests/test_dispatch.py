@@ -0,0 +1,65 @@
+import contextlib
+import io
+import threading
+import time
+import numpy as np
+import pytest
+from gigadiffusion.backends import Processing, WebUIAPIBackend
+from gigadiffusion.pipeline import run
+from gigadiffusion.worker import serve
+
+
+@pytest.fixture
+def timed_backend(seeded_backend):
+    # Every call any backend makes, as (start, end, denoise), on one clock.
+    log = []
+    lock = threading.Lock()
+
+    class TimedBackend(seeded_backend):
+        def process(self, p, masks):
+            start = time.perf_counter()
+            processed = super().process(p, masks)
+            with lock:
+                log.append((start, time.perf_counter(), p.denoising_strength))
+            return processed
+
+    return TimedBackend, log
+
+
+@pytest.fixture
+def workers(timed_backend):
+    backend, _ = timed_backend
+    backends = [backend() for _ in range(2)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        servers = [serve(worker, port=0) for worker in backends]
+    threads = [threading.Thread(target=server.serve_forever, daemon=True) for server in servers]
+    for thread in threads:
+        thread.start()
+    yield backends, [f"http://127.0.0.1:{server.server_address[1]}" for server in servers]
+    for server, thread in zip(servers, threads):
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def render(backend, source, batch_size, **settings):
+    p = Processing(1680, 1200, denoising_strength=0.6, batch_size=batch_size, seed=3)
+    with contextlib.redirect_stdout(io.StringIO()):
+        upscaler = run(backend, p, source, tile_size=256, redraw_mode=1, seams_fix_denoise=0.45, save_redraw=False, save_seams_fix=False, **settings)
+    return np.asarray(upscaler.image)
+
+
+@pytest.mark.parametrize("seams_fix_type,batch_size", [(2, 1), (3, 3)])
+def test_dispatch_matches_serial(timed_backend, workers, source, seams_fix_type, batch_size):
+    backend, log = timed_backend
+    serial = render(backend(), source, batch_size, seams_fix_type=seams_fix_type)
+    log.clear()
+    remote, urls = workers
+    dispatched = render(backend(), source, batch_size, seams_fix_type=seams_fix_type, workers=[WebUIAPIBackend(url) for url in urls])
+    assert np.array_equal(serial, dispatched)
+    assert all(worker.calls > 0 for worker in remote)
+    # The seams fix starts only once every redraw tile is back, wherever it ran.
+    redraw = [call for call in log if call[2] == 0.6]
+    seams = [call for call in log if call[2] == 0.45]
+    assert len(redraw) > 0 and len(seams) > 0
+    assert max(end for _, end, _ in redraw) <= min(start for start, _, _ in seams)
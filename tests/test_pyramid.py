@@ -0,0 +1,31 @@
+import os
+import numpy as np
+from PIL import Image
+from gigadiffusion.pyramid import DeepZoomWriter
+
+
+def read_tiles(writer):
+    tiles = {}
+    for level in range(writer.max_level + 1):
+        folder = os.path.join(writer.files_path, str(level))
+        for name in os.listdir(folder):
+            with Image.open(os.path.join(folder, name)) as tile:
+                tiles[(level, name)] = np.asarray(tile.convert("RGB"))
+    return tiles
+
+
+def test_streamed_pyramid_matches_one_built_from_the_final_canvas(tmp_path):
+    canvas = Image.fromarray(np.random.default_rng(0).integers(0, 255, (700, 1000, 3), dtype=np.uint8))
+    streamed = DeepZoomWriter(canvas, str(tmp_path / "streamed"), tile_size=64, format="png")
+    streamed.flush(write_missing=True)
+    # Only full resolution tile (2, 2) holds this paste, but parent (0, 0) stitches its first columns too.
+    rect = (129, 129, 190, 190)
+    canvas.paste((255, 0, 0), rect)
+    streamed.update(rect)
+    streamed.close()
+    rebuilt = DeepZoomWriter(canvas, str(tmp_path / "rebuilt"), tile_size=64, format="png")
+    rebuilt.close()
+    streamed_tiles, rebuilt_tiles = read_tiles(streamed), read_tiles(rebuilt)
+    assert streamed_tiles.keys() == rebuilt_tiles.keys()
+    for key, tile in rebuilt_tiles.items():
+        assert np.array_equal(streamed_tiles[key], tile), key
@@ -0,0 +1,24 @@
+import contextlib
+import io
+import numpy as np
+import pytest
+from PIL import Image
+from gigadiffusion.backends import Processing
+from gigadiffusion.pipeline import dry_run, run
+
+
+@pytest.mark.parametrize("seams_fix_type", [1, 2, 3])
+@pytest.mark.parametrize("redraw_mode", [0, 1])
+def test_region_keeps_pixels_away_from_it(seeded_backend, seams_fix_type, redraw_mode):
+    previous = Image.fromarray(np.random.default_rng(1).integers(0, 255, (1216, 1600, 3), dtype=np.uint8))
+    settings = dict(tile_size=256, redraw_mode=redraw_mode, seams_fix_type=seams_fix_type, region=(600, 300, 660, 360))
+    backend = seeded_backend()
+    with contextlib.redirect_stdout(io.StringIO()):
+        image = run(backend, Processing(1, 1, batch_size=2, seed=3), previous.copy(), save_redraw=False, save_seams_fix=False, **settings).image
+        plan = dry_run(Processing(1, 1, batch_size=2, seed=3), previous, **settings)
+    ys, xs = np.nonzero(np.any(np.asarray(image) != np.asarray(previous), axis=2))
+    # The region touches cell (2, 1) only; its seams reach half a tile into the neighbours.
+    assert xs.min() >= 512 - 128 and xs.max() < 768 + 128
+    assert ys.min() >= 256 - 128 and ys.max() < 512 + 128
+    assert plan["total"]["backend_calls"] == backend.calls
+    assert plan["total"]["samples"] == backend.samples
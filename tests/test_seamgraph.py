@@ -0,0 +1,95 @@
+import contextlib
+import io
+import random
+import pytest
+from PIL import Image
+from gigadiffusion.backends import Processing
+from gigadiffusion.pipeline import USDUpscaler, dry_run, run
+from gigadiffusion.prefetch import rects_overlap
+from gigadiffusion.seamgraph import SeamGraph
+
+
+def random_rects(rng, count):
+    rects = []
+    for _ in range(count):
+        x, y = rng.randrange(0, 2000), rng.randrange(0, 2000)
+        rects.append((x, y, x + rng.randrange(1, 400), y + rng.randrange(1, 400)))
+    return rects
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_patches_of_one_color_never_overlap(seed):
+    rng = random.Random(seed)
+    rects = random_rects(rng, rng.randrange(1, 150))
+    graph = SeamGraph(rects, 256)
+    assert sorted(index for indexes in graph.color_sets() for index in indexes) == list(range(len(rects)))
+    for indexes in graph.color_sets():
+        assert not any(rects_overlap(rects[a], rects[b]) for a in indexes for b in indexes if a < b)
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("capacity", [1, 3, 8])
+def test_batches_never_overlap(seed, capacity):
+    rng = random.Random(seed)
+    rects = random_rects(rng, rng.randrange(1, 150))
+    groups = [rng.randrange(2) for _ in rects]
+    after = [rng.random() < 0.3 for _ in rects]
+    batches = SeamGraph(rects, 256).batches(capacity, groups, after)
+    assert sorted(index for batch in batches for index in batch) == list(range(len(rects)))
+    batch_of = {index: number for number, batch in enumerate(batches) for index in batch}
+    for batch in batches:
+        assert 0 < len(batch) <= capacity
+        assert len({groups[index] for index in batch}) == 1
+        assert not any(rects_overlap(rects[a], rects[b]) for a in batch for b in batch if a < b)
+    # Flagged patches run after every unflagged patch they overlap.
+    for a in range(len(rects)):
+        for b in range(len(rects)):
+            if after[a] and not after[b] and rects_overlap(rects[a], rects[b]):
+                assert batch_of[a] > batch_of[b]
+
+
+def seams_fix_jobs(size, tile_size, padding, seams_fix_type, batch_size, coloring):
+    p = Processing(*size, batch_size=batch_size)
+    with contextlib.redirect_stdout(io.StringIO()):
+        upscaler = USDUpscaler(p, Image.new("RGB", (400, 300)), None, False, False, tile_size)
+        upscaler.setup_redraw(1, padding, 0)
+        upscaler.setup_seams_fix(padding, 0.35, 0, 64, seams_fix_type)
+        upscaler.setup_seam_coloring(coloring)
+        upscaler.seams_fix.calc_jobs_count(*size, upscaler.rows, upscaler.cols, batch_size)
+    return upscaler.seams_fix
+
+
+@pytest.mark.parametrize("size,tile_size,padding", [((1680, 1200), 256, 32), ((1680, 1200), 256, 0), ((1600, 1216), 512, 128),
+                                                    ((4096, 3000), 512, 128), ((2000, 2000), 512, 0)])
+@pytest.mark.parametrize("seams_fix_type", [2, 3])
+@pytest.mark.parametrize("batch_size", [1, 4, 8])
+def test_coloring_never_needs_more_jobs(size, tile_size, padding, seams_fix_type, batch_size):
+    checkerboard = seams_fix_jobs(size, tile_size, padding, seams_fix_type, batch_size, False)
+    colored = seams_fix_jobs(size, tile_size, padding, seams_fix_type, batch_size, True)
+    assert len(colored.all_jobs()) <= len(checkerboard.all_jobs())
+    tiles = sorted(rect for job in checkerboard.all_jobs() for rect in job.tile_rects)
+    assert sorted(rect for job in colored.all_jobs() for rect in job.tile_rects) == tiles
+    for job in colored.colored_jobs:
+        assert len(job.tile_rects) <= batch_size
+        assert not any(rects_overlap(a, b) for a in job.tile_rects for b in job.tile_rects if a < b)
+
+
+@pytest.mark.parametrize("padding", [0, 32])
+@pytest.mark.parametrize("seams_fix_type", [2, 3])
+@pytest.mark.parametrize("batch_size", [2, 4])
+def test_coloring_dry_run_counts_match_run(seeded_backend, source, padding, seams_fix_type, batch_size):
+    settings = dict(tile_size=256, padding=padding, redraw_mode=1, seams_fix_type=seams_fix_type, seams_fix_padding=padding,
+                    detail_threshold=5, seam_coloring=True)
+    backend = seeded_backend()
+    with contextlib.redirect_stdout(io.StringIO()):
+        run(backend, Processing(1680, 1200, batch_size=batch_size, seed=3), source, save_redraw=False, save_seams_fix=False, **settings)
+        plan = dry_run(Processing(1680, 1200, batch_size=batch_size, seed=3), source, **settings)
+    assert plan["total"]["backend_calls"] == backend.calls
+    assert plan["total"]["samples"] == backend.samples
+
+
+def test_coloring_fills_part_batches():
+    checkerboard = seams_fix_jobs((4096, 3000), 512, 128, 3, 8, False)
+    colored = seams_fix_jobs((4096, 3000), 512, 128, 3, 8, True)
+    assert len(colored.colored_jobs) > 0
+    assert len(colored.all_jobs()) < len(checkerboard.all_jobs())
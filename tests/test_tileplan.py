@@ -0,0 +1,40 @@
+import math
+import random
+import pytest
+from gigadiffusion.pipeline import RectCalculator
+from gigadiffusion.prefetch import rects_overlap
+from gigadiffusion.tileplan import SpatialIndex, TilePlan
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_tile_plan_matches_rect_calculator(seed):
+    rng = random.Random(seed)
+    tile_size = rng.choice([64, 256, 320, 512, 1024])
+    padding = rng.choice([0, 1, 31, 32, 64, 127, 128])
+    width, height = rng.randrange(tile_size // 2, 12 * tile_size), rng.randrange(tile_size // 2, 12 * tile_size)
+    rows, cols = math.ceil(height / tile_size), math.ceil(width / tile_size)
+    plan = TilePlan(tile_size, padding, width, height, rows, cols)
+    for yi in range(rows):
+        for xi in range(cols):
+            args = (tile_size, padding, width, height, xi, yi, cols, rows)
+            assert plan.tile(xi, yi) == RectCalculator.calc_tile(*args)
+            assert plan.mask(xi, yi) == RectCalculator.calc_mask_in_tile(*args)
+            assert plan.row_seam(xi, yi) == RectCalculator.calc_row_seam_in_tile(*args)
+            assert plan.col_seam(xi, yi) == RectCalculator.calc_col_seam_in_tile(*args)
+            if xi < cols - 1 and yi < rows - 1:
+                assert plan.intersection(xi, yi) == RectCalculator.calc_intersection_in_tile(tile_size, width, height, xi, yi)
+            assert all(type(value) is int for value in plan.tile(xi, yi) + plan.mask(xi, yi))
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_spatial_index_matches_brute_force(seed):
+    rng = random.Random(seed)
+    rects = []
+    for _ in range(rng.randrange(0, 200)):
+        x, y = rng.randrange(-50, 1000), rng.randrange(-50, 1000)
+        rects.append((x, y, x + rng.randrange(1, 300), y + rng.randrange(1, 300)))
+    index = SpatialIndex(rects, rng.choice([16, 64, 256]))
+    assert index.pairs() == [(a, b) for a in range(len(rects)) for b in range(a + 1, len(rects)) if rects_overlap(rects[a], rects[b])]
+    left, top = rng.randrange(-50, 900), rng.randrange(-50, 900)
+    query = (left, top, left + rng.randrange(1, 400), top + rng.randrange(1, 400))
+    assert index.query(query) == [number for number, rect in enumerate(rects) if rects_overlap(rect, query)]
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from PIL import Image
+from gigadiffusion.upscale import TiledUpscaler
+
+
+def noise(width, height, seed=0):
+    return Image.fromarray(np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8), "RGB")
+
+
+@pytest.mark.parametrize("tile_size", [64, 100, 256])
+@pytest.mark.parametrize("size,target", [((400, 300), (1600, 1216)), ((333, 211), (1000, 777)), ((256, 192), (731, 505))])
+def test_tiled_upscale_matches_full_resize(tile_size, size, target):
+    source = noise(*size)
+    canvas = Image.new("RGB", target)
+    TiledUpscaler(None, None, tile_size, 16, workers=2).run(source, canvas)
+    expected = np.asarray(source.resize(target, resample=Image.LANCZOS), dtype=np.int16)
+    difference = np.abs(np.asarray(canvas, dtype=np.int16) - expected)
+    assert difference.max() <= 1
+
+
+def test_tiled_upscale_runs_the_chain():
+    source = noise(120, 90)
+    canvas = Image.new("RGB", (250, 190))
+    upscale = lambda image, scale: image.resize((image.width * scale, image.height * scale), resample=Image.NEAREST)
+    TiledUpscaler(upscale, [2], 48, 8, workers=2).run(source, canvas)
+    expected = np.asarray(upscale(source, 2).resize(canvas.size, resample=Image.LANCZOS), dtype=np.int16)
+    assert np.abs(np.asarray(canvas, dtype=np.int16) - expected).max() <= 2
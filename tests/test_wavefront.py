@@ -0,0 +1,52 @@
+import contextlib
+import hashlib
+import io
+import pytest
+from gigadiffusion.backends import Processing
+from gigadiffusion.pipeline import dry_run, run
+
+
+def render(backend, source, batch_size, **settings):
+    with contextlib.redirect_stdout(io.StringIO()):
+        upscaler = run(backend, Processing(1680, 1200, batch_size=batch_size, seed=3), source, **settings)
+    return hashlib.md5(upscaler.image.tobytes()).hexdigest()
+
+
+@pytest.mark.parametrize("extra", [{}, {"flat_tiles": 1}, {"flat_tiles": 2}, {"quadtree_levels": 1, "flat_tiles": 2},
+                                   {"seams_fix_denoise": 0.35, "padding": 0, "seams_fix_padding": 0}])
+@pytest.mark.parametrize("seams_fix_type", [2, 3])
+@pytest.mark.parametrize("batch_size", [1, 2, 4])
+def test_wavefront_matches_serial(seeded_backend, source, extra, seams_fix_type, batch_size):
+    settings = dict(tile_size=256, redraw_mode=1, seams_fix_type=seams_fix_type, save_redraw=False, save_seams_fix=False,
+                    detail_threshold=5, **extra)
+    serial, wavefront = seeded_backend(), seeded_backend()
+    assert render(serial, source, batch_size, **settings) == render(wavefront, source, batch_size, wavefront=True, **settings)
+    assert serial.samples == wavefront.samples
+    assert wavefront.calls <= serial.calls
+
+
+@pytest.mark.parametrize("wavefront", [False, True])
+@pytest.mark.parametrize("seams_fix_type", [1, 2, 3])
+@pytest.mark.parametrize("batch_size", [1, 3, 4])
+def test_dry_run_counts_match_run(seeded_backend, source, wavefront, seams_fix_type, batch_size):
+    settings = dict(tile_size=256, padding=32, redraw_mode=1, seams_fix_type=seams_fix_type, seams_fix_padding=32, detail_threshold=5)
+    backend = seeded_backend()
+    render(backend, source, batch_size, save_redraw=False, save_seams_fix=False, wavefront=wavefront, **settings)
+    with contextlib.redirect_stdout(io.StringIO()):
+        plan = dry_run(Processing(1680, 1200, batch_size=batch_size, seed=3), source, wavefront=wavefront, **settings)
+    assert plan["total"]["backend_calls"] == backend.calls
+    assert plan["total"]["samples"] == backend.samples
+
+
+@pytest.mark.parametrize("extra", [{}, {"seam_coloring": True}, {"wavefront": True}, {"quadtree_levels": 1}, {"seam_threshold": 1.2}])
+@pytest.mark.parametrize("seams_fix_type", [2, 3])
+@pytest.mark.parametrize("batch_size", [2, 3, 4])
+def test_dry_run_bounds_lower_denoise_run(seeded_backend, source, extra, seams_fix_type, batch_size):
+    settings = dict(tile_size=256, redraw_mode=1, seams_fix_type=seams_fix_type, flat_tiles=2, detail_threshold=5, **extra)
+    backend = seeded_backend()
+    render(backend, source, batch_size, save_redraw=False, save_seams_fix=False, **settings)
+    with contextlib.redirect_stdout(io.StringIO()):
+        plan = dry_run(Processing(1680, 1200, batch_size=batch_size, seed=3), source, **settings)
+    assert plan["upper_bound"]
+    assert plan["total"]["backend_calls"] >= backend.calls
+    assert plan["total"]["samples"] >= backend.samples